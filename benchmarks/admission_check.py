@@ -0,0 +1,63 @@
+"""Exercise the admission layer against a stub server that fails on purpose.
+
+Each scenario scripts the stub's responses (429s with Retry-After, 5xx
+errors) and checks how ``OpenAIProvider`` retries, waits and trips its
+circuit breaker.
+
+    python -m benchmarks.admission_check
+"""
+import time
+
+from glance.admission import AdmissionController, AdmissionError, CircuitOpenError
+from glance.encoder import EncodeBudget, encode_for_budget
+from glance.frame import Frame
+from glance.providers import OpenAIProvider
+from glance.screenshot import PixelBuffer
+
+from .stub_server import FlakyHandler, start_server
+
+
+def ask(provider, encoded):
+    start = time.perf_counter()
+    try:
+        answer = "".join(provider.stream([encoded], "What is on my screen?"))
+    except Exception as e:
+        answer = f"{type(e).__name__}: {e}"
+    return answer, time.perf_counter() - start
+
+
+def scenario(name, url, encoded, script, admission, queries=1):
+    FlakyHandler.script = list(script)
+    FlakyHandler.served = []
+    provider = OpenAIProvider(f"{url}/v1/chat/completions", "stub-key", admission=admission)
+    print(f"\n{name}")
+    for _ in range(queries):
+        answer, elapsed = ask(provider, encoded)
+        print(f"  {elapsed * 1000:8.1f}ms  {answer[:70]}")
+    print(f"  server saw {FlakyHandler.served}")
+    print(f"  admission {admission.stats()}")
+    provider.close()
+
+
+def main():
+    server, url = start_server(handler=FlakyHandler)
+    frame = Frame(PixelBuffer(bytes(64 * 64 * 3), 64, 64))
+    encoded = encode_for_budget(frame, EncodeBudget(max_bytes=64 * 1024))
+
+    scenario("Transient 503 and 502, then success", url, encoded, [503, 502],
+             AdmissionController(base_delay=0.05))
+    scenario("429 with Retry-After: 1 (the wait must be at least a second)", url, encoded, [(429, 1)],
+             AdmissionController(base_delay=0.05))
+    scenario("Persistent 500s open the circuit; later queries never reach the server", url, encoded,
+             [500] * 10, AdmissionController(base_delay=0.05, max_attempts=3, failure_threshold=3),
+             queries=3)
+    scenario("Client-side bucket: 120 rpm with a burst of 2 spaces out 6 queries", url, encoded, [],
+             AdmissionController(requests_per_minute=120, burst=2), queries=6)
+    scenario("Non-retryable 400 fails immediately", url, encoded, [400],
+             AdmissionController(base_delay=0.05))
+    server.shutdown()
+    assert issubclass(CircuitOpenError, AdmissionError)
+
+
+if __name__ == "__main__":
+    main()
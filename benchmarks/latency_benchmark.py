@@ -0,0 +1,281 @@
+"""End-to-end query latency, split by pipeline stage.
+
+Drives the real pipeline headlessly against the mock provider server: a
+capture (``take_screenshot``, or a synthetic frame with ``--source
+synthetic``), decode, scale, encode, the provider payload builder, and then
+a full ``ApiWorker`` query on the request scheduler. Network time is split
+into upload (until the mock has the whole body), first byte and completion.
+
+    python -m benchmarks.latency_benchmark --requests 30 --json run.json
+    python -m benchmarks.latency_benchmark --requests 30 --compare run.json
+
+With ``--compare`` the exit status is 1 if any stage regressed by more than
+``--threshold`` (and by at least ``--min-delta-ms``).
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import sys
+import time
+
+from PIL import Image, ImageDraw
+
+from glance.encoder import budget_for, encode_for_budget
+from glance.frame import Frame
+from glance.screenshot import PixelBuffer
+
+from . import mock_server
+from .stub_server import start_server
+
+STAGES = ("capture", "decode", "scale", "encode", "payload", "upload", "first_byte", "completion", "total")
+PROMPT = "What is on my screen?"
+
+
+def percentile(samples, fraction: float) -> float:
+    """Linearly interpolated percentile of ``samples``"""
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(samples) -> dict:
+    if not samples:
+        return {"n": 0}
+    return {
+        "n": len(samples),
+        "mean": round(sum(samples) / len(samples), 3),
+        "p50": round(percentile(samples, 0.5), 3),
+        "p90": round(percentile(samples, 0.9), 3),
+        "p99": round(percentile(samples, 0.99), 3),
+        "max": round(max(samples), 3),
+    }
+
+
+def synthetic_screen(width: int, height: int) -> PixelBuffer:
+    """Flat panels, text and a photo-like patch, roughly like a desktop"""
+    image = Image.new("RGB", (width, height), (236, 236, 236))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, width, 32), fill=(45, 45, 48))
+    draw.rectangle((0, 32, width // 5, height), fill=(250, 250, 250))
+    for row, y in enumerate(range(48, height - 16, 18)):
+        draw.text((width // 5 + 24, y), f"{row:04d}  The quick brown fox jumps over the lazy dog " * 2,
+                  fill=(20, 20, 20))
+    noise = Image.frombytes("RGB", (width // 4, height // 4), os.urandom((width // 4) * (height // 4) * 3))
+    image.paste(noise, (width - width // 4 - 16, height - height // 4 - 16))
+    return PixelBuffer(image.tobytes(), width, height, "RGB")
+
+
+class Pipeline:
+    """One benchmark target: a protocol, its client and the mock server log"""
+
+    def __init__(self, protocol: str, url: str, handler, registry, scheduler):
+        self.protocol = protocol
+        self.handler = handler
+        self.registry = registry
+        self.scheduler = scheduler
+        self.endpoint = f"{url}/v1/chat/completions"
+        self.provider = registry.get(protocol, self.endpoint, "mock-key")
+
+    def build_payload(self, encoded) -> None:
+        if self.protocol == "gemini":
+            self.provider.api._contents(encoded, PROMPT)
+        else:
+            json.dumps(self.provider.build_payload([encoded], PROMPT))
+
+    def ask(self, frame: Frame) -> dict:
+        """Run one ApiWorker query; returns its metrics, or {'error': message}"""
+        from PyQt5.QtCore import QEventLoop
+        from glance.api import ApiWorker
+
+        outcome = {}
+        loop = QEventLoop()
+
+        def finished(response):
+            outcome.update(response.get("metrics", {}))
+            loop.quit()
+
+        def failed(message):
+            outcome["error"] = message
+            loop.quit()
+
+        worker = ApiWorker(self.endpoint, "mock-key", frame, PROMPT, model_provider=self.protocol,
+                           registry=self.registry, scheduler=self.scheduler)
+        worker.finished.connect(finished)
+        worker.error.connect(failed)
+        log_start = len(self.handler.log)
+        worker.start()
+        loop.exec_()
+        # Let the job return before the next one is measured
+        concurrent.futures.wait([worker.future], timeout=5)
+        if "error" not in outcome and len(self.handler.log) > log_start:
+            # Last request the server saw for this query (after any retries)
+            received_ms = (self.handler.log[-1]["received"] - worker._start) * 1000
+            outcome["upload_ms"] = received_ms - outcome["request_ms"]
+            outcome["first_byte_ms"] = outcome["ttft_ms"] - received_ms
+        return outcome
+
+
+def run_pipeline(pipeline: Pipeline, capture, requests: int, warmup: int) -> dict:
+    samples = {stage: [] for stage in STAGES}
+    errors = {}
+    for i in range(warmup + requests):
+        timings = {}
+        start = time.perf_counter()
+        frame = capture()
+        timings["capture"] = (time.perf_counter() - start) * 1000
+
+        budget = budget_for(pipeline.provider.model)
+        start = time.perf_counter()
+        frame.image()
+        timings["decode"] = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        if budget.max_dimension:
+            frame.scaled(budget.max_dimension)
+        timings["scale"] = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        encoded = encode_for_budget(frame, budget)
+        timings["encode"] = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        pipeline.build_payload(encoded)
+        timings["payload"] = (time.perf_counter() - start) * 1000
+
+        # The worker reuses the frame's memoized encode, so its time is network time
+        outcome = pipeline.ask(frame)
+        if "error" in outcome:
+            if i >= warmup:
+                errors[outcome["error"]] = errors.get(outcome["error"], 0) + 1
+            continue
+        timings["upload"] = outcome["upload_ms"]
+        timings["first_byte"] = outcome["first_byte_ms"]
+        timings["completion"] = outcome["total_ms"] - outcome["ttft_ms"]
+        timings["total"] = (timings["capture"] + timings["decode"] + timings["scale"] + timings["encode"]
+                            + timings["payload"] + outcome["total_ms"])
+        if i >= warmup:
+            for stage, value in timings.items():
+                samples[stage].append(value)
+    return {
+        "requests": requests,
+        "errors": sum(errors.values()),
+        "error_messages": errors,
+        "stages": {stage: summarize(values) for stage, values in samples.items()},
+    }
+
+
+def print_report(report: dict) -> None:
+    for protocol, result in report["results"].items():
+        print(f"\n{protocol}: {result['requests']} requests, {result['errors']} errors")
+        print(f"  {'stage':<11}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+        for stage, stats in result["stages"].items():
+            if stats["n"]:
+                print(f"  {stage:<11}{stats['p50']:>10.2f}{stats['p90']:>10.2f}{stats['p99']:>10.2f}{stats['max']:>10.2f}")
+
+
+def compare(report: dict, baseline: dict, metric: str, threshold: float, min_delta_ms: float) -> bool:
+    """Print per-stage changes against ``baseline``; True if anything regressed"""
+    regressed = False
+    print(f"\nCompared with baseline ({metric}, threshold {threshold:.0%}):")
+    for protocol, result in report["results"].items():
+        old_stages = baseline.get("results", {}).get(protocol, {}).get("stages", {})
+        for stage, stats in result["stages"].items():
+            old = old_stages.get(stage, {}).get(metric)
+            new = stats.get(metric)
+            if old is None or new is None:
+                continue
+            delta = new - old
+            change = delta / old if old else 0.0
+            flag = ""
+            if delta > min_delta_ms and change > threshold:
+                flag = "  REGRESSION"
+                regressed = True
+            elif -delta > min_delta_ms and -change > threshold:
+                flag = "  improved"
+            print(f"  {protocol:<7}{stage:<11}{old:>10.2f} -> {new:>10.2f} ms ({change:+.1%}){flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--protocol", choices=("openai", "gemini", "both"), default="both")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed requests before measuring")
+    parser.add_argument("--source", choices=("screen", "synthetic"), default="screen",
+                        help="Capture the real screen, or use a synthetic frame if that fails")
+    parser.add_argument("--size", default="1920x1080", help="Synthetic frame size")
+    parser.add_argument("--no-retry", action="store_true", help="Surface injected errors instead of retrying")
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--compare", help="Baseline report to compare against")
+    parser.add_argument("--metric", default="p50", choices=("mean", "p50", "p90", "p99"))
+    parser.add_argument("--threshold", type=float, default=0.10)
+    parser.add_argument("--min-delta-ms", type=float, default=1.0)
+    mock_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    headless = "DISPLAY" not in os.environ and "WAYLAND_DISPLAY" not in os.environ
+    if headless:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    from glance.providers import ProviderRegistry
+    from glance.scheduler import RequestScheduler
+    from glance.screenshot import take_screenshot
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    width, height = (int(value) for value in args.size.split("x"))
+    synthetic = synthetic_screen(width, height)
+    source = args.source
+    if source == "screen" and (headless or take_screenshot() is None):
+        print("Screen capture unavailable, using a synthetic frame")
+        source = "synthetic"
+    if source == "screen":
+        capture = take_screenshot
+    else:
+        # A new Frame each time so nothing is served from the previous run's memo
+        capture = lambda: Frame(synthetic)
+
+    config = mock_server.config_from_args(args)
+    handler = mock_server.make_handler(config)
+    server, url = start_server(handler=handler)
+    limits = {"max_attempts": 1} if args.no_retry else {}
+    registry = ProviderRegistry(rate_limits={"openai": limits, "gemini": limits},
+                                provider_options={"gemini": {"base_url": url}})
+    scheduler = RequestScheduler()
+
+    protocols = ("openai", "gemini") if args.protocol == "both" else (args.protocol,)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "source": source,
+            "size": list(capture().size),
+            "requests": args.requests,
+            "mock": config.describe(),
+        },
+        "results": {},
+    }
+    for protocol in protocols:
+        pipeline = Pipeline(protocol, url, handler, registry, scheduler)
+        report["results"][protocol] = run_pipeline(pipeline, capture, args.requests, args.warmup)
+
+    scheduler.shutdown()
+    registry.close()
+    server.shutdown()
+    del app
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.json}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.metric, args.threshold, args.min_delta_ms):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
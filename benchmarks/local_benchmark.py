@@ -0,0 +1,68 @@
+"""Concurrent queries against a stand-in local server.
+
+The stand-in behaves like a llama.cpp server with two decoding slots and a
+fixed decode time. The benchmark sends bursts of concurrent queries through
+``LocalProvider``, with and without coalescing of identical questions, and
+reports latency, upstream request count and the slot count it probed.
+
+    python -m benchmarks.local_benchmark --concurrency 6
+"""
+import argparse
+import statistics
+import threading
+import time
+
+from glance.encoder import EncodeBudget, encode_for_budget
+from glance.frame import Frame
+from glance.providers import LocalProvider
+from glance.screenshot import PixelBuffer
+
+from .stub_server import LocalStubHandler, start_server
+
+
+def burst(provider, encoded, prompts):
+    timings = [0.0] * len(prompts)
+
+    def ask(index, prompt):
+        start = time.perf_counter()
+        "".join(provider.stream([encoded], prompt))
+        timings[index] = (time.perf_counter() - start) * 1000
+
+    threads = [threading.Thread(target=ask, args=(i, prompt)) for i, prompt in enumerate(prompts)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=6)
+    parser.add_argument("--slots", type=int, default=2)
+    parser.add_argument("--delay", type=float, default=0.2, help="Stand-in decode time per request (s)")
+    args = parser.parse_args()
+
+    server, url = start_server(handler=LocalStubHandler)
+    endpoint = f"{url}/v1/chat/completions"
+    frame = Frame(PixelBuffer(bytes(64 * 64 * 3), 64, 64))
+    encoded = encode_for_budget(frame, EncodeBudget(max_bytes=64 * 1024))
+
+    for label, coalesce, same in (("distinct questions", True, False),
+                                  ("identical, no coalescing", False, True),
+                                  ("identical, coalesced", True, True)):
+        LocalStubHandler.reset(args.slots, args.delay)
+        provider = LocalProvider(endpoint, model="stand-in", coalesce=coalesce)
+        warmup_ms = provider.warmup()
+        LocalStubHandler.received = 0
+        prompts = ["What is on my screen?" if same else f"Question {i}" for i in range(args.concurrency)]
+        timings = burst(provider, encoded, prompts)
+        print(f"{label:>26}: mean {statistics.mean(timings):7.1f}ms  max {max(timings):7.1f}ms  "
+              f"upstream {LocalStubHandler.received}  peak decoding {LocalStubHandler.peak}  "
+              f"slots {provider.parallel}  warmup {warmup_ms:.0f}ms")
+        provider.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
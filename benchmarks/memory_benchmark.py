@@ -0,0 +1,217 @@
+"""Memory use of a query, stage by stage, in normal and low-memory mode.
+
+Runs the query pipeline on a synthetic screen against the mock provider
+(started in a process of its own, so its copy of each request is not
+counted) and records with ``glance.memory.MemoryProfiler``, per stage: RSS
+before and after, the peak RSS during the stage, and the Python allocations
+still alive at its end. Then it runs ``--queries`` full ``ApiWorker``
+queries and records the RSS the process settles at after each one, which
+shows whether memory keeps growing in steady state.
+
+    python -m benchmarks.memory_benchmark
+    python -m benchmarks.memory_benchmark --size 5120x2880 --queries 20 --json memory.json
+
+Each mode runs in a fresh interpreter so neither inherits the other's heap.
+Per-stage peaks need Linux (``/proc/self/clear_refs``); elsewhere only the
+before and after figures are reported.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from .latency_benchmark import PROMPT, synthetic_screen
+from .preprocess_benchmark import bgrx
+
+MODES = ("normal", "low")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock(args) -> subprocess.Popen:
+    """The mock provider in a child process; returns once it accepts connections"""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.mock_server", "--port", str(args.port),
+         "--latency-ms", str(args.latency_ms), "--chunks", str(args.chunks), "--tokens-per-sec", "1000"],
+        stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("The mock server did not start")
+
+
+def run_mode(args) -> dict:
+    """Profile one mode in this process"""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtCore import QCoreApplication, QEventLoop
+    from glance.api import ApiWorker
+    from glance.encoder import budget_for, encode_for_budget
+    from glance.frame import Frame
+    from glance.memory import MB, MemoryGovernor, MemoryProfiler, peak_rss_bytes, reset_peak, rss_bytes, trim
+    from glance.providers import ProviderRegistry
+    from glance.scheduler import RequestScheduler
+    from glance.screenshot import PixelBuffer
+
+    low = args.mode == "low"
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    width, height = (int(value) for value in args.size.lower().split("x"))
+    # What a capture backend hands over: BGRX rows, copied into a fresh buffer each query
+    captured = bgrx(synthetic_screen(width, height))
+    endpoint = f"http://127.0.0.1:{args.port}/v1/chat/completions"
+    registry = ProviderRegistry(stream_body=low)
+    provider = registry.get("openai", endpoint, "mock-key")
+    scheduler = RequestScheduler()
+    budget = budget_for(provider.model)
+    governor = MemoryGovernor(ceiling_mb=args.ceiling_mb, check_interval_s=0) if low else None
+
+    def capture():
+        return Frame(PixelBuffer(bytes(captured), width, height, raw_mode="BGRX"))
+
+    def settle():
+        # What the widget does once a query is over: the governor's check in low-memory mode, nothing otherwise
+        if governor is not None:
+            governor.check(after_query=True)
+
+    # One untimed query loads the codecs and opens the connection
+    "".join(provider.stream([encode_for_budget(capture(), budget)], PROMPT))
+    settle()
+
+    profiler = MemoryProfiler(top=args.top, settle=True)
+    with profiler.stage("capture"):
+        frame = capture()
+    with profiler.stage("decode + hash"):
+        frame.perceptual_hash()
+    with profiler.stage("scale + encode"):
+        encoded = encode_for_budget(frame, budget)
+        if low:
+            frame.release()
+    with profiler.stage("request"):
+        answer = "".join(provider.stream([encoded], PROMPT))
+    with profiler.stage("settle"):
+        del frame, encoded, answer
+        settle()
+    profiler.stop()
+
+    def ask() -> None:
+        loop = QEventLoop()
+        worker = ApiWorker(endpoint, "mock-key", capture(), PROMPT, registry=registry, scheduler=scheduler,
+                           low_memory=low)
+        worker.finished.connect(lambda response: loop.quit())
+        worker.error.connect(lambda message: loop.quit())
+        worker.start()
+        loop.exec_()
+        worker.future.result(timeout=10)
+
+    trim()
+    reset_peak()
+    start_rss = rss_bytes()
+    settled = []
+    for _ in range(args.queries):
+        ask()
+        settle()
+        settled.append(rss_bytes())
+
+    scheduler.shutdown()
+    registry.close()
+    del app
+    return {
+        "mode": args.mode,
+        "size": args.size,
+        "stages": {stage.name: stage.report() for stage in profiler.stages},
+        "steady": {
+            "queries": args.queries,
+            "start_mb": round(start_rss / MB, 1),
+            "peak_mb": round(peak_rss_bytes() / MB, 1),
+            "settled_first_mb": round(settled[0] / MB, 1),
+            "settled_last_mb": round(settled[-1] / MB, 1),
+            "settled_max_mb": round(max(settled) / MB, 1),
+            "growth_per_query_kb": round((settled[-1] - settled[0]) / max(1, len(settled) - 1) / 1024, 1),
+        },
+        "governor": governor.stats() if governor is not None else None,
+    }
+
+
+def print_mode(result: dict) -> None:
+    print(f"\n== {result['mode']} ({result['size']})")
+    print(f"{'stage':>15} {'ms':>8} {'before':>8} {'peak':>8} {'after':>8} {'py peak':>8}  top allocations still alive")
+    for name, stage in result["stages"].items():
+        peak = stage["peak_rss_mb"] if stage["peak_rss_mb"] is not None else float("nan")
+        top = ", ".join(f"{entry['location'].rsplit(os.sep, 1)[-1]} {entry['kb']}KB" for entry in stage["top"][:3])
+        print(f"{name:>15} {stage['elapsed_ms']:8.1f} {stage['rss_before_mb']:8.1f} {peak:8.1f} "
+              f"{stage['rss_after_mb']:8.1f} {stage['traced_peak_mb']:8.2f}  {top}")
+    steady = result["steady"]
+    print(f"steady state over {steady['queries']} queries: peak {steady['peak_mb']}MB, settled "
+          f"{steady['settled_first_mb']} -> {steady['settled_last_mb']}MB "
+          f"({steady['growth_per_query_kb']}KB/query)")
+    if result["governor"] is not None:
+        print(f"governor: {result['governor']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=MODES + ("both",), default="both")
+    parser.add_argument("--size", default="3840x2160", help="Synthetic screen size")
+    parser.add_argument("--queries", type=int, default=10, help="Full queries run for the steady state")
+    parser.add_argument("--ceiling-mb", type=float, default=256, help="Idle RSS ceiling in low-memory mode")
+    parser.add_argument("--top", type=int, default=5, help="Allocation sites recorded per stage")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Mock server time to first byte")
+    parser.add_argument("--chunks", type=int, default=5, help="Chunks per mock answer")
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    if args.mode != "both" and args.port is not None:
+        # A child started below
+        result = run_mode(args)
+        with open(args.json, "w") as f:
+            json.dump(result, f)
+        return
+
+    args.port = free_port()
+    server = start_mock(args)
+    results = {}
+    try:
+        for mode in MODES if args.mode == "both" else (args.mode,):
+            with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as out:
+                path = out.name
+            command = [sys.executable, "-m", "benchmarks.memory_benchmark", "--mode", mode, "--port", str(args.port),
+                       "--json", path, "--size", args.size, "--queries", str(args.queries),
+                       "--ceiling-mb", str(args.ceiling_mb), "--top", str(args.top)]
+            subprocess.run(command, check=True)
+            with open(path) as f:
+                results[mode] = json.load(f)
+            os.unlink(path)
+            print_mode(results[mode])
+    finally:
+        server.terminate()
+        server.wait()
+
+    if len(results) == 2:
+        normal, low = results["normal"], results["low"]
+        print(f"\n{'':>15} {'normal':>8} {'low':>8}")
+        for name in normal["stages"]:
+            before, after = normal["stages"][name]["peak_over_before_mb"], low["stages"][name]["peak_over_before_mb"]
+            if before is not None:
+                print(f"{name + ' peak +':>15} {before:8.1f} {after:8.1f}  MB over the stage's starting RSS")
+        for key in ("peak_mb", "settled_last_mb"):
+            print(f"{key:>15} {normal['steady'][key]:8.1f} {low['steady'][key]:8.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
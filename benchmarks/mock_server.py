@@ -0,0 +1,253 @@
+"""Mock provider server speaking the OpenAI and Gemini streaming protocols.
+
+Serves ``/v1/chat/completions`` (OpenAI-compatible, SSE or JSON) and
+``/v1beta/models/{model}:streamGenerateContent?alt=sse`` /
+``:generateContent`` (Gemini, as called by google-genai with a custom
+``base_url``), plus the Gemini Files API upload and delete calls. Time to first byte, streaming throughput and injected errors
+are configurable, and every request is logged with the moment its body was
+fully received so a benchmark can split upload time from server time.
+
+    python -m benchmarks.mock_server --port 8080 --latency-ms 300 --error-rate 0.1
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from typing import NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+from .stub_server import start_server
+
+GEMINI_STATUS = {400: "INVALID_ARGUMENT", 429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+
+
+class MockConfig(NamedTuple):
+    """Behaviour of the mock server"""
+    # Delay between receiving the request body and sending the first chunk
+    latency_ms: float = 200
+    # Uniform random extra delay added to ``latency_ms``
+    jitter_ms: float = 0
+    # Streaming speed; each chunk carries one word
+    tokens_per_second: float = 50
+    chunks: int = 20
+    # Fraction of requests answered with ``error_status`` instead
+    error_rate: float = 0.0
+    error_status: int = 503
+    retry_after: Optional[float] = None
+    seed: Optional[int] = None
+    # Models whose answers stop at the output token limit, or come back empty
+    truncated_models: Tuple[str, ...] = ()
+    empty_models: Tuple[str, ...] = ()
+
+    def describe(self) -> dict:
+        return self._asdict()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    config = MockConfig()
+    log: list = []
+    # Files API uploads: upload id -> file name, and file name -> stored bytes
+    uploads: dict = {}
+    files: dict = {}
+    ids = itertools.count(1)
+    rng = random.Random()
+    _lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        received = time.perf_counter()
+        path = urlsplit(self.path).path
+        if path.startswith("/upload/"):
+            self._upload(body)
+            return
+        if path.endswith("/chat/completions"):
+            protocol = "openai"
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                request = {}
+            stream = bool(request.get("stream"))
+            model = request.get("model") or "mock"
+        elif ":streamGenerateContent" in path or ":generateContent" in path:
+            protocol = "gemini"
+            stream = ":streamGenerateContent" in path
+            model = path.rsplit("/", 1)[-1].split(":", 1)[0]
+        else:
+            self.send_error(404)
+            return
+
+        with self._lock:
+            failed = self.rng.random() < self.config.error_rate
+            jitter = self.rng.uniform(0, self.config.jitter_ms) if self.config.jitter_ms else 0.0
+        entry = {"protocol": protocol, "model": model, "bytes": length, "received": received,
+                 "status": self.config.error_status if failed else 200, "body": body}
+        with self._lock:
+            self.log.append(entry)
+
+        if failed:
+            self._send_error_body(protocol)
+            return
+        time.sleep((self.config.latency_ms + jitter) / 1000)
+        words = [] if model in self.config.empty_models else [f"word{i} " for i in range(self.config.chunks)]
+        if stream:
+            self._stream(protocol, model, words)
+        else:
+            self._send_json(200, self._event(protocol, model, "".join(words), last=True))
+
+    def _upload(self, body: bytes) -> None:
+        """Resumable upload: a start request returns the upload URL, the data request finalizes"""
+        command = self.headers.get("X-Goog-Upload-Command", "")
+        query = urlsplit(self.path).query
+        if "start" in command:
+            with self._lock:
+                upload_id = next(self.ids)
+                self.uploads[upload_id] = f"files/mock-{upload_id}"
+            host = self.headers.get("Host", "localhost")
+            self._send_json(200, {}, {"X-Goog-Upload-URL": f"http://{host}/upload/v1beta/files?upload_id={upload_id}",
+                                      "X-Goog-Upload-Status": "active"})
+            return
+        upload_id = int(query.partition("upload_id=")[2] or 0)
+        with self._lock:
+            name = self.uploads.pop(upload_id, None)
+            if name is not None:
+                self.files[name] = body
+        if name is None:
+            self.send_error(404)
+            return
+        host = self.headers.get("Host", "localhost")
+        self._send_json(200, {"file": {"name": name, "uri": f"http://{host}/v1beta/{name}",
+                                       "mimeType": "image/png", "sizeBytes": str(len(body)), "state": "ACTIVE"}},
+                        {"X-Goog-Upload-Status": "final"})
+
+    def do_DELETE(self):
+        name = urlsplit(self.path).path.split("/v1beta/", 1)[-1]
+        with self._lock:
+            found = self.files.pop(name, None) is not None
+        self._send_json(200 if found else 404, {})
+
+    def _event(self, protocol: str, model: str, text: str, last: bool) -> dict:
+        truncated = model in self.config.truncated_models
+        if protocol == "openai":
+            finish_reason = ("length" if truncated else "stop") if last else None
+            return {"model": model, "choices": [{"index": 0, "delta": {"content": text},
+                                                 "message": {"role": "assistant", "content": text},
+                                                 "finish_reason": finish_reason}]}
+        event = {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}],
+                 "modelVersion": model}
+        if last:
+            event["candidates"][0]["finishReason"] = "MAX_TOKENS" if truncated else "STOP"
+        return event
+
+    def _stream(self, protocol: str, model: str, words) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        interval = 1 / self.config.tokens_per_second if self.config.tokens_per_second > 0 else 0
+        # An empty answer is still one final event
+        for i, word in enumerate(words or [""]):
+            if i and interval:
+                time.sleep(interval)
+            event = self._event(protocol, model, word, last=i == max(len(words), 1) - 1)
+            self._write_chunk(f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8"))
+        if protocol == "openai":
+            self._write_chunk(b"data: [DONE]\r\n\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_error_body(self, protocol: str) -> None:
+        status = self.config.error_status
+        if protocol == "openai":
+            body = {"error": {"message": "Injected failure", "type": "server_error", "code": status}}
+        else:
+            body = {"error": {"code": status, "message": "Injected failure",
+                              "status": GEMINI_STATUS.get(status, "UNKNOWN")}}
+        headers = {}
+        if self.config.retry_after is not None:
+            headers["Retry-After"] = f"{self.config.retry_after:g}"
+        self._send_json(status, body, headers)
+
+    def _send_json(self, status: int, body: dict, headers: Optional[dict] = None) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_handler(config: MockConfig):
+    """Handler class bound to ``config`` with its own request log"""
+    return type("MockHandler", (MockHandler,), {
+        "config": config,
+        "log": [],
+        "uploads": {},
+        "files": {},
+        "ids": itertools.count(1),
+        "rng": random.Random(config.seed),
+        "_lock": threading.Lock(),
+    })
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Mock server options, shared with the benchmarks that start one"""
+    group = parser.add_argument_group("mock server")
+    group.add_argument("--latency-ms", type=float, default=200, help="Time to first byte")
+    group.add_argument("--jitter-ms", type=float, default=0, help="Random extra time to first byte")
+    group.add_argument("--tokens-per-sec", type=float, default=50, help="Streaming speed")
+    group.add_argument("--chunks", type=int, default=20, help="Chunks per answer")
+    group.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    group.add_argument("--error-status", type=int, default=503)
+    group.add_argument("--retry-after", type=float, default=None, help="Retry-After sent with errors")
+    group.add_argument("--seed", type=int, default=None)
+    group.add_argument("--truncated-model", action="append", default=[], help="Model whose answers hit the token limit")
+    group.add_argument("--empty-model", action="append", default=[], help="Model whose answers are empty")
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        tokens_per_second=args.tokens_per_sec,
+        chunks=args.chunks,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        seed=args.seed,
+        truncated_models=tuple(args.truncated_model),
+        empty_models=tuple(args.empty_model),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, url = start_server(args.port, handler=make_handler(config_from_args(args)))
+    print(f"OpenAI-compatible endpoint: {url}/v1/chat/completions")
+    print(f"Gemini base_url:            {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Compare per-query clients with the pooled provider registry.
+
+Starts a local HTTPS stub server and sends the same query repeatedly, once
+building a fresh client per request (the old ApiWorker behaviour) and once
+through a shared ``ProviderRegistry``.
+
+    python -m benchmarks.pool_benchmark --requests 50
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from glance.encoder import EncodeBudget, encode_for_budget
+from glance.frame import Frame
+from glance.providers import ProviderRegistry
+from glance.screenshot import PixelBuffer
+
+from .stub_server import make_self_signed_cert, start_server
+
+
+def run(label, get_client, encoded, count):
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        client = get_client()
+        "".join(client.stream([encoded], "What is on my screen?"))
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"{label:>8}: mean {statistics.mean(timings):6.2f}ms  "
+          f"p50 {timings[len(timings) // 2]:6.2f}ms  p95 {timings[int(len(timings) * 0.95) - 1]:6.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--http", action="store_true", help="Use plain HTTP instead of HTTPS")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        certfile = keyfile = None
+        if not args.http:
+            certfile, keyfile = make_self_signed_cert(tmp)
+        server, url = start_server(certfile=certfile, keyfile=keyfile)
+        endpoint = f"{url}/v1/chat/completions"
+
+        frame = Frame(PixelBuffer(os.urandom(640 * 360 * 3), 640, 360))
+        encoded = encode_for_budget(frame, EncodeBudget(max_bytes=200 * 1024, max_dimension=640))
+
+        verify = certfile or True
+        run("fresh", lambda: ProviderRegistry(verify=verify).get("openai", endpoint, "key"), encoded, args.requests)
+
+        pooled = ProviderRegistry(verify=verify)
+        run("pooled", lambda: pooled.get("openai", endpoint, "key"), encoded, args.requests)
+        print("pool stats:", pooled.stats())
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
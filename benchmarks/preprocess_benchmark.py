@@ -0,0 +1,119 @@
+"""Image preprocessing cost: in the query thread versus the process pool.
+
+Encodes synthetic desktops of several resolutions to a model's budget, once
+with ``encoder.encode_for_budget`` on a background thread (as queries did)
+and once with ``PreprocessPool``. While each encode runs, the main thread
+plays the part of the Qt event loop: it wakes every millisecond and records
+how late it woke. ``max_lag_ms`` is the longest it was held up, and
+``blocked_ms`` the time spent more than 5ms late, i.e. time the UI would
+have felt stuck.
+
+    python -m benchmarks.preprocess_benchmark
+    python -m benchmarks.preprocess_benchmark --sizes 5120x2880 7680x2160 --workers 4 --json run.json
+
+The pool only pays off with more than one core: on a single CPU its workers
+compete with each other and with the main thread.
+"""
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+
+from glance.encoder import budget_for, encode_for_budget
+from glance.frame import Frame
+from glance.preprocess import PreprocessPool
+from glance.screenshot import PixelBuffer
+
+from .latency_benchmark import synthetic_screen
+
+SIZES = ("1920x1080", "2560x1440", "3840x2160", "5120x2880", "7680x2160")
+# Woken this much later than asked, the UI counts as blocked
+BLOCKED_MS = 5
+
+
+def bgrx(buffer: PixelBuffer) -> bytes:
+    """RGB pixels as the BGRX rows most capture backends return"""
+    data = bytearray(buffer.width * buffer.height * 4)
+    data[0::4] = buffer.data[2::3]
+    data[1::4] = buffer.data[1::3]
+    data[2::4] = buffer.data[0::3]
+    return bytes(data)
+
+
+def measure(encode) -> dict:
+    """Run ``encode`` on a thread while the main thread measures its own wake-up lag"""
+    result = {}
+
+    def run():
+        start = time.perf_counter()
+        result["encoded"] = encode()
+        result["wall_ms"] = (time.perf_counter() - start) * 1000
+
+    worker = threading.Thread(target=run)
+    lags = []
+    worker.start()
+    while worker.is_alive():
+        expected = time.perf_counter() + 0.001
+        time.sleep(0.001)
+        lags.append(max(0.0, (time.perf_counter() - expected) * 1000))
+    worker.join()
+    result["max_lag_ms"] = max(lags, default=0.0)
+    result["blocked_ms"] = sum(lag for lag in lags if lag > BLOCKED_MS)
+    return result
+
+
+def summarize(runs) -> dict:
+    return {
+        "wall_ms": round(statistics.median(run["wall_ms"] for run in runs), 1),
+        "max_lag_ms": round(max(run["max_lag_ms"] for run in runs), 1),
+        "blocked_ms": round(statistics.median(run["blocked_ms"] for run in runs), 1),
+        "encode": runs[-1]["encoded"].report(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=SIZES, help="WIDTHxHEIGHT resolutions")
+    parser.add_argument("--model", default="gemini-1.5-pro", help="Model whose encode budget is used")
+    parser.add_argument("--workers", type=int, help="Pool processes, default one per CPU up to 4")
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    budget = budget_for(args.model)
+    pool = PreprocessPool(workers=args.workers, min_pixels=0)
+    start = time.perf_counter()
+    pool.warm_up()
+    print(f"{os.cpu_count()} CPUs, {pool.workers} workers (warm-up {(time.perf_counter() - start) * 1000:.0f}ms), "
+          f"budget {budget.max_bytes // 1024}KB / {budget.max_dimension}px")
+    print(f"{'size':>10} {'mode':>7} {'wall ms':>8} {'max lag':>8} {'blocked':>8}  result")
+
+    results = {"cpus": os.cpu_count(), "workers": pool.workers, "model": args.model, "sizes": {}}
+    for size in args.sizes:
+        width, height = (int(value) for value in size.lower().split("x"))
+        data = bgrx(synthetic_screen(width, height))
+
+        def frame():
+            # A fresh frame each time, so nothing is served from its caches
+            return Frame(PixelBuffer(data, width, height, raw_mode="BGRX"))
+
+        row = {}
+        for mode, encode in (("thread", lambda: encode_for_budget(frame(), budget)),
+                             ("pool", lambda: pool.encode_for_budget(frame(), budget))):
+            row[mode] = summarize([measure(encode) for _ in range(args.iterations)])
+            report = row[mode]["encode"]
+            print(f"{size:>10} {mode:>7} {row[mode]['wall_ms']:8.1f} {row[mode]['max_lag_ms']:8.1f} "
+                  f"{row[mode]['blocked_ms']:8.1f}  {report['format']} q={report['quality']} "
+                  f"{report['width']}x{report['height']} {report['bytes'] // 1024}KB in {report['steps']} steps")
+        results["sizes"][size] = row
+    pool.close()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Time the change-region detector on synthetic captures.
+
+Compares pairs of frames that differ in a small window, a scattered set of
+spots, or everywhere, and reports per-update timings.
+
+    python -m benchmarks.regions_benchmark --width 3840 --height 2160
+"""
+import argparse
+import os
+import statistics
+import time
+
+import numpy as np
+
+from glance.frame import Frame
+from glance.regions import ChangeDetector
+from glance.screenshot import PixelBuffer
+
+
+def mutate(base: np.ndarray, scenario: str) -> bytes:
+    pixels = base.copy()
+    height, width = pixels.shape[:2]
+    if scenario == "window":
+        pixels[height // 3:height // 3 + 300, width // 2:width // 2 + 500] ^= 0xFF
+    elif scenario == "scattered":
+        for i in range(8):
+            y, x = (i * 997) % (height - 20), (i * 1499) % (width - 20)
+            pixels[y:y + 12, x:x + 12] ^= 0xFF
+    elif scenario == "full":
+        pixels ^= 0x01
+    return pixels.tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=3840)
+    parser.add_argument("--height", type=int, default=2160)
+    parser.add_argument("--tile-size", type=int, default=64)
+    parser.add_argument("--iterations", type=int, default=30)
+    args = parser.parse_args()
+
+    base = np.frombuffer(os.urandom(args.width * args.height * 4), np.uint8).reshape(args.height, args.width, 4)
+    frames = {"unchanged": base.tobytes()}
+    for scenario in ("window", "scattered", "full"):
+        frames[scenario] = mutate(base, scenario)
+
+    print(f"{args.width}x{args.height} BGRX, {args.tile_size}px tiles")
+    for scenario, data in frames.items():
+        first = Frame(PixelBuffer(base.tobytes(), args.width, args.height, raw_mode="BGRX"))
+        second = Frame(PixelBuffer(data, args.width, args.height, raw_mode="BGRX"))
+        timings = []
+        for _ in range(args.iterations):
+            detector = ChangeDetector(tile_size=args.tile_size)
+            detector.update(first)
+            start = time.perf_counter()
+            result = detector.update(second)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        print(f"{scenario:>10}: mean {statistics.mean(timings):5.2f}ms  p95 {timings[int(len(timings) * 0.95) - 1]:5.2f}ms  "
+              f"changed {result.changed_fraction:6.1%}  boxes {result.boxes}")
+
+
+if __name__ == "__main__":
+    main()
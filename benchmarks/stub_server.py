@@ -0,0 +1,156 @@
+"""Minimal OpenAI-compatible stub server for local benchmarks.
+
+Answers every POST with a short server-sent event stream, over HTTP or, when
+given a certificate, HTTPS. Responses carry a Content-Length so clients can
+keep the connection alive between requests. ``FlakyHandler`` fails requests
+with scripted 429/5xx responses to exercise retry and admission logic, and
+``LocalStubHandler`` stands in for a llama.cpp server with a fixed number of
+decoding slots.
+"""
+import json
+import os
+import ssl
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+
+def sse_body(words, model: str = "stub") -> bytes:
+    """Encode ``words`` as an OpenAI chat completion event stream"""
+    events = []
+    for word in words:
+        event = {"model": model, "choices": [{"index": 0, "delta": {"content": word}}]}
+        events.append(f"data: {json.dumps(event)}\n\n")
+    events.append("data: [DONE]\n\n")
+    return "".join(events).encode("utf-8")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    answer = ["This ", "is ", "a ", "stub ", "answer."]
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        body = sse_body(self.answer)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FlakyHandler(StubHandler):
+    """Fails requests according to ``script``, then answers normally
+
+    Each script entry is a status code, or a ``(status, retry_after)`` pair
+    that adds a Retry-After header. Set ``script`` on a subclass or reset it
+    between runs; ``served`` records the status of every request.
+    """
+    script = []
+    served = []
+    _lock = threading.Lock()
+
+    def do_POST(self):
+        with self._lock:
+            step = self.script.pop(0) if self.script else 200
+        status, retry_after = step if isinstance(step, tuple) else (step, None)
+        self.served.append(status)
+        if status == 200:
+            return super().do_POST()
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        body = json.dumps({"error": {"code": status, "message": "injected failure"}}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class LocalStubHandler(StubHandler):
+    """llama.cpp-like server: ``/props`` reports ``slots``, each answer takes ``delay`` seconds
+
+    Requests beyond the slot count wait for a free slot, as they do in the
+    real server. ``received`` counts chat requests and ``peak`` the most
+    decoded at once.
+    """
+    slots = 2
+    delay = 0.2
+    received = 0
+    active = 0
+    peak = 0
+    _lock = threading.Lock()
+    _slots = None
+
+    @classmethod
+    def reset(cls, slots: int = 2, delay: float = 0.2):
+        cls.slots, cls.delay = slots, delay
+        cls.received = cls.active = cls.peak = 0
+        cls._slots = threading.BoundedSemaphore(slots)
+
+    def do_GET(self):
+        if self.path != "/props":
+            self.send_error(404)
+            return
+        body = json.dumps({"total_slots": self.slots}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        cls = type(self)
+        with cls._lock:
+            cls.received += 1
+        with cls._slots:
+            with cls._lock:
+                cls.active += 1
+                cls.peak = max(cls.peak, cls.active)
+            time.sleep(self.delay)
+            with cls._lock:
+                cls.active -= 1
+        super().do_POST()
+
+
+def make_self_signed_cert(directory: str) -> Tuple[str, str]:
+    """Create a localhost certificate with the openssl CLI
+
+    Returns:
+        Tuple[str, str]: Certificate and key file paths
+    """
+    certfile = os.path.join(directory, "stub-cert.pem")
+    keyfile = os.path.join(directory, "stub-key.pem")
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+        "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+        "-keyout", keyfile, "-out", certfile,
+    ], check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def start_server(port: int = 0, certfile: Optional[str] = None, keyfile: Optional[str] = None,
+                 handler=StubHandler) -> Tuple[ThreadingHTTPServer, str]:
+    """Serve ``handler`` on a background thread
+
+    Returns:
+        Tuple[ThreadingHTTPServer, str]: The server and its base URL
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    scheme = "http"
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{scheme}://localhost:{server.server_address[1]}"
@@ -0,0 +1,346 @@
+"""Rate-limit-aware admission, retry and circuit breaking for provider calls.
+
+Every provider client owns an ``AdmissionController``. Before a request goes
+out it must take a token from a requests-per-minute bucket and its estimated
+cost from a tokens-per-minute bucket, and the circuit breaker must be closed.
+Throttling (429) and server errors (5xx, connection failures) are retried
+with jittered exponential backoff, honoring ``Retry-After``, as long as the
+retry budget allows and no part of the answer has been streamed yet.
+"""
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Callable, Iterator, Optional, Sequence, Tuple
+
+from .tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class AdmissionError(Exception):
+    """Raised when a request is refused before it is sent"""
+
+
+class CircuitOpenError(AdmissionError):
+    """Raised while the circuit breaker is open"""
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at ``rate_per_minute``"""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Take ``amount`` tokens, going into debt if needed
+
+        Returns:
+            Seconds to wait before the reservation is honored
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def refund(self, amount: float) -> None:
+        """Give back a reservation that was never used"""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def try_take(self, amount: float = 1) -> bool:
+        """Take ``amount`` tokens if they are available now; never goes into debt"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
+
+
+class CircuitBreaker:
+    """Stops sending requests after repeated failures, then probes recovery"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self) -> bool:
+        """Raise ``CircuitOpenError`` unless a request may be sent now
+
+        Returns:
+            True if this request is the trial that decides whether the circuit closes
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError("Provider is failing repeatedly; requests are paused for a moment.")
+                # Let one trial request through
+                self.state = self.HALF_OPEN
+                return True
+            if self.state == self.HALF_OPEN:
+                raise CircuitOpenError("Provider is recovering; waiting for the trial request.")
+            return False
+
+    def abandon_trial(self) -> None:
+        """The trial ended without an answer either way; the next request becomes the trial"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                # opened_at is already past the reset timeout
+                self.state = self.OPEN
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """Allows retries only up to a fraction of recent requests, plus a small floor"""
+
+    def __init__(self, ratio: float = 0.2, min_per_minute: int = 6):
+        self.ratio = ratio
+        self.floor = TokenBucket(min_per_minute)
+        self.balance = 0.0
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.balance = min(self.balance + self.ratio, 10.0)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+        return self.floor.try_take(1)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify(error: Exception) -> Tuple[bool, Optional[float]]:
+    """Whether ``error`` is worth retrying, and any server-requested delay"""
+    import requests
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True, None
+    response = getattr(error, "response", None)
+    # requests.HTTPError has status_code on the response; google-genai APIError has .code
+    status = getattr(response, "status_code", None) or getattr(error, "code", None)
+    if status in RETRYABLE_STATUS:
+        headers = getattr(response, "headers", None) or {}
+        return True, parse_retry_after(headers.get("Retry-After"))
+    return False, None
+
+
+def estimate_tokens(prompt: str, image_sizes: Sequence[Tuple[int, int]] = (), max_output: int = 300) -> int:
+    """Rough request cost: ~4 characters per text token, 170 tokens per 512px image tile"""
+    tokens = len(prompt) // 4 + max_output
+    for width, height in image_sizes:
+        tokens += 85 + 170 * (-(-width // 512)) * (-(-height // 512))
+    return tokens
+
+
+class AdmissionController:
+    """Token buckets, retries and a circuit breaker for one provider client"""
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 20,
+                 max_wait: float = 30, failure_threshold: int = 5, reset_timeout: float = 30,
+                 retry_budget_ratio: float = 0.2, burst: Optional[int] = None):
+        """
+        Args:
+            requests_per_minute: Client-side request rate limit, None for unlimited
+            tokens_per_minute: Client-side token rate limit, None for unlimited
+            max_attempts: Attempts per request, including the first
+            base_delay: First backoff delay in seconds, doubled per retry
+            max_delay: Upper bound for a single backoff delay
+            max_wait: Longest we queue a request for rate limits before giving up
+            failure_threshold: Consecutive failures that open the circuit
+            reset_timeout: Seconds the circuit stays open before a trial request
+            retry_budget_ratio: Retries allowed per request sent, on average
+            burst: Requests that may be sent back to back, default a full minute's worth
+        """
+        self.request_bucket = TokenBucket(requests_per_minute, burst) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.budget = RetryBudget(retry_budget_ratio)
+        self.paused_until = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.throttled_ms = 0.0
+
+    @classmethod
+    def from_config(cls, options: dict) -> "AdmissionController":
+        """Build from a ``rate_limits`` config entry such as ``{"rpm": 60, "tpm": 100000}``"""
+        return cls(
+            requests_per_minute=options.get("rpm"),
+            tokens_per_minute=options.get("tpm"),
+            max_attempts=options.get("max_attempts", 4),
+            base_delay=options.get("base_delay", 0.5),
+            max_delay=options.get("max_delay", 20),
+            max_wait=options.get("max_wait", 30),
+            failure_threshold=options.get("failure_threshold", 5),
+            reset_timeout=options.get("reset_timeout", 30),
+            burst=options.get("burst"),
+        )
+
+    def _sleep(self, seconds: float, is_cancelled: Optional[Callable[[], bool]]) -> None:
+        end = time.monotonic() + seconds
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0 or (is_cancelled is not None and is_cancelled()):
+                return
+            time.sleep(min(remaining, 0.1))
+
+    def _admit(self, tokens: int, is_cancelled) -> None:
+        wait = max(0.0, self.paused_until - time.monotonic())
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None and tokens:
+            wait = max(wait, self.token_bucket.reserve(tokens))
+        if wait > self.max_wait:
+            # Refused requests are never sent, so they must not push later ones further out
+            if self.request_bucket is not None:
+                self.request_bucket.refund(1)
+            if self.token_bucket is not None and tokens:
+                self.token_bucket.refund(tokens)
+            raise AdmissionError(f"Rate limit reached. Please wait {wait:.0f}s and try again.")
+        if wait > 0:
+            self.throttled_ms += wait * 1000
+            self._note("throttled_ms", wait * 1000)
+            self._sleep(wait, is_cancelled)
+
+    @staticmethod
+    def _note(metric: str, amount: float = 1) -> None:
+        """Count ``metric`` globally and on the span this request runs in"""
+        tracer = get_tracer()
+        tracer.count(f"{metric}_total", amount)
+        span = tracer.current()
+        if span is not None:
+            span.add(metric, amount)
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff for the given retry number"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def stream(self, open_stream: Callable[[], Iterator[str]], tokens: int = 0,
+               is_cancelled: Optional[Callable[[], bool]] = None) -> Iterator[str]:
+        """Admit, send and, where safe, retry a streaming request
+
+        A request is only retried if nothing has been yielded yet, so callers
+        never see duplicated text.
+
+        Args:
+            is_cancelled: Returns True once the caller gave up; rate-limit waits
+                and backoff stop early and no further attempt is made
+        """
+        attempt = 0
+        while True:
+            trial = self.breaker.before_call()
+            # Whether the breaker has heard how this attempt went
+            settled = False
+            try:
+                self._admit(tokens, is_cancelled)
+                if is_cancelled is not None and is_cancelled():
+                    raise AdmissionError("Request cancelled while waiting for the rate limit.")
+                self.requests += 1
+                self.budget.deposit()
+                started = False
+                try:
+                    for text in open_stream():
+                        started = True
+                        yield text
+                    self.breaker.record_success()
+                    settled = True
+                    return
+                except Exception as e:
+                    retryable, retry_after = classify(e)
+                    if not retryable:
+                        # The provider answered, so it is healthy even if the request was bad
+                        self.breaker.record_success()
+                        settled = True
+                        raise
+                    self.breaker.record_failure()
+                    settled = True
+                    # A failed trial reopened the circuit; a retry would only report that
+                    if trial or started or attempt + 1 >= self.max_attempts or not self.budget.withdraw():
+                        raise
+                    delay = self.backoff(attempt)
+                    if retry_after is not None:
+                        # The server told every request to back off, not just this one
+                        delay = max(delay, retry_after)
+                        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                    logger.info("Retrying after %s (attempt %d, %.2fs)", e, attempt + 2, delay)
+                    self.retries += 1
+                    self._note("retries")
+                    attempt += 1
+                    self._sleep(delay, is_cancelled)
+                    if is_cancelled is not None and is_cancelled():
+                        raise
+            finally:
+                # Refused locally, cancelled, or the stream was closed early: the
+                # trial said nothing about the provider, so let the next request try
+                if trial and not settled:
+                    self.breaker.abandon_trial()
+
+    def call(self, fn: Callable[[], object], tokens: int = 0, is_cancelled: Optional[Callable[[], bool]] = None):
+        """Non-streaming variant of ``stream`` for a call returning a single result"""
+        def once():
+            yield fn()
+        # Run the stream to its end so the outcome reaches the circuit breaker
+        return list(self.stream(once, tokens, is_cancelled))[0]
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "throttled_ms": round(self.throttled_ms, 1),
+            "circuit": self.breaker.state,
+        }
@@ -1,91 +1,387 @@
-import base64
+import logging
+import threading
+import time
 import requests
-from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtCore import QObject, pyqtSignal
 from typing import Optional, Literal
-from .geminiapi import GeminiAPI
+from .admission import AdmissionError
+from .frame import Frame
+from .encoder import budget_for, encode_for_budget
+from .preprocess import PreprocessPool
+from .providers import ProviderRegistry
+from .cache import ResponseCache
+from .scheduler import RequestScheduler, get_scheduler
+from .hedging import HedgePolicy
+from .router import ESCALATE_REASONS, ModelRouter, Route, classify
+from .session import Session, Turn
+from .tracing import BYTES_BUCKETS, Span, get_tracer
 
-class ApiWorker(QThread):
+logger = logging.getLogger(__name__)
+
+DETAIL_NOTE = ("The first image is the whole screen at reduced resolution. "
+               "The second is a full-resolution crop of the area that changed since the last question.")
+
+class ApiWorker(QObject):
+    """One query, run as a job on the shared request scheduler
+
+    Signals are emitted from the scheduler's threads and delivered queued to
+    the GUI thread. Once cancelled, a worker never emits again, so a stale
+    answer cannot overwrite a newer one.
+    """
     finished = pyqtSignal(dict)
     error = pyqtSignal(str)
+    # Partial answer text, emitted as it streams in
+    chunk = pyqtSignal(str)
+    # The text streamed so far is discarded; the answer restarts on the given model
+    restarted = pyqtSignal(str)
 
-    def __init__(self, api_endpoint, api_key, image_path, prompt, model_provider: Literal['openai', 'gemini'] = 'openai'):
+    def __init__(self, api_endpoint, api_key, frame: Frame, prompt, model_provider: Literal['openai', 'gemini', 'local'] = 'openai',
+                 image_budgets: Optional[dict] = None, registry: Optional[ProviderRegistry] = None,
+                 cache: Optional[ResponseCache] = None, detail: Optional[Frame] = None,
+                 scheduler: Optional[RequestScheduler] = None, deadline: float = 60,
+                 hedge: Optional[HedgePolicy] = None, trace: Optional[Span] = None,
+                 session: Optional[Session] = None, router: Optional[ModelRouter] = None,
+                 preprocess: Optional[PreprocessPool] = None, low_memory: bool = False):
         super().__init__()
         self.api_endpoint = api_endpoint
         self.api_key = api_key
-        self.image_path = image_path
+        self.frame = frame
         self.prompt = prompt
         self.model_provider = model_provider
-        
-        # Initialize Gemini API if selected
-        self.gemini = None
-        if model_provider == 'gemini':
-            self.gemini = GeminiAPI(api_key)
+        self.image_budgets = image_budgets
+        # Shared pooled clients; a private registry means a one-off client
+        self.registry = registry or ProviderRegistry()
+        self.cache = cache
+        # Crop of the changed screen area, sent alongside a low-res overview
+        self.detail = detail
+        self.scheduler = scheduler or get_scheduler()
+        # End-to-end time limit in seconds, including queueing
+        self.deadline = deadline
+        self.future = None
+        # Optional second provider/model raced against the primary
+        self.hedge = hedge
+        # Conversation this question continues, in session mode
+        self.session = session
+        # Picks the model tier and escalates bad answers (None: always the provider's model)
+        self.router = router
+        # Worker processes that resize and encode large frames (None: encode on this thread)
+        self.preprocess = preprocess
+        # Drop the frames' decoded and candidate encodes as soon as the images are chosen
+        self.low_memory = low_memory
+        self._cancelled = threading.Event()
+        # Per-request measurements, attached to the emitted response
+        self.metrics = {}
+        # Root span of this query; the UI finishes it after rendering, or we do if it is ours
+        self.owns_trace = trace is None
+        self.error_message = None
+        self.trace = trace or get_tracer().trace("query", provider=model_provider)
+
+    def start(self):
+        """Submit the query to the scheduler"""
+        self.future = self.scheduler.submit(self.run, timeout=self.deadline, on_timeout=self._timed_out)
+
+    def cancel(self):
+        """Abandon the query; any in-flight stream stops at its next chunk"""
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def _timed_out(self):
+        self._emit_error(f"Request exceeded its {self.deadline:g}s deadline. Please try again.")
+        self._cancelled.set()
+
+    def _emit_error(self, message: str):
+        self.error_message = message
+        if not self.is_cancelled():
+            self.error.emit(message)
+
+    def encode_image(self, model: str):
+        """Encode the frame for ``model`` and record the chosen settings"""
+        encoded = self._encode_for_budget(self.frame, budget_for(model, self.image_budgets))
+        self.metrics["encode"] = encoded.report()
+        logger.info("Image for %s: %s", model, self.metrics["encode"])
+        return encoded
+
+    def encode_images(self, model: str):
+        """Encode the frame, or a low-res overview plus the detail crop, for ``model``"""
+        if self.detail is None:
+            return [self.encode_image(model)]
+
+        # Split the byte budget: a third for context, the rest for the changed area
+        budget = budget_for(model, self.image_budgets)
+        overview_budget = budget._replace(max_bytes=budget.max_bytes // 3,
+                                          max_dimension=(budget.max_dimension or max(self.frame.size)) // 2)
+        detail_budget = budget._replace(max_bytes=budget.max_bytes - overview_budget.max_bytes)
+        overview = self._encode_for_budget(self.frame, overview_budget)
+        detail = self._encode_for_budget(self.detail, detail_budget)
+        self.metrics["encode"] = overview.report()
+        self.metrics["encode_detail"] = detail.report()
+        logger.info("Images for %s: overview %s, detail %s", model, self.metrics["encode"], self.metrics["encode_detail"])
+        return [overview, detail]
+
+    def _encode_for_budget(self, frame: Frame, budget):
+        if self.preprocess is not None:
+            encoded = self.preprocess.encode_for_budget(frame, budget)
+        else:
+            encoded = encode_for_budget(frame, budget)
+        if self.low_memory:
+            # An escalation to a model with a different budget decodes the frame again
+            frame.release()
+        return encoded
+
+    def _emit_chunk(self, text: str):
+        """Forward a piece of the answer, recording time-to-first-token"""
+        if "ttft_ms" not in self.metrics:
+            self.metrics["ttft_ms"] = round((time.perf_counter() - self._start) * 1000, 2)
+            get_tracer().observe("ttft_ms", self.metrics["ttft_ms"])
+        if not self.is_cancelled():
+            self.chunk.emit(text)
+
+    def _finish(self, content: str):
+        self.metrics["total_ms"] = round((time.perf_counter() - self._start) * 1000, 2)
+        logger.info("Request timings: ttft=%sms total=%sms", self.metrics.get("ttft_ms"), self.metrics["total_ms"])
+        if self.is_cancelled():
+            return
+        self.finished.emit({
+            'choices': [{
+                'message': {
+                    'content': content
+                }
+            }],
+            'metrics': self.metrics
+        })
+
+    def _ask(self, provider):
+        """Encode the frame, stream the answer from ``provider`` and emit it"""
+        tracer = get_tracer()
+        self.trace.set(model=provider.model)
+        if self.session is not None:
+            self._ask_in_session(provider)
+            return
+        models = self.router.tiers_for(provider.name, provider.model) if self.router is not None else [provider.model]
+        if self.cache is not None:
+            # Checked before any encoding or network work; any tier's answer will do
+            with self.trace.child("cache_lookup") as span:
+                frame_hash = self.frame.perceptual_hash()
+                cached = None
+                for model in models:
+                    cached = self.cache.get(frame_hash, self.prompt, model)
+                    if cached is not None:
+                        break
+                self.metrics["cache"] = "hit" if cached is not None else "miss"
+                span.set(result=self.metrics["cache"])
+            if cached is not None:
+                self._emit_chunk(cached)
+                self._finish(cached)
+                return
+
+        with self.trace.child("preprocess") as span:
+            # Encoded for the lowest tier; the router judges the image by that encode
+            images = self.encode_images(models[0])
+            payload_bytes = sum(len(encoded.data) for encoded in images)
+            span.set(images=len(images), payload_bytes=payload_bytes)
+        self.trace.set(payload_bytes=payload_bytes)
+        tracer.observe("payload_bytes", payload_bytes, buckets=BYTES_BUCKETS)
+        route = self._route(provider, images)
+        prompt = self.prompt if self.detail is None else f"{DETAIL_NOTE}\n\n{self.prompt}"
+        # Everything after this point is network time
+        self.metrics["request_ms"] = round((time.perf_counter() - self._start) * 1000, 2)
+        answer, _ = self._ask_routed(provider, images, prompt, route)
+        if answer is None:
+            return
+        # The answer is already on screen; storing it must not be able to fail the query
+        self._finish(answer)
+        if self.cache is not None:
+            model = route.model if route is not None else provider.model
+            # A hedge that won answered with its own model
+            model = self.metrics.get("hedge", {}).get("model", model)
+            self.cache.put(frame_hash, self.prompt, model, answer)
+
+    def _route(self, provider, images) -> Optional[Route]:
+        """Starting tier for this query, or None without a router"""
+        if self.router is None:
+            return None
+        route = self.router.route(provider.name, provider.model, self.prompt, images)
+        self.trace.set(model=route.model, route=route.reason)
+        logger.info("Routing to %s (%s)", route.model, route.reason)
+        return route
+
+    def _attempt(self, provider, images, prompt, model: Optional[str], history=None):
+        """One request to ``model``
+
+        Returns:
+            (answer, info); the answer is None if the query was cancelled. ``info``
+            has the stream's ``finish_reason`` and the ``model`` that answered,
+            which is the hedge's if it won.
+        """
+        info = {}
+        with self.trace.child("network", provider=provider.name, model=model or provider.model) as span:
+            if self.hedge is not None and history is None:
+                answer = self._stream_hedged(provider, images, prompt, model, info)
+                if answer is None:
+                    span.finish(status="cancelled")
+                    return None, info
+            else:
+                parts = []
+                for text in provider.stream(images, prompt, model=model, history=history, info=info,
+                                             is_cancelled=self.is_cancelled):
+                    if self.is_cancelled():
+                        # Leaving the loop closes the stream and its connection
+                        span.finish(status="cancelled")
+                        return None, info
+                    parts.append(text)
+                    self._emit_chunk(text)
+                answer = "".join(parts)
+                info["model"] = model or provider.model
+            span.set(ttft_ms=self.metrics.get("ttft_ms"), chars=len(answer), finish_reason=info.get("finish_reason"))
+        return answer, info
+
+    def _ask_routed(self, provider, images, prompt, route: Optional[Route], history=None):
+        """Ask the route's model, moving up a tier after an empty, truncated or failed answer
+
+        Returns:
+            (answer, images sent with it); the answer is None if the query was cancelled
+        """
+        if route is None:
+            answer, _ = self._attempt(provider, images, prompt, None, history)
+            return answer, images
+        while True:
+            model = route.model
+            started = time.perf_counter()
+            error = None
+            try:
+                answer, info = self._attempt(provider, images, prompt, model, history)
+            except Exception as e:
+                if self.is_cancelled():
+                    raise
+                answer, info, error = "", {}, e
+            if answer is None:
+                return None, images
+            reason = classify(answer, info.get("finish_reason"), error)
+            # Credited to the model that answered: a hedge that won, or the tier asked
+            self.router.record(info.get("model", model), reason, (time.perf_counter() - started) * 1000)
+            # Rejected requests and admission refusals would fare no better a tier up
+            if reason not in ESCALATE_REASONS or route.escalate(reason) is None:
+                self.metrics["routing"] = route.report()
+                self.trace.set(model=route.model, escalations=len(route.escalations))
+                if error is not None:
+                    raise error
+                return answer, images
+
+            get_tracer().count("model_escalations_total", reason=reason, model=model)
+            logger.info("Escalating from %s to %s: %s answer", model, route.model, reason)
+            if images and budget_for(route.model, self.image_budgets) != budget_for(model, self.image_budgets):
+                with self.trace.child("preprocess", model=route.model):
+                    images = self.encode_images(route.model)
+            if "ttft_ms" in self.metrics:
+                # Part of the bad answer was shown; the stronger model's replaces it
+                self.metrics["discarded_ttft_ms"] = self.metrics.pop("ttft_ms")
+                if not self.is_cancelled():
+                    self.restarted.emit(route.model)
+
+    def _ask_in_session(self, provider):
+        """Continue the session: attach the screen only if it changed since the last screenshot
+
+        Answers depend on the conversation, so the response cache and hedging are not used.
+        """
+        session = self.session
+        with self.trace.child("session") as span:
+            frame_hash = self.frame.perceptual_hash()
+            attach = session.needs_image(frame_hash)
+            # A new screenshot replaces the old one rather than joining it
+            history = session.history(keep_image=not attach)
+            span.set(turns=len(history), image=attach)
+        self.metrics["session"] = {"history_turns": len(history), "history_tokens": sum(turn.tokens for turn in history),
+                                   "image": attach}
+
+        images = []
+        if attach:
+            model = self.router.tiers_for(provider.name, provider.model)[0] if self.router is not None else provider.model
+            with self.trace.child("preprocess") as span:
+                images = self.encode_images(model)
+                payload_bytes = sum(len(encoded.data) for encoded in images)
+                span.set(images=len(images), payload_bytes=payload_bytes)
+            self.trace.set(payload_bytes=payload_bytes)
+            get_tracer().observe("payload_bytes", payload_bytes, buckets=BYTES_BUCKETS)
+        route = self._route(provider, images)
+        prompt = self.prompt if self.detail is None or not attach else f"{DETAIL_NOTE}\n\n{self.prompt}"
+        self.metrics["request_ms"] = round((time.perf_counter() - self._start) * 1000, 2)
+        answer, images = self._ask_routed(provider, images, prompt, route, history=history)
+        if answer is None:
+            return
+        if not self.is_cancelled():
+            session.add(Turn(prompt, images, answer), frame_hash)
+        self._finish(answer)
+
+    def _stream_hedged(self, provider, images, prompt, model: Optional[str] = None,
+                       info: Optional[dict] = None) -> Optional[str]:
+        """Race ``provider`` (asking ``model``) against the hedge provider; None if cancelled
+
+        Args:
+            info: Filled with the winning stream's ``finish_reason`` and ``model``
+        """
+        hedge = self.hedge
+        secondary = self.registry.get(hedge.provider, hedge.api_endpoint, hedge.api_key or self.api_key)
+        primary_label = f"{provider.name}:{model or provider.model}"
+        # Each stream reports into its own; the winner's is passed on
+        primary_info, secondary_info = {}, {}
+        winner, answer, report = hedge.run(
+            (primary_label, lambda stopped: provider.stream(images, prompt, model=model, info=primary_info,
+                                                            is_cancelled=stopped)),
+            (f"{secondary.name}:{hedge.model or secondary.model}",
+             lambda stopped: secondary.stream(images, prompt, model=hedge.model, info=secondary_info,
+                                              is_cancelled=stopped)),
+            self._emit_chunk,
+            self.is_cancelled,
+            self.scheduler,
+        )
+        if winner is None:
+            return None
+        # The model that answered, which the answer is cached under
+        report["model"] = (model or provider.model) if winner == primary_label else (hedge.model or secondary.model)
+        self.metrics["hedge"] = report
+        if info is not None:
+            info.update(primary_info if winner == primary_label else secondary_info)
+            info["model"] = report["model"]
+        return answer
 
     def run(self):
+        self._start = time.perf_counter()
         try:
-            # Read image data
-            try:
-                with open(self.image_path, "rb") as f:
-                    image_data = f.read()
-            except IOError as e:
-                self.error.emit(f"Failed to read screenshot: {str(e)}")
-                return
+            self._run()
+        finally:
+            if self.owns_trace:
+                self.trace.finish(status="cancelled" if self.is_cancelled() else "ok", error=self.error_message)
 
+    def _run(self):
+        try:
             if self.model_provider == 'gemini':
                 try:
                     # Use Gemini API
-                    response_text = self.gemini.analyze_image(image_data, self.prompt)
-                    response_data = {
-                        'choices': [{
-                            'message': {
-                                'content': response_text
-                            }
-                        }]
-                    }
-                    self.finished.emit(response_data)
+                    self._ask(self.registry.get('gemini', self.api_endpoint, self.api_key))
                 except Exception as e:
-                    self.error.emit(f"Gemini API error: {str(e)}")
+                    self._emit_error(f"Gemini API error: {str(e)}")
                     return
             else:
                 # Validate OpenAI endpoint
                 if not self.api_endpoint or not self.api_endpoint.startswith('http'):
-                    self.error.emit("Invalid OpenAI API endpoint")
+                    self._emit_error("Invalid OpenAI API endpoint")
                     return
 
-                # Use OpenAI API
+                # Use OpenAI API, or a local OpenAI-compatible server
                 try:
-                    # Detect image format
-                    import imghdr
-                    img_format = imghdr.what(None, image_data) or 'png'
-                    base64_image = base64.b64encode(image_data).decode("utf-8")
-                    
-                    payload = {
-                        "model": "gpt-4-vision-preview",
-                        "messages": [{
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": self.prompt},
-                                {"type": "image_url", "image_url": {"url": f"data:image/{img_format};base64,{base64_image}"}}
-                            ]
-                        }],
-                        "max_tokens": 300
-                    }
-
-                    headers = {
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    }
-
-                    # Make request with timeout
-                    response = requests.post(self.api_endpoint, headers=headers, json=payload, timeout=30)
-                    response.raise_for_status()
-                    self.finished.emit(response.json())
+                    self._ask(self.registry.get(self.model_provider, self.api_endpoint, self.api_key))
+                except AdmissionError as e:
+                    self._emit_error(str(e))
                 except requests.Timeout:
-                    self.error.emit("Request timed out. Please try again.")
+                    self._emit_error("Request timed out. Please try again.")
                 except requests.RequestException as e:
-                    self.error.emit(f"API request failed: {str(e)}")
+                    self._emit_error(f"API request failed: {str(e)}")
                 except Exception as e:
-                    self.error.emit(f"Unexpected error: {str(e)}")
+                    self._emit_error(f"Unexpected error: {str(e)}")
 
         except Exception as e:
-            self.error.emit(f"Unexpected error: {str(e)}")
+            self._emit_error(f"Unexpected error: {str(e)}")
@@ -0,0 +1,315 @@
+"""Screenshot archive.
+
+Keeps the frames that were sent with a query, stored under a hash of their
+pixels so an unchanged screen is saved once no matter how often it is asked
+about. ``add`` only queues the frame; hashing, encoding and file writes
+happen on a background writer thread, off the query path. Retention limits
+(total size, age and entry count) evict the least recently seen images
+first. With ``memory_only`` the encoded images are kept in process memory
+under the same limits and nothing touches the disk.
+
+Files are laid out as ``<directory>/<key[:2]>/<key>.<ext>``; the index is
+rebuilt from the directory on start, using file modification times as
+"last seen", so there is no separate index file to keep consistent.
+"""
+import atexit
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+from .frame import Frame
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp"}
+
+
+def default_directory() -> str:
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "glance", "screenshots")
+
+
+def content_key(frame: Frame) -> str:
+    """Hex digest of the frame's pixels, size and pixel layout"""
+    buffer = frame.buffer
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{buffer.width}x{buffer.height}:{buffer.raw_mode}:{buffer.stride}".encode("ascii"))
+    digest.update(buffer.data)
+    return digest.hexdigest()
+
+
+class _Entry:
+    __slots__ = ("size", "last_seen", "data")
+
+    def __init__(self, size: int, last_seen: float, data: Optional[bytes] = None):
+        self.size = size
+        self.last_seen = last_seen
+        # Encoded image, only kept in memory-only mode
+        self.data = data
+
+
+class ScreenshotArchive:
+    """Content-addressed, size and age bounded store of query screenshots"""
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = 256 * 1024 * 1024,
+                 max_age_days: Optional[float] = 7, max_entries: Optional[int] = None,
+                 memory_only: bool = False, fmt: str = "PNG", quality: Optional[int] = None,
+                 max_pending: int = 8):
+        """
+        Args:
+            directory: Where images are written, default ~/.local/share/glance/screenshots
+            max_bytes: Maximum total size of stored images
+            max_age_days: Images not seen for longer than this are deleted, None to keep them
+            max_entries: Maximum number of stored images, None for no limit
+            memory_only: Keep encoded images in memory and never write to disk
+            fmt: PIL format the images are stored in (PNG, JPEG, WEBP)
+            quality: Lossy quality setting, ignored for PNG
+            max_pending: Frames waiting for the writer before new ones are dropped
+        """
+        self.directory = None if memory_only else (directory or default_directory())
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.max_entries = max_entries
+        self.memory_only = memory_only
+        self.fmt = fmt.upper()
+        self.quality = None if self.fmt == "PNG" else quality
+        self.extension = EXTENSIONS.get(self.fmt, self.fmt.lower())
+        self.written = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.evicted = 0
+        self.errors = 0
+        # key -> entry, least recently seen first
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name="glance-archive", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, options: dict) -> Optional["ScreenshotArchive"]:
+        """Build the archive from the ``archive`` config section, or None if disabled"""
+        if not options.get("enabled", False):
+            return None
+        return cls(
+            directory=options.get("directory"),
+            max_bytes=int(options.get("max_mb", 256) * 1024 * 1024),
+            max_age_days=options.get("max_age_days", 7),
+            max_entries=options.get("max_entries"),
+            memory_only=options.get("memory_only", False),
+            fmt=options.get("format", "PNG"),
+            quality=options.get("quality"),
+        )
+
+    def add(self, frame: Frame, timestamp: Optional[float] = None) -> Future:
+        """Queue ``frame`` to be archived without blocking
+
+        Returns:
+            Future: Resolves to the image's content key once stored, or to None
+                if the frame was dropped because the writer is backed up
+        """
+        future = Future()
+        try:
+            self._queue.put_nowait((frame, timestamp or time.time(), future))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            future.set_result(None)
+        return future
+
+    def path(self, key: str) -> Optional[str]:
+        """File the image with ``key`` is stored in (None in memory-only mode)"""
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, key[:2], f"{key}.{self.extension}")
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Encoded image stored under ``key``, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.data is not None:
+                return entry.data
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def keys(self) -> List[str]:
+        """Stored keys, least recently seen first"""
+        with self._lock:
+            return list(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued frame has been written
+
+        Returns:
+            bool: False if ``timeout`` expired first
+        """
+        done = threading.Event()
+        try:
+            self._queue.put((None, None, done), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 5) -> None:
+        """Write what is queued and stop the writer thread"""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "written": self.written,
+                "duplicates": self.duplicates,
+                "dropped": self.dropped,
+                "evicted": self.evicted,
+                "errors": self.errors,
+                "pending": self._queue.qsize(),
+            }
+
+    def _run(self) -> None:
+        if self.directory is not None:
+            self._scan()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            frame, timestamp, future = item
+            if frame is None:
+                # flush() marker
+                future.set()
+                continue
+            try:
+                key = self._store(frame, timestamp)
+            except Exception as e:
+                logger.warning("Could not archive screenshot: %s", e)
+                with self._lock:
+                    self.errors += 1
+                future.set_result(None)
+                continue
+            future.set_result(key)
+
+    def _scan(self) -> None:
+        """Rebuild the index from the files already on disk"""
+        found: List[Tuple[float, str, int]] = []
+        suffix = f".{self.extension}"
+        try:
+            shards = os.listdir(self.directory)
+        except OSError:
+            shards = []
+        for shard in shards:
+            shard_dir = os.path.join(self.directory, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if not name.endswith(suffix):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(shard_dir, name))
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, name[:-len(suffix)], stat.st_size))
+        found.sort()
+        with self._lock:
+            for last_seen, key, size in found:
+                self._entries[key] = _Entry(size, last_seen)
+                self._bytes += size
+        self._evict(time.time())
+
+    def _store(self, frame: Frame, timestamp: float) -> str:
+        key = content_key(frame)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.last_seen = timestamp
+                self._entries.move_to_end(key)
+                self.duplicates += 1
+        if entry is not None:
+            if self.directory is not None:
+                # The file's mtime is its "last seen" time across restarts
+                try:
+                    os.utime(self.path(key), (timestamp, timestamp))
+                except OSError:
+                    pass
+            return key
+
+        data = self._encode(frame)
+        if self.directory is not None:
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.utime(temp_path, (timestamp, timestamp))
+            os.replace(temp_path, path)
+        with self._lock:
+            self._entries[key] = _Entry(len(data), timestamp, data if self.directory is None else None)
+            self._bytes += len(data)
+            self.written += 1
+        self._evict(time.time())
+        return key
+
+    def _encode(self, frame: Frame) -> bytes:
+        # Reuse bytes the frame already holds, e.g. one read from a PNG file
+        if frame.source_format == self.fmt and self.quality is None:
+            return frame.encoded(self.fmt)
+        # The decoded image is shared with the query; encode outside the frame lock
+        image = frame.image()
+        options = {} if self.quality is None else {"quality": self.quality}
+        out = BytesIO()
+        image.save(out, format=self.fmt, **options)
+        return out.getvalue()
+
+    def _evict(self, now: float) -> None:
+        """Drop the least recently seen images until every limit holds"""
+        removed: List[str] = []
+        with self._lock:
+            while self._entries:
+                key, entry = next(iter(self._entries.items()))
+                expired = self.max_age is not None and now - entry.last_seen > self.max_age
+                too_many = self.max_entries is not None and len(self._entries) > self.max_entries
+                if not (expired or too_many or self._bytes > self.max_bytes):
+                    break
+                del self._entries[key]
+                self._bytes -= entry.size
+                self.evicted += 1
+                removed.append(key)
+        if self.directory is None:
+            return
+        for key in removed:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def __repr__(self):
+        where = "memory" if self.directory is None else self.directory
+        return f"ScreenshotArchive({where!r}, {len(self)} images)"
@@ -0,0 +1,376 @@
+"""Headless batch mode.
+
+Asks the configured provider about many saved screenshots without the GUI:
+
+    glance-batch manifest.jsonl -o results.jsonl --concurrency 8
+    python -m glance.batch screenshots/ --prompt "Describe the error shown" -o results.jsonl
+
+The manifest is a JSONL file with ``image`` and optional ``prompt`` and
+``id`` fields, a CSV file with the same columns, or a directory of images
+that all get ``--prompt``. Images are decoded and encoded to the model's
+byte budget in a process pool, a bounded window ahead of the requests, so
+memory stays flat however long the manifest is. Requests run on a
+``RequestScheduler`` with ``--concurrency`` slots, through the provider's
+admission controller, so configured rate limits and retries apply.
+
+Every result is appended to the output file as soon as it arrives, and that
+file is the checkpoint: running the same command again skips the items that
+already succeeded and retries the rest.
+"""
+import argparse
+import concurrent.futures
+import csv
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Set
+
+from .encoder import EncodeBudget, EncodedImage, budget_for, encode_for_budget
+from .frame import Frame
+from .providers import ProviderRegistry
+from .scheduler import RequestScheduler
+from .settings import load_settings
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp")
+
+
+class BatchItem:
+    """One image and the question to ask about it"""
+
+    def __init__(self, image: str, prompt: str, item_id: Optional[str] = None, path: Optional[str] = None):
+        self.image = image
+        self.prompt = prompt
+        # Stable across runs, so a rerun can tell what is already done
+        self.id = item_id or hashlib.sha1(f"{image}\0{prompt}".encode("utf-8")).hexdigest()[:16]
+        # ``image`` resolved against the manifest's directory
+        self.path = path or image
+
+
+def read_manifest(source: str, default_prompt: Optional[str] = None) -> Iterator[BatchItem]:
+    """Yield the items of a JSONL or CSV manifest, or of a directory of images
+
+    Raises:
+        ValueError: If an entry has no image or no prompt
+    """
+    if os.path.isdir(source):
+        if not default_prompt:
+            raise ValueError("--prompt is required when the manifest is a directory")
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield BatchItem(name, default_prompt, path=os.path.join(source, name))
+        return
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline="") as f:
+        if source.lower().endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for number, row in enumerate(rows, 1):
+            image = row.get("image")
+            prompt = row.get("prompt") or default_prompt
+            if not image or not prompt:
+                raise ValueError(f"{source}:{number}: every entry needs an image and a prompt")
+            yield BatchItem(image, prompt, row.get("id") or None, os.path.join(base, os.path.expanduser(image)))
+
+
+def completed_ids(output: str) -> Set[str]:
+    """Ids that already have a successful result in ``output``"""
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interrupted run
+                continue
+            if record.get("status") == "ok":
+                done.add(record.get("id"))
+    return done
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def preprocess(path: str, budget: EncodeBudget) -> EncodedImage:
+    """Read an image file and encode it to ``budget``; runs in a worker process"""
+    with open(path, "rb") as f:
+        data = f.read()
+    return encode_for_budget(Frame.from_bytes(data), budget)
+
+
+class Throughput:
+    """Completed images per second, overall and over a recent window"""
+
+    def __init__(self, window: float = 30):
+        self.window = window
+        self.start = time.perf_counter()
+        self.recent: Deque[float] = deque()
+        self.count = 0
+
+    def add(self) -> None:
+        now = time.perf_counter()
+        self.count += 1
+        self.recent.append(now)
+        while self.recent and now - self.recent[0] > self.window:
+            self.recent.popleft()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def overall(self) -> float:
+        return self.count / self.elapsed if self.elapsed > 0 else 0.0
+
+    def current(self) -> float:
+        span = min(self.window, self.elapsed)
+        return len(self.recent) / span if span > 0 else 0.0
+
+
+class BatchRunner:
+    """Preprocesses, asks and records a stream of ``BatchItem``s"""
+
+    def __init__(self, provider, output: str, concurrency: int = 4, workers: Optional[int] = None,
+                 model: Optional[str] = None, image_budgets: Optional[dict] = None, timeout: float = 120,
+                 progress_interval: float = 5, out=sys.stderr):
+        """
+        Args:
+            provider: Client from ``ProviderRegistry.get``
+            output: JSONL file results are appended to
+            concurrency: Requests in flight at once
+            workers: Preprocessing processes, default one per CPU; 0 to preprocess in threads
+            model: Model to ask instead of the provider's default
+            image_budgets: ``{model: {field: value}}`` encode budget overrides
+            timeout: Per-request deadline in seconds, including time queued for a slot
+            progress_interval: Seconds between progress lines
+            out: Where progress is reported
+        """
+        self.provider = provider
+        self.output = output
+        self.concurrency = concurrency
+        self.workers = (os.cpu_count() or 2) if workers is None else workers
+        self.model = model
+        self.budget = budget_for(model or provider.model, image_budgets)
+        self.timeout = timeout
+        self.progress_interval = progress_interval
+        self.out = out
+        self.throughput = Throughput()
+        self.total = 0
+        self.skipped = 0
+        self.ok = 0
+        self.errors = 0
+        self.latencies: List[float] = []
+
+    def _pool(self) -> concurrent.futures.Executor:
+        if self.workers == 0:
+            return concurrent.futures.ThreadPoolExecutor(max_workers=max(2, self.concurrency))
+        # Spawned rather than forked: the request threads are already running
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                      mp_context=multiprocessing.get_context("spawn"))
+
+    def _ask(self, item: BatchItem, encoded: EncodedImage, stop: threading.Event) -> dict:
+        """One request; runs on a scheduler thread"""
+        start = time.perf_counter()
+        parts = []
+        ttft = None
+        # The deadline also cuts rate-limit waits, backoff and a stalled stream short
+        for text in self.provider.stream([encoded], item.prompt, model=self.model, is_cancelled=stop.is_set):
+            if stop.is_set():
+                break
+            if ttft is None:
+                ttft = (time.perf_counter() - start) * 1000
+            parts.append(text)
+        return {"answer": "".join(parts), "ttft_ms": round(ttft or 0.0, 1),
+                "request_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+    def run(self, items: Iterator[BatchItem], done: Set[str]) -> dict:
+        """Process every item not in ``done``, appending results as they complete"""
+        scheduler = RequestScheduler(max_concurrency=self.concurrency, max_workers=self.concurrency)
+        pool = self._pool()
+        # Preprocessed images waiting for a request slot are bounded by this window
+        window = self.concurrency * 2 + max(self.workers, 1)
+        preparing: Dict[concurrent.futures.Future, BatchItem] = {}
+        asking: Dict[concurrent.futures.Future, tuple] = {}
+        source = iter(items)
+        exhausted = False
+        next_report = time.perf_counter() + self.progress_interval
+
+        with open(self.output, "a", buffering=1) as results:
+            if results.tell() > 0 and not _ends_with_newline(self.output):
+                # Close the line an interrupted run left half-written
+                results.write("\n")
+            try:
+                while True:
+                    while not exhausted and len(preparing) + len(asking) < window:
+                        item = next(source, None)
+                        if item is None:
+                            exhausted = True
+                            break
+                        self.total += 1
+                        if item.id in done:
+                            self.skipped += 1
+                            continue
+                        preparing[pool.submit(preprocess, item.path, self.budget)] = item
+                    if not preparing and not asking:
+                        break
+
+                    finished, _ = concurrent.futures.wait(
+                        list(preparing) + list(asking), timeout=self.progress_interval,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        if future in preparing:
+                            item = preparing.pop(future)
+                            try:
+                                encoded = future.result()
+                            except Exception as e:
+                                self._record(results, item, error=f"preprocess failed: {e}")
+                                continue
+                            stop = threading.Event()
+                            job = scheduler.submit(lambda item=item, encoded=encoded, stop=stop: self._ask(item, encoded, stop),
+                                                   timeout=self.timeout, on_timeout=stop.set)
+                            asking[job] = (item, encoded, stop)
+                        else:
+                            item, encoded, stop = asking.pop(future)
+                            try:
+                                result = future.result()
+                            except Exception as e:
+                                self._record(results, item, encoded, error=str(e) or type(e).__name__)
+                                continue
+                            if result is None or stop.is_set():
+                                self._record(results, item, encoded, error=f"timed out after {self.timeout:g}s")
+                            else:
+                                self._record(results, item, encoded, result=result)
+
+                    if time.perf_counter() >= next_report:
+                        self.report()
+                        next_report = time.perf_counter() + self.progress_interval
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
+                scheduler.shutdown()
+        return self.summary()
+
+    def _record(self, results, item: BatchItem, encoded: Optional[EncodedImage] = None,
+                result: Optional[dict] = None, error: Optional[str] = None) -> None:
+        record = {"id": item.id, "image": item.image, "prompt": item.prompt,
+                  "status": "error" if error else "ok", "model": self.model or self.provider.model}
+        if result is not None:
+            record.update(result)
+            self.latencies.append(result["request_ms"])
+        if error:
+            record["error"] = error
+        if encoded is not None:
+            record["encode"] = encoded.report()
+        record["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        results.write(json.dumps(record) + "\n")
+        if error:
+            self.errors += 1
+            logger.warning("%s: %s", item.image, error)
+        else:
+            self.ok += 1
+        self.throughput.add()
+
+    def report(self) -> None:
+        """Print done/seen counts and throughput; ``total`` grows as the manifest is read"""
+        done = self.ok + self.errors + self.skipped
+        print(f"[{done}/{self.total}] {self.throughput.overall():.2f} img/s "
+              f"(last {self.throughput.window:g}s: {self.throughput.current():.2f}), {self.errors} errors",
+              file=self.out, flush=True)
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            return round(latencies[int((len(latencies) - 1) * fraction)], 1) if latencies else None
+
+        return {
+            "items": self.total,
+            "skipped": self.skipped,
+            "ok": self.ok,
+            "errors": self.errors,
+            "elapsed_s": round(self.throughput.elapsed, 2),
+            "images_per_s": round(self.throughput.overall(), 3),
+            "request_ms_p50": percentile(0.5),
+            "request_ms_p95": percentile(0.95),
+            "provider": self.provider.stats(),
+        }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="glance-batch", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", help="JSONL or CSV manifest, or a directory of images")
+    parser.add_argument("-o", "--output", required=True, help="JSONL results file, also the resume checkpoint")
+    parser.add_argument("--prompt", help="Prompt for entries without one")
+    parser.add_argument("--provider", choices=("openai", "gemini", "local"), help="Default: from config.json")
+    parser.add_argument("--endpoint", help="Chat completions URL for openai/local")
+    parser.add_argument("--api-key", help="Default: config.json, then GLANCE_API_KEY")
+    parser.add_argument("--model", help="Model to ask instead of the provider default")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once")
+    parser.add_argument("--workers", type=int, default=None, help="Preprocessing processes (0: threads)")
+    parser.add_argument("--rpm", type=float, help="Requests per minute limit")
+    parser.add_argument("--tpm", type=float, help="Tokens per minute limit")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request deadline in seconds")
+    parser.add_argument("--progress-interval", type=float, default=5)
+    parser.add_argument("--overwrite", action="store_true", help="Start over instead of resuming")
+    parser.add_argument("--config", default=None, help="Settings file, default config.json")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+
+    if args.config is None:
+        config = load_settings()
+    else:
+        with open(args.config) as f:
+            config = json.load(f)
+    provider_name = args.provider or config.get("model_provider", "openai")
+    api_key = args.api_key or config.get("api_key") or os.environ.get("GLANCE_API_KEY", "")
+    endpoint = args.endpoint or config.get("api_endpoint", "")
+    rate_limits = dict(config.get("rate_limits", {}))
+    limits = dict(rate_limits.get(provider_name, {}))
+    if args.rpm is not None:
+        limits["rpm"] = args.rpm
+    if args.tpm is not None:
+        limits["tpm"] = args.tpm
+    rate_limits[provider_name] = limits
+
+    if args.overwrite and os.path.exists(args.output):
+        os.remove(args.output)
+    done = completed_ids(args.output)
+    if done:
+        print(f"Resuming: {len(done)} items already done in {args.output}", file=sys.stderr)
+
+    registry = ProviderRegistry(rate_limits=rate_limits, provider_options=config.get("providers", {}),
+                                pool_size=max(4, args.concurrency))
+    try:
+        provider = registry.get(provider_name, endpoint, api_key)
+        runner = BatchRunner(provider, args.output, concurrency=args.concurrency, workers=args.workers,
+                             model=args.model, image_budgets=config.get("image_budgets"), timeout=args.timeout,
+                             progress_interval=args.progress_interval)
+        summary = runner.run(read_manifest(args.manifest, args.prompt), done)
+    except (OSError, ValueError) as e:
+        print(f"glance-batch: {e}", file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        print("Interrupted; rerun the same command to resume", file=sys.stderr)
+        return 130
+    finally:
+        registry.close()
+    runner.report()
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""Response cache for repeated questions about an unchanged screen.
+
+Answers are keyed on a perceptual hash of the captured frame plus the
+normalized prompt and the model. A lookup matches any stored frame hash
+within a configurable Hamming distance, so re-capturing the same screen
+(with a blinking cursor, say) still hits. Entries are evicted LRU-first once
+either the entry count or the total answer size exceeds its bound, and the
+cache can be persisted to a JSON file between runs. Writes happen on a
+timer thread a moment after the last change, never on the query thread.
+"""
+import atexit
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CacheKey = Tuple[str, str]
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return re.sub(r"\s+", " ", prompt).strip().lower().rstrip("?!. ")
+
+
+class CacheEntry:
+    def __init__(self, frame_hash: int, prompt: str, model: str, answer: str):
+        self.frame_hash = frame_hash
+        self.prompt = prompt
+        self.model = model
+        self.answer = answer
+
+    @property
+    def size(self) -> int:
+        return len(self.answer.encode("utf-8")) + len(self.prompt.encode("utf-8"))
+
+    def to_dict(self) -> dict:
+        return {
+            "frame_hash": format(self.frame_hash, "x"),
+            "prompt": self.prompt,
+            "model": self.model,
+            "answer": self.answer,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CacheEntry":
+        return cls(int(data["frame_hash"], 16), data["prompt"], data["model"], data["answer"])
+
+
+class ResponseCache:
+    """LRU cache of answers keyed by perceptual frame hash, prompt and model"""
+
+    def __init__(self, max_entries: int = 128, max_bytes: int = 1024 * 1024,
+                 tolerance: int = 0, path: Optional[str] = None, save_delay: float = 2.0):
+        """
+        Args:
+            max_entries: Maximum number of cached answers
+            max_bytes: Maximum total size of cached answers, in UTF-8 bytes
+            tolerance: Maximum Hamming distance between frame hashes for a hit
+            path: JSON file to persist the cache to, or None to keep it in memory
+            save_delay: Seconds after a change before the file is rewritten;
+                changes in between are written together
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self.path = path
+        self.save_delay = save_delay
+        self.hits = 0
+        self.misses = 0
+        self.save_errors = 0
+        self._entries: "OrderedDict[int, CacheEntry]" = OrderedDict()
+        self._index: Dict[CacheKey, List[int]] = {}
+        self._next_id = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Serializes writers; each still uses a temporary file of its own
+        self._save_lock = threading.Lock()
+        self._save_timer: Optional[threading.Timer] = None
+        if path:
+            self.load()
+            atexit.register(self.flush)
+
+    @classmethod
+    def from_config(cls, options: dict) -> Optional["ResponseCache"]:
+        """Build the cache from the ``response_cache`` config section, or None if disabled"""
+        if not options.get("enabled", True):
+            return None
+        return cls(
+            max_entries=options.get("max_entries", 128),
+            max_bytes=options.get("max_bytes", 1024 * 1024),
+            tolerance=options.get("tolerance", 0),
+            path=options.get("path"),
+            save_delay=options.get("save_delay", 2.0),
+        )
+
+    def get(self, frame_hash: int, prompt: str, model: str) -> Optional[str]:
+        """Return a cached answer for a similar frame, or None"""
+        key = (normalize_prompt(prompt), model)
+        with self._lock:
+            best_id, best_distance = None, self.tolerance + 1
+            for entry_id in self._index.get(key, ()):
+                distance = bin(self._entries[entry_id].frame_hash ^ frame_hash).count("1")
+                if distance < best_distance:
+                    best_id, best_distance = entry_id, distance
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id].answer
+
+    def put(self, frame_hash: int, prompt: str, model: str, answer: str) -> None:
+        """Store an answer, evicting the least recently used entries if needed"""
+        if not answer:
+            return
+        entry = CacheEntry(frame_hash, normalize_prompt(prompt), model, answer)
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            self._add(entry)
+            self._evict()
+            if self.path and self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay, self._save_scheduled)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def _save_scheduled(self) -> None:
+        with self._lock:
+            self._save_timer = None
+        self.save()
+
+    def flush(self) -> None:
+        """Write a pending change now instead of waiting for the timer"""
+        with self._lock:
+            timer, self._save_timer = self._save_timer, None
+        if timer is not None:
+            timer.cancel()
+            self.save()
+
+    def _add(self, entry: CacheEntry) -> None:
+        key = (entry.prompt, entry.model)
+        # Replace an existing entry for the same exact frame
+        for entry_id in self._index.get(key, ()):
+            if self._entries[entry_id].frame_hash == entry.frame_hash:
+                self._remove(entry_id)
+                break
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = entry
+        self._index.setdefault(key, []).append(entry_id)
+        self._bytes += entry.size
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        key = (entry.prompt, entry.model)
+        self._index[key].remove(entry_id)
+        if not self._index[key]:
+            del self._index[key]
+        self._bytes -= entry.size
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "save_errors": self.save_errors,
+            }
+
+    def save(self) -> bool:
+        """Write the cache to ``path``, oldest entries first
+
+        Returns:
+            False if the file could not be written; the error is logged and
+            the cache keeps working in memory
+        """
+        with self._save_lock:
+            with self._lock:
+                entries = [entry.to_dict() for entry in self._entries.values()]
+            tmp_path = None
+            try:
+                fd, tmp_path = tempfile.mkstemp(prefix=".glance-cache-", suffix=".tmp",
+                                                dir=os.path.dirname(os.path.abspath(self.path)))
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)
+                return True
+            except OSError as e:
+                self.save_errors += 1
+                logger.warning("Could not save the response cache to %s: %s", self.path, e)
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                return False
+
+    def load(self) -> None:
+        """Read entries saved by ``save``, keeping the LRU order"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                entries = [CacheEntry.from_dict(data) for data in json.load(f)]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable response cache %s: %s", self.path, e)
+            return
+        with self._lock:
+            for entry in entries:
+                self._add(entry)
+            self._evict()
@@ -0,0 +1,125 @@
+"""Background capture ring buffer.
+
+While the floating widget is unfocused, the screen is sampled at a low rate
+into a small ring buffer. When the user submits a question, the newest frame
+taken before they focused Glance is already in memory, so the query does not
+have to hide the window, wait for the compositor and capture again.
+
+Sampling takes a full-screen capture on the GUI thread every interval, so
+it is opt-in (``"capture": {"mode": "ring"}``); by default a query captures
+when it is submitted and blanks out Glance's own window instead.
+"""
+import logging
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+from PyQt5.QtCore import QObject, QTimer
+
+from .frame import Frame
+from .screenshot import CaptureError, get_engine
+
+logger = logging.getLogger(__name__)
+
+
+class FrameRingBuffer:
+    """Most recent frames, bounded by count and total pixel bytes"""
+
+    def __init__(self, max_frames: int = 3, max_bytes: int = 128 * 1024 * 1024):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self._frames: Deque[Tuple[float, Frame]] = deque()
+        self.nbytes = 0
+
+    def push(self, frame: Frame, timestamp: Optional[float] = None) -> None:
+        size = len(frame.buffer.data)
+        if size > self.max_bytes or self.max_frames <= 0:
+            return
+        self._frames.append((timestamp if timestamp is not None else time.monotonic(), frame))
+        self.nbytes += size
+        while len(self._frames) > self.max_frames or self.nbytes > self.max_bytes:
+            _, dropped = self._frames.popleft()
+            self.nbytes -= len(dropped.buffer.data)
+
+    def latest(self, not_before: Optional[float] = None, not_after: Optional[float] = None) -> Optional[Frame]:
+        """Newest frame captured within ``[not_before, not_after]`` (monotonic seconds)"""
+        for timestamp, frame in reversed(self._frames):
+            if not_after is not None and timestamp > not_after:
+                continue
+            if not_before is not None and timestamp < not_before:
+                return None
+            return frame
+        return None
+
+    def clear(self) -> None:
+        self._frames.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+
+class BackgroundCapture(QObject):
+    """Samples the screen into a ``FrameRingBuffer`` while the widget is unfocused
+
+    Captures run on the GUI thread because the Qt backend requires it; the
+    interval keeps the cost to a few milliseconds per second or less.
+    """
+
+    def __init__(self, interval_ms: int = 1500, max_frames: int = 3,
+                 max_bytes: int = 128 * 1024 * 1024, max_age_ms: int = 5000, parent=None):
+        """
+        Args:
+            interval_ms: Time between background captures
+            max_frames: Frames kept in the ring buffer
+            max_bytes: Upper bound on the pixel memory held by the ring buffer
+            max_age_ms: How old a frame may be, relative to the moment the
+                widget gained focus, to still answer a query
+        """
+        super().__init__(parent)
+        self.buffer = FrameRingBuffer(max_frames, max_bytes)
+        self.max_age = max_age_ms / 1000
+        self.active = False
+        self.focused_at: Optional[float] = None
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.sample)
+
+    @classmethod
+    def from_config(cls, options: dict, parent=None) -> "BackgroundCapture":
+        return cls(
+            interval_ms=options.get("interval_ms", 1500),
+            max_frames=options.get("max_frames", 3),
+            max_bytes=options.get("max_bytes", 128 * 1024 * 1024),
+            max_age_ms=options.get("max_age_ms", 5000),
+            parent=parent,
+        )
+
+    def start(self) -> None:
+        self.timer.start()
+        self.sample()
+
+    def stop(self) -> None:
+        self.timer.stop()
+        self.buffer.clear()
+
+    def set_active(self, active: bool) -> None:
+        """Track widget focus; sampling pauses while the user is in Glance"""
+        if active and not self.active:
+            self.focused_at = time.monotonic()
+        elif not active:
+            self.focused_at = None
+        self.active = active
+
+    def sample(self) -> None:
+        if self.active:
+            return
+        try:
+            self.buffer.push(Frame(get_engine().capture()))
+        except CaptureError as e:
+            logger.debug("Background capture failed: %s", e)
+
+    def frame_for_query(self) -> Optional[Frame]:
+        """Newest frame showing the screen as it was before the widget was focused"""
+        reference = self.focused_at if self.active and self.focused_at is not None else time.monotonic()
+        return self.buffer.latest(not_before=reference - self.max_age, not_after=reference)
@@ -0,0 +1,242 @@
+"""Client for a running Glance.
+
+Talks to the control socket of a Glance instance that is already running
+(see ``glance.ipc``), so asking from a terminal or a keybinding starts no Qt,
+loads no provider and reuses the warm capture backend, connections and caches:
+
+    python -m glance.client "What does this error mean?"
+    python -m glance.client --scope window "Summarize this page"
+    python -m glance.client --status
+    python -m glance.client --bench 20 --no-cache "What is on the screen?"
+
+Only the standard library is imported here, to keep the client's own start-up
+cost negligible.
+
+The protocol is one JSON object per line in each direction. A request has an
+``op`` of ``ask``, ``status``, ``show`` or ``ping``; an ask is answered with
+``accepted``, then any number of ``chunk`` events and finally ``done`` or
+``error``. A ``restart`` event means the text so far was a bad answer that is
+being replaced by a stronger model's. An ask that arrives while another is
+being answered gets a ``queued`` event with its ``position`` first, and is
+answered when the ones before it are done.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from typing import Iterator, List, Optional
+
+# Events that end the reply to a request
+FINAL_EVENTS = ("done", "error", "status", "pong", "shown")
+
+
+def default_socket_path() -> str:
+    """``$XDG_RUNTIME_DIR/glance.sock``, or one in a per-user directory under the temp directory
+
+    The server creates that directory with mode 0700, so no other user can
+    place a socket in it.
+    """
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "glance.sock")
+    return os.path.join(tempfile.gettempdir(), f"glance-{os.getuid()}", "glance.sock")
+
+
+class GlanceClient:
+    """Sends requests to a running Glance over its Unix socket"""
+
+    def __init__(self, path: Optional[str] = None, timeout: float = 120):
+        """
+        Args:
+            path: Socket path, default ``default_socket_path()``
+            timeout: Seconds to wait for each event before giving up
+        """
+        self.path = path or default_socket_path()
+        self.timeout = timeout
+
+    def request(self, message: dict) -> Iterator[dict]:
+        """Send ``message`` and yield the events of the reply, up to the final one
+
+        Raises:
+            ConnectionError: If no Glance is listening on the socket
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            try:
+                owner = os.stat(self.path).st_uid
+                sock.connect(self.path)
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                raise ConnectionError(f"Glance is not running (no socket at {self.path})") from e
+            if owner != os.getuid():
+                # Whoever listens there would see the questions, and answer them
+                raise ConnectionError(f"{self.path} belongs to another user")
+            sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+            reader = sock.makefile("rb")
+            for line in reader:
+                event = json.loads(line)
+                yield event
+                if event.get("event") in FINAL_EVENTS:
+                    return
+            raise ConnectionError("Glance closed the connection before answering")
+        finally:
+            sock.close()
+
+    def ask(self, prompt: str, scope: Optional[str] = None, region: Optional[List[int]] = None,
+            show: bool = False, cache: bool = True) -> Iterator[dict]:
+        """Ask about the screen; yields ``accepted``, ``chunk`` and a final ``done`` or ``error``
+
+        Args:
+            scope: 'desktop', 'monitor' or 'window' instead of the widget's current scope
+            region: ``[x, y, width, height]`` in screen pixels to capture instead
+            show: Also bring the Glance window to the front
+            cache: Whether an answer from the response cache may be used
+        """
+        message = {"op": "ask", "prompt": prompt, "show": show, "cache": cache}
+        if scope:
+            message["scope"] = scope
+        if region:
+            message["region"] = list(region)
+        return self.request(message)
+
+    def status(self) -> dict:
+        return self._single({"op": "status"})
+
+    def show(self) -> dict:
+        return self._single({"op": "show"})
+
+    def ping(self) -> dict:
+        return self._single({"op": "ping"})
+
+    def _single(self, message: dict) -> dict:
+        event = {}
+        for event in self.request(message):
+            pass
+        return event
+
+
+def timed_ask(client: GlanceClient, prompt: str, **options) -> dict:
+    """Ask once, recording when each stage of the reply reached the client"""
+    start = time.perf_counter()
+    timings = {}
+    answer = []
+    final = {}
+    for event in client.ask(prompt, **options):
+        elapsed = round((time.perf_counter() - start) * 1000, 2)
+        kind = event.get("event")
+        if kind == "accepted":
+            timings["accepted_ms"] = elapsed
+        elif kind == "chunk":
+            timings.setdefault("first_token_ms", elapsed)
+            answer.append(event.get("text", ""))
+        elif kind == "restart":
+            timings["restarts"] = timings.get("restarts", 0) + 1
+            answer.clear()
+        else:
+            timings["total_ms"] = elapsed
+            final = event
+    timings["status"] = final.get("event")
+    timings["answer"] = final.get("answer", "".join(answer))
+    timings["server"] = final.get("metrics", {})
+    if final.get("event") == "error":
+        timings["error"] = final.get("message")
+    return timings
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[int((len(values) - 1) * fraction)], 2)
+
+
+def bench(client: GlanceClient, prompt: str, runs: int, **options) -> dict:
+    """Submit-to-first-token latency over ``runs`` sequential questions
+
+    ``first_token_ms`` is measured by the client from just before it connects
+    to the socket, so it includes the hand-off to the GUI thread, capture and
+    encoding as well as the provider's own time to first token, which the
+    server reports separately as ``server_ttft_ms``.
+    """
+    results = [timed_ask(client, prompt, **options) for _ in range(runs)]
+    ok = [result for result in results if result["status"] == "done"]
+
+    def summary(values):
+        return {"p50": percentile(values, 0.5), "p95": percentile(values, 0.95),
+                "min": percentile(values, 0), "n": len(values)}
+
+    return {
+        "runs": runs,
+        "errors": len(results) - len(ok),
+        "accepted_ms": summary([r["accepted_ms"] for r in results if "accepted_ms" in r]),
+        "first_token_ms": summary([r["first_token_ms"] for r in ok if "first_token_ms" in r]),
+        "server_ttft_ms": summary([r["server"]["ttft_ms"] for r in ok if "ttft_ms" in r["server"]]),
+        "total_ms": summary([r["total_ms"] for r in ok]),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="glance-ask", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("prompt", nargs="?", help="Question about the screen")
+    parser.add_argument("--socket", help="Control socket path")
+    parser.add_argument("--scope", choices=("desktop", "monitor", "window"))
+    parser.add_argument("--region", type=int, nargs=4, metavar=("X", "Y", "W", "H"))
+    parser.add_argument("--show", action="store_true", help="Bring the Glance window to the front")
+    parser.add_argument("--no-cache", action="store_true", help="Do not answer from the response cache")
+    parser.add_argument("--status", action="store_true", help="Print the running instance's status")
+    parser.add_argument("--bench", type=int, metavar="RUNS", help="Measure submit-to-first-token latency")
+    parser.add_argument("--json", action="store_true", help="Print the final event as JSON")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args(argv)
+
+    client = GlanceClient(args.socket, timeout=args.timeout)
+    options = {"scope": args.scope, "region": args.region, "show": args.show, "cache": not args.no_cache}
+    try:
+        if args.status:
+            print(json.dumps(client.status(), indent=2))
+            return 0
+        if not args.prompt:
+            if args.show:
+                client.show()
+                return 0
+            parser.error("a prompt is required")
+        if args.bench:
+            print(json.dumps(bench(client, args.prompt, args.bench, **options), indent=2))
+            return 0
+
+        final = {}
+        streamed = False
+        for event in client.ask(args.prompt, **options):
+            if event.get("event") == "chunk" and not args.json:
+                streamed = True
+                sys.stdout.write(event.get("text", ""))
+                sys.stdout.flush()
+            elif event.get("event") == "restart" and not args.json:
+                if streamed:
+                    sys.stdout.write("\n")
+                print(f"glance: answer incomplete, asking {event.get('model')}", file=sys.stderr)
+            elif event.get("event") in FINAL_EVENTS:
+                final = event
+    except (ConnectionError, OSError) as e:
+        print(f"glance: {e}", file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        return 130
+
+    if args.json:
+        print(json.dumps(final, indent=2))
+    elif final.get("event") == "done":
+        # Answers that did not stream (e.g. cached ones) arrive whole
+        print("" if streamed else final.get("answer", ""))
+    if final.get("event") == "error":
+        print(f"glance: {final.get('message')}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""Budgeted image encoding.
+
+Screenshots are encoded to fit a per-model target for payload size and
+resolution. The encoder walks a short ladder of formats (lossless PNG first,
+since it keeps text crisp, then WebP/JPEG at falling quality) and downscales
+when nothing fits, stopping after a bounded number of encode attempts. The
+chosen settings are returned with the data so they can be logged per request.
+"""
+import base64
+import logging
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .frame import Frame
+
+logger = logging.getLogger(__name__)
+
+
+class EncodeBudget(NamedTuple):
+    """Payload target for one model
+
+    Attributes:
+        max_bytes: Largest encoded payload we want to upload
+        max_dimension: Largest width or height to send, None for no limit
+        formats: Formats to try, in order of preference
+        qualities: Lossy qualities to try, highest first
+        min_dimension: Never downscale the longest side below this
+        max_steps: Maximum number of encode attempts
+    """
+    max_bytes: int
+    max_dimension: Optional[int] = None
+    formats: Tuple[str, ...] = ("PNG", "WEBP", "JPEG")
+    qualities: Tuple[int, ...] = (85, 70, 55)
+    min_dimension: int = 512
+    max_steps: int = 8
+
+
+# Vision models tile or rescale images internally, so resolution beyond these
+# sizes only costs upload time. Byte targets keep uploads well under the
+# providers' hard limits (4MB inline data for Gemini).
+BUDGETS: Dict[str, EncodeBudget] = {
+    "gemini-2.0-flash-exp": EncodeBudget(max_bytes=400 * 1024, max_dimension=1024),
+    "gemini-1.5-flash": EncodeBudget(max_bytes=400 * 1024, max_dimension=1024),
+    "gemini-1.5-pro": EncodeBudget(max_bytes=800 * 1024, max_dimension=1536),
+    "gemini-1.0-pro-vision": EncodeBudget(max_bytes=800 * 1024, max_dimension=1536),
+    "gpt-4-vision-preview": EncodeBudget(max_bytes=500 * 1024, max_dimension=2048),
+}
+
+DEFAULT_BUDGET = EncodeBudget(max_bytes=500 * 1024, max_dimension=1536)
+
+
+def budget_for(model: str, overrides: Optional[dict] = None) -> EncodeBudget:
+    """Return the encode budget for a model
+
+    Args:
+        model: Model name as sent to the provider
+        overrides: Optional ``{model: {field: value}}`` mapping, e.g. from config.json
+    """
+    budget = BUDGETS.get(model, DEFAULT_BUDGET)
+    if overrides and model in overrides:
+        fields = {key: value for key, value in overrides[model].items() if key in EncodeBudget._fields}
+        budget = budget._replace(**fields)
+    return budget
+
+
+class EncodedImage:
+    """Encoded payload plus the settings that produced it"""
+
+    def __init__(self, data: bytes, fmt: str, quality: Optional[int], size: Tuple[int, int],
+                 steps: int, elapsed_ms: float, within_budget: bool):
+        self.data = data
+        self.format = fmt
+        self.quality = quality
+        self.size = size
+        self.steps = steps
+        self.elapsed_ms = elapsed_ms
+        self.within_budget = within_budget
+        self._base64 = None
+
+    def base64(self) -> str:
+        """Base64 text of the payload, computed once"""
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode("utf-8")
+        return self._base64
+
+    @property
+    def mime_type(self) -> str:
+        return Frame.mime_type(self.format)
+
+    def report(self) -> dict:
+        """Settings and cost of this encode, for logging and tuning"""
+        return {
+            "format": self.format,
+            "quality": self.quality,
+            "width": self.size[0],
+            "height": self.size[1],
+            "bytes": len(self.data),
+            "steps": self.steps,
+            "elapsed_ms": round(self.elapsed_ms, 2),
+            "within_budget": self.within_budget,
+        }
+
+
+def supported_formats(formats: Tuple[str, ...]) -> Tuple[str, ...]:
+    """``formats`` without those this Pillow build cannot write, falling back to JPEG"""
+    from PIL import features
+
+    # WebP support is optional in Pillow builds
+    supported = tuple(fmt for fmt in formats if fmt != "WEBP" or features.check("webp"))
+    return supported or ("JPEG",)
+
+
+def usable_budget(budget: EncodeBudget) -> EncodeBudget:
+    """The budget with the ladder guaranteed at least one attempt
+
+    Overrides from config.json can set ``max_steps`` to 0 or empty the
+    qualities; the ladder then still encodes once rather than having no result.
+    """
+    return budget._replace(max_steps=max(1, budget.max_steps),
+                           qualities=budget.qualities or EncodeBudget._field_defaults["qualities"])
+
+
+# (format, quality) of one encode attempt; quality is None for PNG
+Candidate = Tuple[str, Optional[int]]
+# Encodes the frame scaled to a longest side of ``dimension`` once per candidate,
+# yielding the results in order; it is closed as soon as one fits
+EncodeLevel = Callable[[int, List[Candidate]], Iterator[bytes]]
+
+
+def encode_ladder(frame: Frame, budget: EncodeBudget, encode_level: EncodeLevel) -> EncodedImage:
+    """Walk the encode ladder for ``frame``, leaving each level's encodes to ``encode_level``
+
+    Each resolution level tries PNG (first level only), then every lossy
+    format from the highest quality down. If nothing fits, the longest side
+    is shrunk in proportion to how far the smallest attempt overshot, and the
+    ladder repeats. The smallest result is returned if the budget cannot be met.
+    """
+    start = time.perf_counter()
+    budget = usable_budget(budget)
+    formats = supported_formats(budget.formats)
+    dimension = max(frame.scaled_size(budget.max_dimension))
+    steps = 0
+    best = None  # (data, fmt, quality, dimension)
+
+    first_level = True
+    while steps < budget.max_steps:
+        candidates: List[Candidate] = [
+            # Lossless size barely shrinks with resolution compared to lossy formats
+            (fmt, quality) for fmt in formats if fmt != "PNG" or first_level
+            for quality in ((None,) if fmt == "PNG" else budget.qualities)
+        ][:budget.max_steps - steps]
+        level = encode_level(dimension, candidates)
+        try:
+            for (fmt, quality), data in zip(candidates, level):
+                steps += 1
+                if best is None or len(data) < len(best[0]):
+                    best = (data, fmt, quality, dimension)
+                if len(data) <= budget.max_bytes:
+                    return _result(frame, data, fmt, quality, dimension, steps, start, True)
+        finally:
+            # Lets the level drop candidates it has not finished yet
+            level.close()
+
+        first_level = False
+        if dimension <= budget.min_dimension:
+            break
+        # Encoded size scales roughly with pixel count
+        factor = min(0.9, max(0.5, (budget.max_bytes / len(best[0])) ** 0.5 * 0.95))
+        dimension = max(budget.min_dimension, int(dimension * factor))
+
+    data, fmt, quality, dimension = best
+    return _result(frame, data, fmt, quality, dimension, steps, start, len(data) <= budget.max_bytes)
+
+
+def encode_for_budget(frame: Frame, budget: EncodeBudget) -> EncodedImage:
+    """Encode a frame to fit ``budget`` in at most ``budget.max_steps`` attempts, in this thread
+
+    See ``encode_ladder`` for the order of attempts.
+    """
+    def encode_level(dimension: int, candidates: List[Candidate]) -> Iterator[bytes]:
+        for fmt, quality in candidates:
+            yield frame.encoded(fmt, dimension, quality)
+
+    return encode_ladder(frame, budget, encode_level)
+
+
+def _result(frame: Frame, data: bytes, fmt: str, quality: Optional[int], dimension: int,
+            steps: int, start: float, within_budget: bool) -> EncodedImage:
+    encoded = EncodedImage(data, fmt, quality, frame.scaled_size(dimension), steps,
+                           (time.perf_counter() - start) * 1000, within_budget)
+    logger.debug("Encoded %s -> %s", frame, encoded.report())
+    return encoded
@@ -0,0 +1,214 @@
+"""In-memory image pipeline.
+
+A ``Frame`` wraps one captured screen and computes its derived forms (decoded
+image, scaled copies, encoded bytes, base64 text) on first use only. The same
+frame object travels from the capture in ``MainPage`` to the provider code in
+``ApiWorker``, so every conversion happens at most once per query and nothing
+is written to disk.
+"""
+import base64
+import threading
+from io import BytesIO
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .screenshot import PixelBuffer
+
+# PIL format name -> MIME subtype
+MIME_TYPES = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+}
+
+
+class Frame:
+    """A captured screen with lazily computed, memoized derived forms"""
+
+    def __init__(self, buffer: "PixelBuffer"):
+        self.buffer = buffer
+        self._lock = threading.RLock()
+        self._image = None
+        self._scaled: Dict[int, object] = {}
+        self._encoded: Dict[Tuple, bytes] = {}
+        self._base64: Dict[Tuple, str] = {}
+        self._hashes: Dict[int, int] = {}
+        # PIL format of the bytes the frame was decoded from, if any
+        self.source_format: Optional[str] = None
+
+    @classmethod
+    def from_bytes(cls, image_data: bytes) -> "Frame":
+        """Build a frame from an already encoded image (PNG, JPEG, ...)
+
+        The original bytes are kept, so asking for the same format at full
+        size returns them without re-encoding.
+
+        Raises:
+            ValueError: If the data is not a readable image
+        """
+        from PIL import Image, UnidentifiedImageError
+        from .screenshot import PixelBuffer
+
+        try:
+            img = Image.open(BytesIO(image_data))
+            img_format = img.format
+            img = img.convert("RGB")
+        except (UnidentifiedImageError, OSError):
+            raise ValueError("Invalid image format")
+
+        frame = cls(PixelBuffer(img.tobytes(), img.width, img.height, raw_mode="RGB"))
+        frame._image = img
+        if img_format in MIME_TYPES:
+            frame._encoded[(img_format, None, None)] = image_data
+        frame.source_format = img_format
+        return frame
+
+    @property
+    def width(self) -> int:
+        return self.buffer.width
+
+    @property
+    def height(self) -> int:
+        return self.buffer.height
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.buffer.width, self.buffer.height
+
+    def crop(self, rect: Tuple[int, int, int, int]) -> "Frame":
+        """New frame holding the pixels inside ``rect`` (x, y, width, height)"""
+        return Frame(self.buffer.crop(rect))
+
+    def masked(self, rect: Tuple[int, int, int, int], fill: int = 0x20) -> "Frame":
+        """New frame with ``rect`` (x, y, width, height) painted a flat gray
+
+        Used to blank out Glance's own window instead of hiding it before capture.
+        """
+        from .screenshot import PixelBuffer
+
+        buffer = self.buffer
+        x, y, width, height = buffer.clip(rect)
+        if width <= 0 or height <= 0:
+            return self
+        bpp = buffer.bytes_per_pixel
+        data = bytearray(buffer.data)
+        blank = bytes([fill]) * (width * bpp)
+        for row in range(y, y + height):
+            start = row * buffer.stride + x * bpp
+            data[start:start + len(blank)] = blank
+        return Frame(PixelBuffer(data, buffer.width, buffer.height, raw_mode=buffer.raw_mode,
+                                 stride=buffer.stride, backend=buffer.backend, elapsed_ms=buffer.elapsed_ms))
+
+    def image(self, cache: bool = True):
+        """Full-size RGB PIL image, decoded once
+
+        Args:
+            cache: Keep the decoded image on the frame. Without it a frame
+                that holds no decoded image returns a one-off copy, for
+                callers that must not undo ``release``.
+        """
+        with self._lock:
+            if self._image is None:
+                if not cache:
+                    return self.buffer.to_image()
+                self._image = self.buffer.to_image()
+            return self._image
+
+    def scaled_size(self, max_dimension: Optional[int]) -> Tuple[int, int]:
+        """Size of the frame after scaling its longest side down to ``max_dimension``"""
+        width, height = self.size
+        if not max_dimension:
+            return width, height
+        scale = min(max_dimension / width, max_dimension / height)
+        # Only scale down, never up
+        if scale >= 1:
+            return width, height
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def scaled(self, max_dimension: Optional[int]):
+        """PIL image scaled down (never up) so neither side exceeds ``max_dimension``"""
+        from PIL import Image
+
+        target = self.scaled_size(max_dimension)
+        if target == self.size:
+            return self.image()
+        with self._lock:
+            if max_dimension not in self._scaled:
+                self._scaled[max_dimension] = self.image().resize(target, Image.Resampling.LANCZOS)
+            return self._scaled[max_dimension]
+
+    def _encode_key(self, fmt: str, max_dimension: Optional[int], quality: Optional[int]) -> Tuple:
+        """Cache key for an encode; arguments that produce the same bytes share one"""
+        if self.scaled_size(max_dimension) == self.size:
+            max_dimension = None
+        if fmt == "PNG":
+            quality = None
+        return fmt, max_dimension, quality
+
+    def encoded(self, fmt: str = "PNG", max_dimension: Optional[int] = None,
+                quality: Optional[int] = None) -> bytes:
+        """Encoded bytes of the (optionally scaled) frame
+
+        Args:
+            fmt: PIL format name (PNG, JPEG, WEBP)
+            max_dimension: Maximum width or height, None for full size
+            quality: Lossy quality setting, ignored for PNG
+        """
+        key = self._encode_key(fmt, max_dimension, quality)
+        fmt, max_dimension, quality = key
+        with self._lock:
+            if key not in self._encoded:
+                options = {} if quality is None else {"quality": quality}
+                buffer = BytesIO()
+                self.scaled(max_dimension).save(buffer, format=fmt, **options)
+                self._encoded[key] = buffer.getvalue()
+            return self._encoded[key]
+
+    def base64(self, fmt: str = "PNG", max_dimension: Optional[int] = None,
+               quality: Optional[int] = None) -> str:
+        """Base64 text of ``encoded`` with the same arguments"""
+        key = self._encode_key(fmt, max_dimension, quality)
+        with self._lock:
+            if key not in self._base64:
+                self._base64[key] = base64.b64encode(self.encoded(fmt, max_dimension, quality)).decode("utf-8")
+            return self._base64[key]
+
+    def perceptual_hash(self, hash_size: int = 16) -> int:
+        """Difference hash of the frame as a ``hash_size * hash_size`` bit integer
+
+        Similar-looking frames get hashes with a small Hamming distance, so the
+        hash survives re-captures of an unchanged screen.
+        """
+        from PIL import Image
+
+        with self._lock:
+            if hash_size not in self._hashes:
+                small = self.image().resize((hash_size + 1, hash_size), Image.Resampling.BOX).convert("L")
+                pixels = small.tobytes()
+                bits = 0
+                for row in range(hash_size):
+                    offset = row * (hash_size + 1)
+                    for col in range(hash_size):
+                        bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+                self._hashes[hash_size] = bits
+            return self._hashes[hash_size]
+
+    def release(self) -> None:
+        """Drop the decoded, scaled and encoded forms, keeping the pixels and hashes
+
+        Anything asked for again is recomputed. Used in low-memory mode once a
+        query has its encoded image.
+        """
+        with self._lock:
+            self._image = None
+            self._scaled.clear()
+            self._encoded.clear()
+            self._base64.clear()
+
+    @staticmethod
+    def mime_type(fmt: str) -> str:
+        return MIME_TYPES.get(fmt, f"image/{fmt.lower()}")
+
+    def __repr__(self):
+        return f"Frame({self.width}x{self.height}, backend={self.buffer.backend!r})"
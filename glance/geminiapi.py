@@ -1,14 +1,28 @@
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 import requests
 import os
-from typing import Optional, Tuple
-from enum import Enum
-import imghdr
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple, Union
+from enum import Enum
 from PIL import Image
 import logging
 
+from .admission import AdmissionController, AdmissionError, estimate_tokens
+from .frame import Frame
+from .session import Turn
+from .tracing import get_tracer
+from .encoder import EncodedImage, budget_for, encode_for_budget
+
+logger = logging.getLogger(__name__)
+
+# Uploaded screenshots remembered for follow-ups; older ones are deleted
+MAX_UPLOADS = 8
+
 class GeminiModel(Enum):
     """Available Gemini models"""
     GEMINI_2_FLASH = "gemini-2.0-flash-exp"
@@ -17,8 +31,16 @@ class GeminiModel(Enum):
     GEMINI_1_PRO_VISION = "gemini-1.0-pro-vision"
 
 class GeminiAPI:
-    def __init__(self, api_key: Optional[str] = None, debug: bool = False):
-        """Initialize Gemini API client"""
+    def __init__(self, api_key: Optional[str] = None, debug: bool = False,
+                 admission: Optional[AdmissionController] = None, base_url: Optional[str] = None):
+        """Initialize Gemini API client
+        
+        Args:
+            api_key: Gemini API key, defaults to GEMINI_API_KEY
+            debug: Enable debug logging
+            admission: Rate limiting and retry policy, default unlimited with retries
+            base_url: Alternative API root, e.g. a proxy or a local mock server
+        """
         self.api_key = api_key or os.getenv("GEMINI_API_KEY")
         if not self.api_key:
             raise ValueError("Gemini API key not found. Please set GEMINI_API_KEY environment variable or pass it directly.")
@@ -26,8 +48,16 @@ class GeminiAPI:
         if debug:
             logging.basicConfig(level=logging.DEBUG)
             
-        self.client = genai.Client(api_key=self.api_key)
+        http_options = types.HttpOptions(base_url=base_url) if base_url else None
+        self.client = genai.Client(api_key=self.api_key, http_options=http_options)
         self.model = GeminiModel.GEMINI_2_FLASH.value  # Default model
+        self.admission = admission or AdmissionController()
+        # Files API uploads by content hash of the encoded image, oldest first
+        self._uploads: "OrderedDict[str, Future]" = OrderedDict()
+        self._uploads_lock = threading.Lock()
+        self._upload_executor: Optional[ThreadPoolExecutor] = None
+        self.uploads_made = 0
+        self.upload_hits = 0
 
     def set_model(self, model: GeminiModel) -> None:
         """Set the Gemini model to use
@@ -62,6 +92,21 @@ class GeminiAPI:
         
         return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
 
+    def _prepare_image(self, frame: Frame, scale: bool = True) -> EncodedImage:
+        """Encode a frame to fit the current model's payload budget
+        
+        Args:
+            frame: Captured or decoded frame
+            scale: Scale down large images (recommended for screenshots)
+            
+        Returns:
+            EncodedImage: Encoded bytes plus the settings that were chosen
+        """
+        budget = budget_for(self.model)
+        if not scale:
+            budget = budget._replace(max_dimension=None)
+        return encode_for_budget(frame, budget)
+
     def _validate_image(self, image_data: bytes, scale: bool = True) -> Tuple[bytes, str]:
         """Validate image size and format
         
@@ -74,43 +119,113 @@ class GeminiAPI:
         Raises:
             ValueError: If image is invalid or too large
         """
-        # Detect image format
-        img_format = imghdr.what(None, image_data)
-        if not img_format:
-            raise ValueError("Invalid image format")
-            
-        # Convert MIME type
-        mime_type = f"image/{img_format.lower()}"
-        
-        # Open image
-        img = Image.open(BytesIO(image_data))
-        
-        # Scale down large images (recommended for screenshots)
-        if scale:
-            img = self._scale_image(img)
-        
-        # Check size and resize if still needed (Gemini's limit is 4MB)
-        max_size = 4 * 1024 * 1024  # 4MB
-        
-        if len(image_data) > max_size:
-            # Resize while maintaining aspect ratio
-            factor = (max_size / len(image_data)) ** 0.5
-            new_size = tuple(int(dim * factor) for dim in img.size)
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
-            
-            # Convert back to bytes
-            buffer = BytesIO()
-            img.save(buffer, format=img_format)
-            image_data = buffer.getvalue()
-            
-        return image_data, mime_type
+        encoded = self._prepare_image(Frame.from_bytes(image_data), scale=scale)
+        return encoded.data, encoded.mime_type
+
+    def _contents(self, image: Union[Frame, EncodedImage, bytes, List[EncodedImage]], query: str, scale: bool = True) -> list:
+        """Build the request contents for a query about an image (or several encoded images)"""
+        if isinstance(image, list):
+            images = image
+        elif isinstance(image, EncodedImage):
+            images = [image]
+        else:
+            frame = image if isinstance(image, Frame) else Frame.from_bytes(image)
+            images = [self._prepare_image(frame, scale=scale)]
+        return [query] + [
+            types.Part.from_bytes(data=encoded.data, mime_type=encoded.mime_type)
+            for encoded in images
+        ]
+
+    @staticmethod
+    def _upload_key(encoded: EncodedImage) -> str:
+        return hashlib.sha1(encoded.data).hexdigest()
+
+    def upload_images(self, images: Sequence[EncodedImage]) -> None:
+        """Upload screenshots to the Files API in the background, once per distinct image
 
-    def analyze_image(self, image_data: bytes, query: str = "What is in this image?", scale: bool = True) -> str:
+        The question that first sends an image still sends its bytes inline,
+        so the upload adds no latency; follow-ups refer to the uploaded file
+        once it is ready.
+        """
+        with self._uploads_lock:
+            for encoded in images:
+                key = self._upload_key(encoded)
+                if key in self._uploads:
+                    self._uploads.move_to_end(key)
+                    continue
+                if self._upload_executor is None:
+                    # One worker keeps uploads and deletes in order
+                    self._upload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="glance-gemini-upload")
+                self._uploads[key] = self._upload_executor.submit(self._upload, encoded)
+                while len(self._uploads) > MAX_UPLOADS:
+                    _, stale = self._uploads.popitem(last=False)
+                    self._upload_executor.submit(self._delete, stale)
+
+    def _upload(self, encoded: EncodedImage) -> Optional[types.File]:
+        try:
+            uploaded = self.admission.call(lambda: self.client.files.upload(
+                file=BytesIO(encoded.data), config=types.UploadFileConfig(mime_type=encoded.mime_type)))
+        except Exception as e:
+            # Follow-ups fall back to sending the bytes inline
+            logger.warning("Gemini file upload failed: %s", e)
+            return None
+        self.uploads_made += 1
+        return uploaded
+
+    def _delete(self, upload: Future) -> None:
+        uploaded = upload.result()
+        if uploaded is None:
+            return
+        try:
+            self.client.files.delete(name=uploaded.name)
+        except Exception as e:
+            # Uploaded files expire on their own after two days
+            logger.debug("Could not delete %s: %s", uploaded.name, e)
+
+    def _image_part(self, encoded: EncodedImage, uploaded: bool = False) -> types.Part:
+        """Inline bytes, or with ``uploaded`` a reference to the Files API copy if it is ready"""
+        if uploaded:
+            with self._uploads_lock:
+                upload = self._uploads.get(self._upload_key(encoded))
+            if upload is not None and upload.done() and upload.result() is not None:
+                file = upload.result()
+                if file.uri and file.state in (None, types.FileState.ACTIVE):
+                    self.upload_hits += 1
+                    return types.Part.from_uri(file_uri=file.uri, mime_type=file.mime_type or encoded.mime_type)
+        return types.Part.from_bytes(data=encoded.data, mime_type=encoded.mime_type)
+
+    def _conversation(self, images: List[EncodedImage], query: str, history: Sequence[Turn]) -> list:
+        """Request contents for a follow-up: earlier turns, then the question"""
+        contents = []
+        for turn in history:
+            contents.append(types.Content(role="user", parts=[types.Part.from_text(text=turn.prompt)] + [
+                self._image_part(encoded, uploaded=True) for encoded in turn.images]))
+            contents.append(types.Content(role="model", parts=[types.Part.from_text(text=turn.answer)]))
+        contents.append(types.Content(role="user", parts=[types.Part.from_text(text=query)] + [
+            self._image_part(encoded) for encoded in images]))
+        return contents
+
+    def upload_stats(self) -> dict:
+        with self._uploads_lock:
+            return {"uploaded": self.uploads_made, "reused": self.upload_hits, "kept": len(self._uploads)}
+
+    def close(self) -> None:
+        if self._upload_executor is not None:
+            self._upload_executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _estimate_tokens(contents: list) -> int:
+        """Approximate request cost for the token bucket"""
+        prompt = next((part for part in contents if isinstance(part, str)), "")
+        images = len(contents) - 1
+        return estimate_tokens(prompt) + 258 * images
+
+    def analyze_image(self, image: Union[Frame, EncodedImage, bytes], query: str = "What is in this image?", scale: bool = True) -> str:
         """
         Analyze an image using Gemini Vision API
         
         Args:
-            image_data: Raw image bytes
+            image: Captured frame, an already budgeted encode, or raw encoded image bytes
             query: Question to ask about the image
             
         Returns:
@@ -118,27 +233,23 @@ class GeminiAPI:
             
         Raises:
             ValueError: If image validation fails
-            genai.types.generation_types.GenerationError: If Gemini API call fails
-            Exception: For other unexpected errors
+            Exception: If the Gemini API call fails after any retries
         """
         try:
             # Validate and process image
-            processed_image, mime_type = self._validate_image(image_data, scale=scale)
+            contents = self._contents(image, query, scale=scale)
             
-            # Send to Gemini
+            # Send to Gemini; throttling and server errors are retried by the admission layer
             try:
-                response = self.client.models.generate_content(
-                    model=self.model,
-                    contents=[
-                        query,
-                        types.Part.from_bytes(data=processed_image, mime_type=mime_type)
-                    ]
+                response = self.admission.call(
+                    lambda: self.client.models.generate_content(model=self.model, contents=contents),
+                    self._estimate_tokens(contents),
                 )
                 return response.text
-            except genai.types.generation_types.GenerationError as e:
-                if "quota exceeded" in str(e).lower():
-                    raise Exception("API quota exceeded. Please try again later.")
-                elif "rate limit" in str(e).lower():
+            except AdmissionError:
+                raise
+            except errors.APIError as e:
+                if e.code == 429:
                     raise Exception("Rate limit reached. Please wait a moment and try again.")
                 else:
                     raise Exception(f"Gemini API error: {str(e)}")
@@ -154,6 +265,43 @@ class GeminiAPI:
             # Re-raise the exception to be handled by the caller
             raise
 
+    def analyze_image_stream(self, image: Union[Frame, EncodedImage, bytes, List[EncodedImage]], query: str = "What is in this image?", scale: bool = True, model: Optional[str] = None, history: Optional[Sequence[Turn]] = None, info: Optional[dict] = None, is_cancelled: Optional[Callable[[], bool]] = None) -> Iterator[str]:
+        """
+        Analyze an image using Gemini Vision API, yielding the answer as it is generated
+        
+        Args:
+            image: Captured frame, budgeted encode(s), or raw encoded image bytes;
+                an empty list for a follow-up about the same screen
+            query: Question to ask about the image
+            model: Model name to use instead of the current one
+            history: Earlier turns of the session, sent before the question
+            info: Filled with the response's ``finish_reason`` (e.g. 'STOP', 'MAX_TOKENS')
+            is_cancelled: Returns True once the caller gave up; stops rate-limit waits and retries
+            
+        Yields:
+            str: Successive pieces of Gemini's response
+        """
+        with get_tracer().span("request_build"):
+            if history:
+                images = image if isinstance(image, list) else [image]
+                contents = self._conversation(images, query, history)
+                tokens = (estimate_tokens(query) + 258 * len(images)
+                          + sum(estimate_tokens(turn.prompt + turn.answer, max_output=0) + 258 * len(turn.images)
+                                for turn in history))
+            else:
+                contents = self._contents(image, query, scale=scale)
+                tokens = self._estimate_tokens(contents)
+
+        def send():
+            for chunk in self.client.models.generate_content_stream(model=model or self.model, contents=contents):
+                reason = chunk.candidates[0].finish_reason if chunk.candidates else None
+                if info is not None and reason is not None:
+                    info["finish_reason"] = getattr(reason, "name", str(reason))
+                if chunk.text:
+                    yield chunk.text
+
+        yield from self.admission.stream(send, tokens, is_cancelled)
+
     def analyze_image_from_url(self, image_url: str, query: str = "What is in this image?", scale: bool = True) -> str:
         """
         Analyze an image from a URL using Gemini Vision API
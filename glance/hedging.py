@@ -0,0 +1,279 @@
+"""Hedged requests across providers.
+
+A hedged query starts on the primary provider. If no answer has started to
+arrive after a delay (or immediately, in race mode, or as soon as the primary
+fails), the same prepared images and prompt are sent to a second provider or
+model. Whichever attempt streams its first non-empty chunk first wins: its
+text is forwarded and the other attempt is told to stop. Both run on the
+request scheduler: the primary under the query's own slot, the hedge as a job
+of its own, so it waits for a free slot like any other request. Per-attempt
+win rates and first-token latencies (of losing attempts too, when their first
+token arrives before they stop) are kept so the hedge delay can be tuned, or
+derived automatically from the primary's recent latency.
+"""
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from .scheduler import RequestScheduler
+
+logger = logging.getLogger(__name__)
+
+# A label (e.g. "gemini:gemini-1.5-flash") and a callable opening the answer
+# stream, given a callable that returns True once the attempt should stop
+Attempt = Tuple[str, Callable[[Callable[[], bool]], Iterator[str]]]
+
+
+class HedgeStats:
+    """Rolling win counts and first-token latencies per attempt label"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.attempts: Dict[str, int] = {}
+        self.wins: Dict[str, int] = {}
+        self.latencies: Dict[str, Deque[float]] = {}
+        self.hedged = 0
+        self._lock = threading.Lock()
+
+    def record(self, label: str, won: bool, ttft_ms: Optional[float]) -> None:
+        with self._lock:
+            self.attempts[label] = self.attempts.get(label, 0) + 1
+            if won:
+                self.wins[label] = self.wins.get(label, 0) + 1
+            if ttft_ms is not None:
+                self.latencies.setdefault(label, deque(maxlen=self.window)).append(ttft_ms)
+
+    def note_hedged(self) -> None:
+        with self._lock:
+            self.hedged += 1
+
+    @staticmethod
+    def _pick(samples: List[float], fraction: float) -> Optional[float]:
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    def percentile(self, label: str, fraction: float, min_samples: int = 1) -> Optional[float]:
+        """First-token latency percentile for ``label``, or None with fewer than ``min_samples``"""
+        with self._lock:
+            samples = sorted(self.latencies.get(label, ()))
+        return self._pick(samples, fraction) if len(samples) >= min_samples else None
+
+    def snapshot(self) -> dict:
+        """Win rate and latency percentiles for every label seen so far"""
+        # Copied under the lock; worker threads record while this runs
+        with self._lock:
+            hedged = self.hedged
+            counts = {label: (attempts, self.wins.get(label, 0), sorted(self.latencies.get(label, ())))
+                      for label, attempts in self.attempts.items()}
+        result = {"hedged": hedged, "providers": {}}
+        for label, (attempts, wins, samples) in counts.items():
+            result["providers"][label] = {
+                "attempts": attempts,
+                "wins": wins,
+                "win_rate": round(wins / attempts, 3) if attempts else 0.0,
+                "ttft_p50_ms": self._pick(samples, 0.5),
+                "ttft_p95_ms": self._pick(samples, 0.95),
+            }
+        return result
+
+
+class HedgePolicy:
+    """Where and when to send the hedge request"""
+
+    def __init__(self, provider: str, api_endpoint: str = "", api_key: str = "",
+                 model: Optional[str] = None, delay_ms: float = 1500, race: bool = False,
+                 adaptive: bool = True, min_samples: int = 20):
+        """
+        Args:
+            provider: Provider of the hedge request ('openai' or 'gemini')
+            api_endpoint: Endpoint for an OpenAI-compatible hedge provider
+            api_key: API key for the hedge provider
+            model: Model to ask, None for the provider's default
+            delay_ms: Wait before hedging when there are too few samples to adapt
+            race: Send both requests at once
+            adaptive: Use the primary's p90 first-token latency as the delay once
+                ``min_samples`` have been recorded
+        """
+        self.provider = provider
+        self.api_endpoint = api_endpoint
+        self.api_key = api_key
+        self.model = model
+        self.delay_ms = delay_ms
+        self.race = race
+        self.adaptive = adaptive
+        self.min_samples = min_samples
+        self.stats = HedgeStats()
+
+    @classmethod
+    def from_config(cls, options: dict) -> Optional["HedgePolicy"]:
+        """Build the policy from the ``hedge`` config section, or None if disabled"""
+        if not options.get("enabled", False) or not options.get("provider"):
+            return None
+        return cls(
+            provider=options["provider"],
+            api_endpoint=options.get("api_endpoint", ""),
+            api_key=options.get("api_key", ""),
+            model=options.get("model"),
+            delay_ms=options.get("delay_ms", 1500),
+            race=options.get("mode") == "race",
+            adaptive=options.get("adaptive", True),
+        )
+
+    def delay(self, primary_label: str) -> float:
+        """Seconds to wait for the primary's first token before hedging"""
+        if self.race:
+            return 0.0
+        if self.adaptive:
+            p90 = self.stats.percentile(primary_label, 0.9, min_samples=max(1, self.min_samples))
+            if p90 is not None:
+                return p90 / 1000
+        return self.delay_ms / 1000
+
+    def run(self, primary: Attempt, secondary: Attempt, on_chunk: Callable[[str], None],
+            is_cancelled: Callable[[], bool], scheduler: RequestScheduler) -> Tuple[Optional[str], str, dict]:
+        """Run the hedged query
+
+        Args:
+            scheduler: Runs the attempts; the caller is a job of it holding a slot,
+                which the primary uses
+
+        Returns:
+            Tuple of the winning label (None if cancelled), the full answer and a
+            report of what happened. If no attempt produced any text, the
+            primary's empty answer is returned.
+
+        Raises:
+            Exception: The primary's error if every attempt failed
+        """
+        events: "queue.Queue" = queue.Queue()
+        stops: Dict[str, threading.Event] = {}
+        started: Dict[str, float] = {}
+        futures: Dict[str, concurrent.futures.Future] = {}
+        ttft: Dict[str, float] = {}
+        lock = threading.Lock()
+        state = {"winner": None}
+        if secondary[0] == primary[0]:
+            secondary = (f"{secondary[0]}#hedge", secondary[1])
+        attempts = dict([primary, secondary])
+
+        def claim(label) -> bool:
+            """Make ``label`` the winner unless another attempt already is"""
+            with lock:
+                if state["winner"] is None:
+                    state["winner"] = label
+                    for other, stop in stops.items():
+                        if other != label:
+                            stop.set()
+                return state["winner"] == label
+
+        def consume(label, stop):
+            # The hedge may have waited for a slot; its latency counts from now
+            started[label] = time.perf_counter()
+            stopped = lambda: stop.is_set() or is_cancelled()
+            # Whitespace does not win the race; it is kept for the answer it may start
+            leading = []
+            try:
+                for text in attempts[label](stopped):
+                    if label not in ttft:
+                        if not text.strip():
+                            leading.append(text)
+                            continue
+                        ttft[label] = (time.perf_counter() - started[label]) * 1000
+                        if not claim(label):
+                            return
+                        text = "".join(leading) + text
+                    elif stop.is_set():
+                        return
+                    events.put(("chunk", label, text))
+                events.put(("done", label, None))
+            except Exception as e:
+                events.put(("error", label, e))
+            finally:
+                self.stats.record(label, state["winner"] == label, ttft.get(label))
+
+        def launch(label):
+            with lock:
+                stops[label] = threading.Event()
+                if state["winner"] is not None:
+                    stops[label].set()
+            started[label] = time.perf_counter()
+            job = lambda: consume(label, stops[label])
+            if label == primary_label:
+                futures[label] = scheduler.submit_within(job)
+            else:
+                futures[label] = scheduler.submit(job)
+
+        primary_label, secondary_label = primary[0], secondary[0]
+        delay = self.delay(primary_label)
+        launch(primary_label)
+        hedge_at = started[primary_label] + delay
+        if delay == 0:
+            launch(secondary_label)
+
+        # Attempts that ended without producing any text: their error, or None
+        ended: Dict[str, Optional[Exception]] = {}
+        parts = []
+        try:
+            while True:
+                if is_cancelled():
+                    return None, "", {}
+                winner = state["winner"]
+                now = time.perf_counter()
+                if winner is None and secondary_label not in stops and now >= hedge_at:
+                    launch(secondary_label)
+                wait = 0.1
+                if secondary_label not in stops:
+                    wait = min(wait, max(0.0, hedge_at - now))
+                try:
+                    kind, label, payload = events.get(timeout=wait)
+                except queue.Empty:
+                    continue
+
+                if label != state["winner"]:
+                    # Ended before producing text (or lost, and stopped)
+                    if kind == "chunk":
+                        continue
+                    ended[label] = payload if kind == "error" else None
+                    if state["winner"] is not None:
+                        continue
+                    if secondary_label not in stops:
+                        # Hedge straight away instead of waiting out the delay
+                        launch(secondary_label)
+                    elif len(ended) == len(stops):
+                        # No attempt produced text: the primary's error, or its empty answer for the caller to judge
+                        if ended[primary_label] is not None:
+                            raise ended[primary_label]
+                        state["winner"] = primary_label
+                        break
+                    continue
+                if kind == "error":
+                    raise payload
+                if kind == "chunk":
+                    parts.append(payload)
+                    on_chunk(payload)
+                else:
+                    break
+        finally:
+            for stop in stops.values():
+                stop.set()
+            for label, future in futures.items():
+                if label != state["winner"] and label not in ended:
+                    # A hedge still waiting for a slot is dropped; running attempts stop at their next check
+                    future.cancel()
+            if len(stops) > 1:
+                self.stats.note_hedged()
+
+        winner = state["winner"]
+        report = {
+            "winner": winner,
+            "hedged": len(stops) > 1,
+            "delay_ms": round(delay * 1000, 1),
+            "ttft_ms": round(ttft[winner], 2) if winner in ttft else None,
+        }
+        logger.info("Hedged request: %s", report)
+        return winner, "".join(parts), report
@@ -0,0 +1,417 @@
+"""Query history.
+
+Every answered question is kept in a local SQLite database with its answer,
+the model that gave it, its timings and the content key of the screenshot
+(the same key ``ScreenshotArchive`` stores the image under); a small JPEG
+thumbnail of the screenshot is stored too if enabled. An FTS5 index over prompts and answers makes searching tens of
+thousands of entries a matter of milliseconds, so an earlier answer can be
+found instead of asked for again.
+
+``add`` only queues the entry: thumbnails are made and rows are written by a
+background writer thread, which commits whatever has queued up in one
+transaction. Reads go through a separate connection; the database is in WAL
+mode, so they never wait for a write, and entries not written yet are served
+from memory rather than waited for.
+
+``AnswerHistory`` is the in-memory equivalent used when the database is
+disabled. Both are sources for ``widgets.history_view.HistoryModel``:
+``__len__``, ``page(offset, limit)`` newest first, and ``add``.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+from collections import deque
+from typing import Deque, List, NamedTuple, Optional
+
+from .archive import content_key
+from .frame import Frame
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    prompt TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    model TEXT NOT NULL DEFAULT '',
+    provider TEXT NOT NULL DEFAULT '',
+    ttft_ms REAL,
+    total_ms REAL,
+    metrics TEXT,
+    frame_hash TEXT,
+    -- Last, so reading the other columns never touches it
+    thumbnail BLOB
+);
+CREATE INDEX IF NOT EXISTS queries_frame_hash ON queries(frame_hash);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS queries_fts USING fts5(
+    prompt, answer, content='queries', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS queries_fts_insert AFTER INSERT ON queries BEGIN
+    INSERT INTO queries_fts(rowid, prompt, answer) VALUES (new.id, new.prompt, new.answer);
+END;
+CREATE TRIGGER IF NOT EXISTS queries_fts_delete AFTER DELETE ON queries BEGIN
+    INSERT INTO queries_fts(queries_fts, rowid, prompt, answer) VALUES ('delete', old.id, old.prompt, old.answer);
+END;
+"""
+
+COLUMNS = "id, timestamp, prompt, answer, model, provider, ttft_ms, total_ms, frame_hash"
+
+
+class HistoryEntry(NamedTuple):
+    question: str
+    answer: str
+    timestamp: float
+    model: str = ""
+    provider: str = ""
+    ttft_ms: Optional[float] = None
+    total_ms: Optional[float] = None
+    frame_hash: Optional[str] = None
+    # Row id, once stored
+    entry_id: Optional[int] = None
+    # Matching text with the search terms in [brackets], for search results
+    snippet: str = ""
+
+
+def default_path() -> str:
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "glance", "history.db")
+
+
+def match_expression(text: str) -> Optional[str]:
+    """FTS5 query matching entries that contain every word of ``text`` (the last one as a prefix)"""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def make_thumbnail(frame: Frame, max_dimension: int = 192, quality: int = 70) -> bytes:
+    """Small JPEG of the frame"""
+    from io import BytesIO
+    from PIL import Image
+
+    # Bilinear with reducing_gap is plenty at this size and far cheaper than LANCZOS. The
+    # frame may be released already (and shared with the capture buffer), so a decode
+    # made here is not cached on it.
+    image = frame.image(cache=False).resize(frame.scaled_size(max_dimension), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    out = BytesIO()
+    image.save(out, format="JPEG", quality=quality)
+    return out.getvalue()
+
+
+class AnswerHistory:
+    """Answers of this session, newest first, kept in memory only"""
+
+    def __init__(self, max_entries: int = 1000):
+        self.entries = deque(maxlen=max_entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, entry: HistoryEntry, frame: Optional[Frame] = None, metrics: Optional[dict] = None) -> None:
+        self.entries.appendleft(entry)
+
+    def page(self, offset: int, limit: int) -> List[HistoryEntry]:
+        return [self.entries[i] for i in range(offset, min(offset + limit, len(self.entries)))]
+
+
+class SearchResults:
+    """Entries matching a search, newest first, read a page at a time"""
+
+    def __init__(self, store: "HistoryStore", text: str):
+        self.store = store
+        self.text = text
+        self._count = store.count_matches(text)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def page(self, offset: int, limit: int) -> List[HistoryEntry]:
+        return self.store.search(self.text, limit=limit, offset=offset)
+
+    def thumbnail(self, entry_id: int) -> Optional[bytes]:
+        return self.store.thumbnail(entry_id)
+
+
+class HistoryStore:
+    """SQLite history of questions and answers, with full-text search and thumbnails"""
+
+    def __init__(self, path: Optional[str] = None, max_entries: Optional[int] = None,
+                 thumbnail_size: int = 0, batch_size: int = 64, max_pending: int = 256):
+        """
+        Args:
+            path: Database file, default ~/.local/share/glance/history.db;
+                ':memory:' keeps the history for this run only
+            max_entries: Oldest entries beyond this are deleted, None to keep everything
+            thumbnail_size: Longest side of stored thumbnails in pixels, 0 to store none
+            batch_size: Most entries written in one transaction
+            max_pending: Entries waiting for the writer before new ones are dropped
+        """
+        self.path = path or default_path()
+        self.max_entries = max_entries
+        self.thumbnail_size = thumbnail_size
+        self.batch_size = batch_size
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        # Re-entrant: page() holds it across reads of the queue and the database
+        self._lock = threading.RLock()
+        if self.path == ":memory:":
+            # Both connections have to see the same in-memory database
+            self._uri = f"file:glance-history-{id(self)}?mode=memory&cache=shared"
+        else:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._uri = None
+        self._reader = self._connect()
+        self.full_text = self._create_schema(self._reader)
+        self._count = self._reader.execute("SELECT count(*) FROM queries").fetchone()[0]
+        # Entries queued but not written yet, newest first
+        self._unwritten: Deque[HistoryEntry] = deque()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name="glance-history", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, options: dict) -> Optional["HistoryStore"]:
+        """Build the store from the ``history`` config section, or None if disabled or not persisted
+
+        Keeps the newest 10000 entries and no thumbnails unless configured otherwise.
+        """
+        if not options.get("enabled", True) or not options.get("persist", True):
+            return None
+        try:
+            return cls(
+                path=options.get("path"),
+                max_entries=options.get("max_stored", 10000),
+                thumbnail_size=options.get("thumbnail_size", 0),
+            )
+        except sqlite3.Error as e:
+            logger.warning("Query history unavailable: %s", e)
+            return None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._uri is not None:
+            connection = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=2000")
+        return connection
+
+    @staticmethod
+    def _create_schema(connection: sqlite3.Connection) -> bool:
+        """Create the tables; False if this SQLite has no FTS5 and search falls back to LIKE"""
+        with connection:
+            connection.executescript(SCHEMA)
+            try:
+                connection.executescript(FTS_SCHEMA)
+            except sqlite3.OperationalError as e:
+                logger.warning("SQLite has no FTS5 (%s); history search will be slow", e)
+                return False
+        return True
+
+    def add(self, entry: HistoryEntry, frame: Optional[Frame] = None, metrics: Optional[dict] = None) -> None:
+        """Queue ``entry`` to be stored without blocking
+
+        Args:
+            frame: Screenshot the question was about, for its hash and thumbnail
+            metrics: Full query metrics, kept as JSON
+        """
+        with self._lock:
+            try:
+                self._queue.put_nowait((entry, frame, metrics))
+            except queue.Full:
+                self.dropped += 1
+                logger.warning("History writer is behind; not storing %r (%d dropped so far)",
+                               entry.question[:40], self.dropped)
+                return
+            self._unwritten.appendleft(entry)
+
+    def __len__(self) -> int:
+        """Stored entries, counting those still queued"""
+        with self._lock:
+            return self._count + len(self._unwritten)
+
+    def page(self, offset: int, limit: int) -> List[HistoryEntry]:
+        """Entries newest first, those still queued included, without waiting for the writer"""
+        with self._lock:
+            unwritten = list(self._unwritten)
+            entries = unwritten[offset:offset + limit]
+            if len(entries) < limit:
+                # The writer commits under the lock, so no entry is in both lists
+                entries += self._query(f"SELECT {COLUMNS} FROM queries ORDER BY id DESC LIMIT ? OFFSET ?",
+                                       (limit - len(entries), max(0, offset - len(unwritten))))
+        return entries
+
+    def get(self, entry_id: int) -> Optional[HistoryEntry]:
+        entries = self._query(f"SELECT {COLUMNS} FROM queries WHERE id = ?", (entry_id,))
+        return entries[0] if entries else None
+
+    def thumbnail(self, entry_id: int) -> Optional[bytes]:
+        with self._lock:
+            row = self._reader.execute("SELECT thumbnail FROM queries WHERE id = ?", (entry_id,)).fetchone()
+        return row[0] if row else None
+
+    def search(self, text: str, limit: int = 50, offset: int = 0) -> List[HistoryEntry]:
+        """Entries containing every word of ``text``, newest first
+
+        Newest first rather than by relevance: FTS5 then walks the index in
+        rowid order and stops at ``limit``, where ranking would score every
+        match, which takes tens of milliseconds for common words.
+        """
+        expression = match_expression(text)
+        if expression is None:
+            return []
+        if not self.full_text:
+            return self._like(text, limit, offset)
+        columns = ", ".join(f"q.{column.strip()}" for column in COLUMNS.split(","))
+        return self._query(
+            f"SELECT {columns}, snippet(queries_fts, -1, '[', ']', '...', 12) FROM queries_fts "
+            "JOIN queries q ON q.id = queries_fts.rowid WHERE queries_fts MATCH ? "
+            "ORDER BY queries_fts.rowid DESC LIMIT ? OFFSET ?", (expression, limit, offset))
+
+    def count_matches(self, text: str) -> int:
+        expression = match_expression(text)
+        if expression is None:
+            return 0
+        with self._lock:
+            if not self.full_text:
+                pattern = f"%{text.strip()}%"
+                return self._reader.execute("SELECT count(*) FROM queries WHERE prompt LIKE ? OR answer LIKE ?",
+                                            (pattern, pattern)).fetchone()[0]
+            return self._reader.execute("SELECT count(*) FROM queries_fts WHERE queries_fts MATCH ?",
+                                        (expression,)).fetchone()[0]
+
+    def matching(self, text: str) -> SearchResults:
+        """Search results as a source for ``HistoryModel``"""
+        return SearchResults(self, text)
+
+    def _like(self, text: str, limit: int, offset: int) -> List[HistoryEntry]:
+        pattern = f"%{text.strip()}%"
+        return self._query(f"SELECT {COLUMNS} FROM queries WHERE prompt LIKE ? OR answer LIKE ? "
+                           "ORDER BY id DESC LIMIT ? OFFSET ?", (pattern, pattern, limit, offset))
+
+    def _query(self, sql: str, parameters: tuple) -> List[HistoryEntry]:
+        with self._lock:
+            rows = self._reader.execute(sql, parameters).fetchall()
+        return [HistoryEntry(question=row[2], answer=row[3], timestamp=row[1], model=row[4], provider=row[5],
+                             ttft_ms=row[6], total_ms=row[7], frame_hash=row[8], entry_id=row[0],
+                             snippet=row[9] if len(row) > 9 else "")
+                for row in rows]
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued entry has been written
+
+        Returns:
+            bool: False if ``timeout`` expired first
+        """
+        done = threading.Event()
+        try:
+            self._queue.put((None, done, None), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 5) -> None:
+        """Write what is queued and stop the writer thread"""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "path": self.path,
+                "entries": self._count,
+                "pending": len(self._unwritten),
+                "written": self.written,
+                "batches": self.batches,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "full_text": self.full_text,
+            }
+
+    def _run(self) -> None:
+        connection = self._connect()
+        try:
+            while True:
+                batch = [self._queue.get()]
+                # Whatever queued up meanwhile goes into the same transaction
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                items = [item for item in batch if item is not None and item[0] is not None]
+                if items:
+                    self._write(connection, items)
+                for item in batch:
+                    if item is not None and item[0] is None:
+                        # flush() marker
+                        item[1].set()
+                if stop:
+                    return
+                # Frames are large; let go of them before waiting for the next batch
+                batch = items = item = None
+        finally:
+            connection.close()
+
+    def _write(self, connection: sqlite3.Connection, items: list) -> None:
+        rows = []
+        for entry, frame, metrics in items:
+            thumbnail = None
+            frame_hash = entry.frame_hash
+            if frame is not None:
+                try:
+                    frame_hash = frame_hash or content_key(frame)
+                    if self.thumbnail_size:
+                        thumbnail = make_thumbnail(frame, self.thumbnail_size)
+                except Exception as e:
+                    logger.warning("Could not make a history thumbnail: %s", e)
+            rows.append((entry.timestamp, entry.question, entry.answer, entry.model, entry.provider,
+                         entry.ttft_ms, entry.total_ms, json.dumps(metrics, default=str) if metrics else None,
+                         frame_hash, thumbnail))
+        removed = 0
+        # Held across the commit, so readers see each entry either queued or written
+        with self._lock:
+            # The oldest queued entries are the ones being written
+            for _ in items:
+                self._unwritten.pop()
+            try:
+                with connection:
+                    connection.executemany(
+                        "INSERT INTO queries (timestamp, prompt, answer, model, provider, ttft_ms, total_ms, metrics, "
+                        "frame_hash, thumbnail) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                    if self.max_entries is not None:
+                        removed = connection.execute(
+                            "DELETE FROM queries WHERE id <= (SELECT id FROM queries ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                            (self.max_entries,)).rowcount
+            except sqlite3.Error as e:
+                logger.warning("Could not write query history: %s", e)
+                self.errors += 1
+                return
+            self._count += len(rows) - max(removed, 0)
+            self.written += len(rows)
+            self.batches += 1
+
+    def __repr__(self):
+        return f"HistoryStore({self.path!r}, {len(self)} entries)"
@@ -0,0 +1,325 @@
+"""Control socket.
+
+A running Glance listens on a Unix-domain socket so other processes (the
+``glance.client`` CLI, a keybinding, a script) can ask questions about the
+screen without starting anything: the capture backend, ring buffer, pooled
+provider connections and caches of the resident instance are already warm.
+
+The server runs on the request scheduler's asyncio loop, next to the
+provider I/O. Questions are handed to the GUI thread, which captures the
+screen and starts an ``ApiWorker`` exactly as for a typed question (the
+answer also appears in the widget); the worker's chunks are relayed from the
+scheduler thread straight to the socket, without waiting for the GUI. The
+wire protocol is described in ``glance.client``; the reply to an ``ask``
+ends its connection.
+
+The socket is created with mode 0600, so only the user running Glance can
+connect, and it lives in a directory only that user can write to: the
+runtime directory, or a ``glance-<uid>`` directory created with mode 0700.
+One question is answered at a time; the GUI queues the others (see
+``MainPage.ask_client``) and tells their clients with a ``queued`` event.
+"""
+import asyncio
+import atexit
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import socket
+import stat
+import time
+from typing import Callable, Optional
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+from .client import default_socket_path
+from .scheduler import RequestScheduler
+from .scope import SCOPES, CaptureScope
+
+logger = logging.getLogger(__name__)
+
+# Longest request line accepted from a client
+MAX_REQUEST_BYTES = 64 * 1024
+# Seconds a status request waits for the GUI thread
+STATUS_TIMEOUT = 2
+
+
+class ClientQuestion:
+    """A question received over the socket, and where its answer goes
+
+    Passed to ``MainPage.ask`` as the listener of the query; every method may
+    be called from any thread.
+    """
+
+    def __init__(self, question_id: int, message: dict, loop: asyncio.AbstractEventLoop):
+        self.id = question_id
+        self.prompt = str(message.get("prompt", "")).strip()
+        self.show = bool(message.get("show", False))
+        # Whether the response cache may answer
+        self.use_cache = bool(message.get("cache", True))
+        self.scope: Optional[CaptureScope] = None
+        if message.get("region"):
+            region = tuple(int(v) for v in message["region"])
+            if len(region) != 4:
+                raise ValueError("region needs four values")
+            self.scope = CaptureScope("region", region)
+        elif message.get("scope") in SCOPES:
+            self.scope = CaptureScope(message["scope"])
+        self.received = time.perf_counter()
+        self.loop = loop
+        self.events: "asyncio.Queue[dict]" = asyncio.Queue()
+        self.closed = False
+
+    def send(self, event: dict) -> None:
+        if not self.closed:
+            self.loop.call_soon_threadsafe(self.events.put_nowait, event)
+
+    def attach(self, worker) -> None:
+        """Relay ``worker``'s answer; chunks are forwarded from the scheduler thread directly"""
+        worker.chunk.connect(self.chunk, Qt.DirectConnection)
+        worker.restarted.connect(self.restarted, Qt.DirectConnection)
+        worker.finished.connect(self.finished, Qt.DirectConnection)
+        worker.error.connect(self.error, Qt.DirectConnection)
+
+    def chunk(self, text: str) -> None:
+        self.send({"event": "chunk", "text": text})
+
+    def restarted(self, model: str) -> None:
+        self.send({"event": "restart", "model": model})
+
+    def finished(self, response: dict) -> None:
+        content = response.get("choices", [{}])[0].get("message", {}).get("content", "")
+        self.send({"event": "done", "id": self.id, "answer": content, "metrics": response.get("metrics", {})})
+
+    def error(self, message: str) -> None:
+        self.send({"event": "error", "id": self.id, "message": message})
+
+
+class IpcServer(QObject):
+    """Unix socket server for ``ask``, ``status``, ``show`` and ``ping`` requests"""
+    # A ClientQuestion for the GUI thread to answer
+    ask_requested = pyqtSignal(object)
+    # The client of a ClientQuestion went away before the answer was complete
+    ask_abandoned = pyqtSignal(object)
+    show_requested = pyqtSignal()
+    # A concurrent Future for the status, resolved on the GUI thread
+    _status_requested = pyqtSignal(object)
+
+    def __init__(self, scheduler: RequestScheduler, status: Callable[[], dict], path: Optional[str] = None,
+                 parent=None):
+        """
+        Args:
+            scheduler: Scheduler whose loop the server runs on
+            status: Returns the instance's status; called on the GUI thread
+            path: Socket path, default ``$XDG_RUNTIME_DIR/glance.sock``
+        """
+        super().__init__(parent)
+        self.scheduler = scheduler
+        self.status = status
+        self.path = path or default_socket_path()
+        self.started = time.time()
+        self.connections = 0
+        self.questions = 0
+        self.abandoned = 0
+        self._ids = itertools.count(1)
+        self._server = None
+        # The server lives on the GUI thread, so the queued slot runs there
+        self._status_requested.connect(self._build_status, Qt.QueuedConnection)
+
+    @classmethod
+    def from_config(cls, options: dict, scheduler: RequestScheduler, status: Callable[[], dict],
+                    parent=None) -> Optional["IpcServer"]:
+        """Build the server from the ``ipc`` config section, or None if disabled"""
+        if not options.get("enabled", True):
+            return None
+        return cls(scheduler, status, path=options.get("path"), parent=parent)
+
+    def start(self) -> bool:
+        """Listen on the socket; False if another Glance already does, or it cannot be created"""
+        try:
+            if self._in_use():
+                logger.warning("Another Glance is listening on %s; not starting the control socket", self.path)
+                return False
+        except OSError as e:
+            logger.warning("Could not remove the stale socket %s: %s", self.path, e)
+            return False
+        try:
+            self.scheduler.run_coroutine(self._listen()).result(timeout=5)
+        except Exception as e:
+            logger.warning("Could not listen on %s: %s", self.path, e)
+            return False
+        atexit.register(self.close)
+        logger.info("Control socket listening on %s", self.path)
+        return True
+
+    def _in_use(self) -> bool:
+        """Whether a live server owns the path; a stale socket file is removed
+
+        Raises:
+            OSError: If the stale file cannot be removed, e.g. it belongs to another user
+        """
+        if not os.path.exists(self.path):
+            return False
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+            return True
+        except OSError:
+            pass
+        finally:
+            probe.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        return False
+
+    @staticmethod
+    def _private_directory(directory: str) -> None:
+        """Create ``directory`` owner-only if missing, and refuse one another user controls
+
+        A sticky directory such as /tmp is accepted: others can create names
+        in it but not replace the socket once it is there.
+        """
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode):
+            raise PermissionError(f"{directory} is not a directory")
+        if info.st_uid != os.getuid() and not info.st_mode & stat.S_ISVTX:
+            raise PermissionError(f"{directory} belongs to another user")
+        if info.st_uid == os.getuid() and info.st_mode & 0o002 and not info.st_mode & stat.S_ISVTX:
+            raise PermissionError(f"{directory} is writable by other users")
+
+    async def _listen(self) -> None:
+        self._private_directory(os.path.dirname(os.path.abspath(self.path)))
+        # Created owner-only: anyone who can connect can read the screen
+        previous = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._handle, path=self.path, limit=MAX_REQUEST_BYTES)
+        finally:
+            os.umask(previous)
+
+    def close(self) -> None:
+        if self._server is None:
+            return
+        server, self._server = self._server, None
+        try:
+            self.scheduler.loop.call_soon_threadsafe(server.close)
+        except RuntimeError:
+            # The loop has already been closed
+            pass
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        return {"path": self.path, "connections": self.connections, "questions": self.questions,
+                "abandoned": self.abandoned}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await self._write(writer, {"event": "error", "message": "Request too long"})
+                    return
+                if not line:
+                    return
+                try:
+                    message = json.loads(line)
+                    op = message.get("op")
+                except (ValueError, AttributeError):
+                    await self._write(writer, {"event": "error", "message": "Requests are JSON objects, one per line"})
+                    continue
+                if op == "ask":
+                    # The reply to an ask ends the connection
+                    await self._ask(message, reader, writer)
+                    return
+                elif op == "status":
+                    await self._write(writer, {"event": "status", **await self._status()})
+                elif op == "show":
+                    self.show_requested.emit()
+                    await self._write(writer, {"event": "shown"})
+                elif op == "ping":
+                    await self._write(writer, {"event": "pong"})
+                else:
+                    await self._write(writer, {"event": "error", "message": f"Unknown op: {op!r}"})
+        except (ConnectionError, BrokenPipeError):
+            pass
+        finally:
+            writer.close()
+
+    async def _ask(self, message: dict, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            question = ClientQuestion(next(self._ids), message, asyncio.get_running_loop())
+        except (TypeError, ValueError):
+            await self._write(writer, {"event": "error", "message": "region must be [x, y, width, height]"})
+            return
+        if not question.prompt:
+            await self._write(writer, {"event": "error", "message": "Empty prompt"})
+            return
+        self.questions += 1
+        await self._write(writer, {"event": "accepted", "id": question.id})
+        # Queued to the GUI thread, which captures the screen and starts the query
+        self.ask_requested.emit(question)
+
+        # A client whose connection is reset abandons its question. End of input
+        # is not a hang-up: a client may shut down its side once it has asked.
+        hangup = asyncio.ensure_future(reader.read(1))
+        try:
+            while True:
+                next_event = asyncio.ensure_future(question.events.get())
+                waiting = {next_event} if hangup is None else {next_event, hangup}
+                await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if hangup is not None and hangup.done() and not next_event.done():
+                    next_event.cancel()
+                    # Raises the reset, if that is what ended the read
+                    data = hangup.result()
+                    # Stray input is ignored until the answer is complete; after
+                    # the end of input there is nothing more to watch
+                    hangup = asyncio.ensure_future(reader.read(1)) if data else None
+                    continue
+                event = next_event.result()
+                await self._write(writer, event)
+                if event["event"] in ("done", "error"):
+                    return
+        except (ConnectionError, BrokenPipeError):
+            question.closed = True
+            self.abandoned += 1
+            self.ask_abandoned.emit(question)
+            raise
+        finally:
+            if hangup is not None:
+                hangup.cancel()
+
+    @staticmethod
+    async def _write(writer: asyncio.StreamWriter, event: dict) -> None:
+        writer.write(json.dumps(event).encode("utf-8") + b"\n")
+        await writer.drain()
+
+    def _build_status(self, future: concurrent.futures.Future) -> None:
+        if not future.set_running_or_notify_cancel():
+            # The request gave up waiting
+            return
+        try:
+            future.set_result(self.status())
+        except Exception as e:
+            logger.exception("Status callback failed")
+            future.set_exception(e)
+
+    async def _status(self) -> dict:
+        # Widget state may only be read on the GUI thread
+        future = concurrent.futures.Future()
+        self._status_requested.emit(future)
+        try:
+            status = await asyncio.wait_for(asyncio.wrap_future(future), STATUS_TIMEOUT)
+        except asyncio.TimeoutError:
+            status = {"status_error": "The GUI did not answer in time"}
+        except Exception as e:
+            status = {"status_error": str(e)}
+        return {"pid": os.getpid(), "uptime_s": round(time.time() - self.started, 1),
+                "ipc": self.stats(), **status}
@@ -1,31 +1,67 @@
 import sys
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtCore import Qt, QTimer
 
-# Import from modular structure
-from widgets.floating_widget import FloatingWidget
-from glance.tray import SystemTray
+# Preprocessing workers are spawned processes that run this file again as
+# __mp_main__; only a real start loads Qt and the widget
+if __name__ == "__main__":
+    # Installed first so the profile covers every import below
+    from glance.startup import StartupProfiler, set_profiler
+    profiler = StartupProfiler.from_argv(sys.argv)
+    set_profiler(profiler)
+
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtCore import Qt, QTimer
+
+    # Import from modular structure
+    from widgets.floating_widget import FloatingWidget
+    from glance.tray import SystemTray
+    from glance.screenshot import get_engine
+    profiler.mark("imports")
 
 class MainApp:
-    def __init__(self):
+    def __init__(self, background=False):
+        """
+        Args:
+            background: Start resident in the tray without showing the window;
+                questions can still come from the control socket
+        """
         self.app = QApplication(sys.argv)
         self.app.setQuitOnLastWindowClosed(False)
+        profiler.mark("qt application")
+        
+        # Pick and cache the screen capture backend before any query is made
+        get_engine().select_backend()
+        profiler.mark("capture backend")
         
         # Create window
         self.window = FloatingWidget()
+        profiler.mark("window")
         
         # Create system tray
         self.tray = SystemTray(self.window)
         self.tray.tray_icon.show()
+        profiler.mark("tray")
         
         # Position window after creating but before showing
         self.position_window()
         
-        self.window.show()
+        if not background:
+            self.window.show()
+            
+            # Ensure window stays on top
+            self.window.raise_()
+            self.window.activateWindow()
+        profiler.mark("show")
         
-        # Ensure window stays on top
-        self.window.raise_()
-        self.window.activateWindow()
+        # Runs once the event loop has painted the window
+        QTimer.singleShot(0, self.on_visible)
+    
+    def on_visible(self):
+        profiler.mark("visible")
+        # Caches, history, the control socket and worker pools, now that the window is up
+        self.window.start_services()
+        profiler.report()
+        # Load the query pipeline while the user is still typing
+        self.window.preload()
     
     def position_window(self):
         # Get screen geometry
@@ -66,5 +102,8 @@ class MainApp:
 
 
 if __name__ == "__main__":
-    app = MainApp()
+    background = "--background" in sys.argv
+    if background:
+        sys.argv.remove("--background")
+    app = MainApp(background=background)
     sys.exit(app.run())
\ No newline at end of file
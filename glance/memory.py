@@ -0,0 +1,321 @@
+"""Resident memory: measurement, per-stage profiling and the idle ceiling.
+
+Glance stays resident all day, so what a query leaves behind matters as much
+as what it costs while it runs. A 4K capture is 33MB of raw pixels; decoding
+it, scaling it, trying several encodes and base64-encoding the winner into a
+JSON body can briefly hold several times that.
+
+* ``rss_bytes`` and ``peak_rss_bytes`` read the kernel's view of the process,
+  which includes Pillow's image buffers; ``tracemalloc`` only sees memory
+  allocated through Python, so ``MemoryProfiler`` records both per stage.
+* ``trim`` collects garbage and returns freed heap pages to the system. glibc
+  keeps freed memory below its (growing) mmap threshold in the heap, so a
+  process that handled one large capture otherwise stays that big.
+* ``MemoryGovernor`` runs in low-memory mode: it trims after each query and
+  drops rebuildable caches while RSS stays above the configured ceiling.
+"""
+import ctypes
+import ctypes.util
+import functools
+import gc
+import logging
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from PyQt5.QtCore import QObject, QTimer
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def _status_bytes(field: str) -> Optional[int]:
+    """A ``kB`` field of /proc/self/status in bytes, or None off Linux"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _max_rss() -> int:
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def rss_bytes() -> int:
+    """Current resident set size of this process
+
+    Falls back to the peak where the current size is not available.
+    """
+    value = _status_bytes("VmRSS")
+    return value if value is not None else _max_rss()
+
+
+def peak_rss_bytes() -> int:
+    """Highest resident set size since start, or since the last ``reset_peak``"""
+    value = _status_bytes("VmHWM")
+    return value if value is not None else _max_rss()
+
+
+def reset_peak() -> bool:
+    """Restart ``peak_rss_bytes`` from the current RSS; False where the kernel cannot"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def usage() -> dict:
+    """Current and peak RSS in megabytes, for status reports"""
+    return {"rss_mb": round(rss_bytes() / MB, 1), "peak_rss_mb": round(peak_rss_bytes() / MB, 1)}
+
+
+@functools.lru_cache(maxsize=None)
+def _malloc_trim() -> Optional[Callable[[int], int]]:
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6").malloc_trim
+    except (OSError, AttributeError):
+        # Not glibc (e.g. musl)
+        return None
+
+
+def trim() -> int:
+    """Collect garbage and give freed heap memory back to the system
+
+    Returns:
+        Bytes of RSS released
+    """
+    before = rss_bytes()
+    gc.collect()
+    malloc_trim = _malloc_trim()
+    if malloc_trim is not None:
+        malloc_trim(0)
+    return max(0, before - rss_bytes())
+
+
+class StageReport(NamedTuple):
+    """Memory use of one profiled stage"""
+    name: str
+    elapsed_ms: float
+    rss_before: int
+    rss_after: int
+    # Highest RSS during the stage, None where it cannot be reset per stage
+    peak_rss: Optional[int]
+    # Python allocations: high-water mark over the starting level, and net change
+    traced_peak: int
+    traced_delta: int
+    # (file:line, bytes, blocks) allocated in the stage and still alive at its end
+    top: List[Tuple[str, int, int]]
+
+    def report(self) -> dict:
+        return {
+            "elapsed_ms": round(self.elapsed_ms, 2),
+            "rss_before_mb": round(self.rss_before / MB, 1),
+            "rss_after_mb": round(self.rss_after / MB, 1),
+            "peak_rss_mb": round(self.peak_rss / MB, 1) if self.peak_rss is not None else None,
+            "peak_over_before_mb": round((self.peak_rss - self.rss_before) / MB, 1) if self.peak_rss is not None else None,
+            "traced_peak_mb": round(self.traced_peak / MB, 2),
+            "traced_delta_mb": round(self.traced_delta / MB, 2),
+            "top": [{"location": location, "kb": size // 1024, "blocks": count} for location, size, count in self.top],
+        }
+
+
+class MemoryProfiler:
+    """Records RSS and tracemalloc figures for named stages of a pipeline
+
+    Usage::
+
+        profiler = MemoryProfiler()
+        with profiler.stage("encode"):
+            encoded = encode_for_budget(frame, budget)
+        print(profiler.stages[-1].report())
+
+    The top allocators are what the stage allocated and still held when it
+    ended, so keep the stage's result alive until the block exits.
+    """
+
+    def __init__(self, top: int = 5, trace: bool = True, frames: int = 1, settle: bool = False):
+        """
+        Args:
+            top: Allocation sites listed per stage
+            trace: Use tracemalloc; without it only RSS is recorded, at no overhead
+            frames: Stack frames stored per allocation; more locate allocations
+                better and slow the program down more
+            settle: ``trim`` before each stage, so its RSS figures are not hidden
+                by heap that earlier stages freed but the process kept
+        """
+        self.top = top
+        self.trace = trace
+        self.frames = frames
+        self.settle = settle
+        self.stages: List[StageReport] = []
+        self._started_tracing = False
+
+    def start(self) -> None:
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracing = True
+
+    def stop(self) -> None:
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+
+    @contextmanager
+    def stage(self, name: str):
+        self.start()
+        if self.settle:
+            trim()
+        tracing = tracemalloc.is_tracing()
+        before_snapshot = self._snapshot() if tracing else None
+        if tracing:
+            tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0] if tracing else 0
+        exact_peak = reset_peak()
+        rss_before = rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            rss_after = rss_bytes()
+            peak = max(peak_rss_bytes(), rss_after) if exact_peak else None
+            top = []
+            traced_peak = traced_delta = 0
+            if tracing:
+                traced, traced_peak = tracemalloc.get_traced_memory()
+                traced_peak -= traced_before
+                traced_delta = traced - traced_before
+                for diff in self._snapshot().compare_to(before_snapshot, "lineno")[:self.top]:
+                    if diff.size_diff <= 0:
+                        break
+                    frame = diff.traceback[0]
+                    top.append((f"{frame.filename}:{frame.lineno}", diff.size_diff, diff.count_diff))
+            self.stages.append(StageReport(name, elapsed_ms, rss_before, rss_after, peak,
+                                           traced_peak, traced_delta, top))
+
+
+class MemoryGovernor(QObject):
+    """Holds the widget's resident memory under a ceiling while it is idle
+
+    A short while after each query the governor collects garbage and returns
+    the freed heap to the system. If RSS is still above the ceiling, it calls
+    the registered releasers (caches that can be rebuilt, in the order they
+    were added) one at a time until it fits. The same check runs
+    periodically, skipped while a query is in flight.
+    """
+
+    def __init__(self, ceiling_mb: float = 256, idle_delay_ms: int = 2000, check_interval_s: float = 60,
+                 busy: Optional[Callable[[], bool]] = None, parent=None):
+        """
+        Args:
+            ceiling_mb: Idle RSS to stay under
+            idle_delay_ms: Wait after a query before trimming, so follow-ups do not pay for it
+            check_interval_s: Seconds between periodic checks, 0 for none
+            busy: Returns True while a query runs; checks are skipped then
+        """
+        super().__init__(parent)
+        self.ceiling = int(ceiling_mb * MB)
+        self.busy = busy or (lambda: False)
+        self._releasers: List[Tuple[str, Callable[[], None]]] = []
+        self.checks = 0
+        self.trimmed_bytes = 0
+        self.releases: Dict[str, int] = {}
+        self.over_ceiling = 0
+        self.last_rss: Optional[int] = None
+
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(idle_delay_ms)
+        self.idle_timer.timeout.connect(lambda: self.check(after_query=True))
+        self.timer = QTimer(self)
+        self.timer.setInterval(int(check_interval_s * 1000))
+        self.timer.timeout.connect(self.check)
+        self.check_interval_s = check_interval_s
+
+    @classmethod
+    def from_config(cls, options: dict, busy=None, parent=None) -> Optional["MemoryGovernor"]:
+        """Build the governor from the ``memory`` config section, or None outside low-memory mode"""
+        if not options.get("low_memory", False):
+            return None
+        return cls(ceiling_mb=options.get("idle_rss_mb", 256), idle_delay_ms=options.get("idle_delay_ms", 2000),
+                   check_interval_s=options.get("check_interval_s", 60), busy=busy, parent=parent)
+
+    def add_releaser(self, name: str, release: Callable[[], None]) -> None:
+        """Register a cache to drop when trimming alone does not reach the ceiling"""
+        self._releasers.append((name, release))
+
+    def start(self) -> None:
+        if self.check_interval_s > 0:
+            self.timer.start()
+
+    def stop(self) -> None:
+        self.timer.stop()
+        self.idle_timer.stop()
+
+    def query_done(self) -> None:
+        """Check once the widget has been idle for a moment; each query restarts the wait"""
+        self.idle_timer.start()
+
+    def check(self, after_query: bool = False) -> Optional[int]:
+        """Bring RSS under the ceiling if possible
+
+        Args:
+            after_query: Trim even under the ceiling; a query just freed its buffers
+
+        Returns:
+            RSS afterwards, or None if a query was running
+        """
+        if self.busy():
+            return None
+        self.checks += 1
+        rss = rss_bytes()
+        if after_query or rss > self.ceiling:
+            self.trimmed_bytes += trim()
+            rss = rss_bytes()
+        for name, release in self._releasers:
+            if rss <= self.ceiling:
+                break
+            release()
+            self.releases[name] = self.releases.get(name, 0) + 1
+            self.trimmed_bytes += trim()
+            rss = rss_bytes()
+            logger.info("Released %s; RSS now %.0fMB", name, rss / MB)
+        if rss > self.ceiling:
+            self.over_ceiling += 1
+            logger.warning("Idle RSS %.0fMB is above the %.0fMB ceiling", rss / MB, self.ceiling / MB)
+        self.last_rss = rss
+        return rss
+
+    def stats(self) -> dict:
+        return {
+            **usage(),
+            "ceiling_mb": round(self.ceiling / MB, 1),
+            "checks": self.checks,
+            "trimmed_mb": round(self.trimmed_bytes / MB, 1),
+            "releases": dict(self.releases),
+            "over_ceiling": self.over_ceiling,
+        }
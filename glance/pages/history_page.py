@@ -0,0 +1,72 @@
+# pages/history_page.py
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QLineEdit
+from PyQt5.QtCore import QTimer
+
+from widgets.history_view import HistoryModel, HistoryView
+
+
+class HistoryPage(QWidget):
+    """Search through every stored question and answer"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.parent = parent
+        self.store = self.parent.history_store
+        self.model = HistoryModel(self.store, page_size=self.parent.config.get("history", {}).get("page_size", 20))
+        # Search once typing pauses rather than on every key
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.search)
+        self.init_ui()
+
+    def init_ui(self):
+        history_layout = QVBoxLayout(self)
+        history_layout.setContentsMargins(10, 10, 10, 10)
+
+        history_header = QHBoxLayout()
+        history_title = QLabel("History")
+        history_title.setStyleSheet("font-weight: bold; font-size: 14px;")
+        back_button = QPushButton("Back")
+        back_button.clicked.connect(self.parent.show_main_page)
+        history_header.addWidget(history_title)
+        history_header.addStretch()
+        history_header.addWidget(back_button)
+
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Search questions and answers...")
+        self.search_input.setClearButtonEnabled(True)
+        self.search_input.textChanged.connect(self.search_timer.start)
+        self.search_input.returnPressed.connect(self.search)
+
+        self.result_label = QLabel()
+        self.result_label.setStyleSheet("font-size: 11px;")
+
+        self.results = HistoryView(self.model)
+        self.results.opened.connect(self.open_entry)
+
+        history_layout.addLayout(history_header)
+        history_layout.addWidget(self.search_input)
+        history_layout.addWidget(self.result_label)
+        history_layout.addWidget(self.results)
+
+    def refresh(self):
+        """Show the latest entries, or the current search again, when the page is shown"""
+        self.search_input.setFocus()
+        self.search()
+
+    def search(self):
+        self.search_timer.stop()
+        text = self.search_input.text().strip()
+        if text:
+            self.model.set_source(self.store.matching(text))
+            self.result_label.setText(f"{len(self.model.source)} matching")
+        else:
+            self.model.set_source(self.store)
+            self.result_label.setText(f"{len(self.store)} questions")
+        # The view fetches further pages as it scrolls
+        self.model.fetchMore()
+
+    def open_entry(self, entry):
+        self.parent.show_main_page()
+        self.parent.main_page.show_entry(entry)
@@ -1,19 +1,66 @@
 # pages/main_page.py
+import time
+from collections import deque
+
 from PyQt5.QtWidgets import (
-    QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, QPushButton
+    QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, QPushButton, QComboBox, QSplitter
 )
 from PyQt5.QtCore import Qt
 from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QTextCharFormat, QTextCursor
 from PyQt5.QtWidgets import QApplication
 
-from glance.api import ApiWorker
+from glance.history import AnswerHistory, HistoryEntry
+from glance.richtext import MarkdownRenderer, stable_length
 from glance.screenshot import take_screenshot
+from glance.scope import SCOPES, SCOPE_LABELS, CaptureScope
+from glance.session import Session
+from glance.tracing import get_tracer
+from widgets.history_view import HistoryModel, HistoryView
+from widgets.region_selector import RegionSelector
+
+
+def utf16_length(text):
+    """Length of ``text`` in document positions"""
+    return len(text.encode("utf-16-le")) // 2
 
 class MainPage(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.parent = parent
+        # Compares each capture with the previous one to find what changed (opt-in)
+        self.change_options = self.parent.config.get("change_regions", {})
+        # Built on first use; NumPy is not needed to show the window
+        self.change_detector = None
+        # When the detector last saw a capture, to tell follow-ups from fresh questions
+        self.last_capture_at = None
+        # The query currently in flight, if any
+        self.worker = None
+        # Socket client waiting for that query's answer, if it came from one
+        self.listener = None
+        # Socket questions waiting for the query in flight to end
+        self.client_questions = deque()
+        # Whether the window is hidden for a capture that has not been taken yet
+        self.capturing = False
+        # Overlay for drawing a capture region, while one is open
+        self.region_selector = None
+        # Conversation continued by follow-ups while chat mode is on
+        self.session_options = self.parent.config.get("session", {})
+        self.session = Session.from_config(self.session_options)
+        # Markdown is converted to rich text on a worker thread, once per answer
+        self.renderer = MarkdownRenderer()
+        self.renderer.rendered.connect(self.apply_rendered)
+        # Increments for every answer shown, so renders of a replaced one are dropped
+        self.answer_id = 0
+        # Earlier answers, loaded into the history pane a page at a time; stored
+        # across sessions unless the history database is disabled
+        self.history_options = self.parent.config.get("history", {})
+        # The parent swaps in its history database once that is open
+        source = AnswerHistory(self.history_options.get("max_entries", 1000))
+        self.history = HistoryModel(source, page_size=self.history_options.get("page_size", 20))
+        self.question = ""
         self.init_ui()
+        self.begin_answer()
 
     def init_ui(self):
         main_layout = QVBoxLayout(self)
@@ -30,20 +77,84 @@ class MainPage(QWidget):
         submit_button = QPushButton("Ask")
         submit_button.clicked.connect(self.process_query)
 
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_query)
+
         input_layout = QHBoxLayout()
         input_layout.addWidget(self.query_input)
         input_layout.addWidget(submit_button)
+        input_layout.addWidget(self.cancel_button)
 
         self.response_text = QTextEdit()
         self.response_text.setReadOnly(True)
         self.response_text.setPlaceholderText("Responses will appear here.")
 
+        self.history_view = HistoryView(self.history)
+        self.history_view.opened.connect(self.show_entry)
+        self.history_view.hide()
+        self.response_splitter = QSplitter(Qt.Vertical)
+        self.response_splitter.addWidget(self.response_text)
+        self.response_splitter.addWidget(self.history_view)
+        self.response_splitter.setStretchFactor(0, 2)
+        self.response_splitter.setStretchFactor(1, 1)
+
+        # What part of the screen to capture; the choice lasts for the session
+        self.scope_picker = QComboBox()
+        for kind in SCOPES:
+            self.scope_picker.addItem(SCOPE_LABELS[kind], kind)
+        self.scope_picker.setCurrentIndex(SCOPES.index(self.parent.default_scope.kind))
+        self.scope_picker.activated.connect(self.choose_scope)
+
+        # Follow-ups continue the conversation; unchecking starts over
+        self.chat_button = QPushButton("Chat")
+        self.chat_button.setCheckable(True)
+        self.chat_button.setChecked(self.session_options.get("enabled", False))
+        self.chat_button.setToolTip("Follow-up questions reuse the screenshot until the screen changes")
+        self.chat_button.toggled.connect(self.toggle_session)
+
+        self.history_button = QPushButton("History")
+        self.history_button.setCheckable(True)
+        self.history_button.setToolTip("Earlier answers; double-click one to show it again")
+        self.history_button.toggled.connect(self.history_view.setVisible)
+
         settings_button = QPushButton("Settings")
         settings_button.clicked.connect(self.parent.show_settings_page)
 
+        bottom_layout = QHBoxLayout()
+        bottom_layout.addWidget(self.scope_picker)
+        bottom_layout.addWidget(self.chat_button)
+        bottom_layout.addWidget(self.history_button)
+        bottom_layout.addWidget(settings_button)
+
         main_layout.addLayout(input_layout)
-        main_layout.addWidget(self.response_text)
-        main_layout.addWidget(settings_button)
+        main_layout.addWidget(self.response_splitter)
+        main_layout.addLayout(bottom_layout)
+
+    def toggle_session(self, enabled):
+        if not enabled:
+            self.session.reset()
+
+    def choose_scope(self, index):
+        kind = self.scope_picker.itemData(index)
+        if kind != "region":
+            self.parent.scope_tracker.set_scope(CaptureScope(kind))
+            return
+        # Choosing "Region..." again draws a new region
+        self.region_selector = RegionSelector()
+        self.region_selector.selected.connect(self.set_region)
+        self.region_selector.cancelled.connect(self.restore_scope_picker)
+        self.region_selector.start()
+
+    def set_region(self, rect):
+        self.region_selector = None
+        self.parent.scope_tracker.set_scope(CaptureScope("region", rect))
+        self.scope_picker.setCurrentIndex(SCOPES.index("region"))
+        self.scope_picker.setToolTip(f"{rect[2]}x{rect[3]} at {rect[0]},{rect[1]}")
+
+    def restore_scope_picker(self):
+        self.region_selector = None
+        self.scope_picker.setCurrentIndex(SCOPES.index(self.parent.scope_tracker.scope.kind))
 
     def eventFilter(self, obj, event):
         if obj == self.query_input and event.type() == event.KeyPress:
@@ -53,15 +164,55 @@ class MainPage(QWidget):
         return super().eventFilter(obj, event)
 
     def process_query(self):
-        query = self.query_input.toPlainText()
+        self.ask(self.query_input.toPlainText())
+
+    def ask(self, query, listener=None):
+        """Capture the screen and ask ``query`` about it
+
+        Args:
+            listener: Socket client (``glance.ipc.ClientQuestion``) the answer is
+                also relayed to; its scope, if any, overrides the picker's
+        """
         if not query:
-            self.response_text.setText("Please enter a question.")
+            self.fail("Please enter a question.", listener)
+            return
+
+        # Local servers usually run without a key, but still need an endpoint
+        if self.parent.model_provider == 'local':
+            configured = bool(self.parent.api_endpoint)
+        else:
+            configured = bool(self.parent.api_key)
+        if not configured:
+            self.fail("Please configure API settings first.", listener)
             return
 
-        if not self.parent.api_key:
-            self.response_text.setText("Please configure API settings first.")
+        trace = get_tracer().trace("query", provider=self.parent.model_provider, prompt_chars=len(query),
+                                   source="socket" if listener is not None else "widget")
+        scope = (listener.scope if listener is not None else None) or self.parent.scope_tracker.scope
+        # None captures the whole desktop
+        rect = self.parent.scope_tracker.rect(scope)
+        if self.parent.capture_options.get("mode", "mask") != "hide":
+            # Use a frame from before the widget was focused, or capture now and
+            # blank out our own window; either way there is no hide-and-wait
+            with trace.child("capture", scope=scope.describe()) as span:
+                frame = None
+                if self.parent.background_capture is not None:
+                    frame = self.parent.background_capture.frame_for_query()
+                    if frame is not None and rect is not None:
+                        frame = frame.crop(rect)
+                span.set(source="ring" if frame is not None else "screen")
+                if frame is None:
+                    frame = take_screenshot(rect)
+                if frame is not None:
+                    # Resident in the tray, there is no window to blank out
+                    if self.parent.isVisible():
+                        frame = frame.masked(self.parent.capture_exclusion_rect(rect))
+                    span.set(pixels=frame.width * frame.height)
+            self.process_frame(query, frame, trace, listener)
             return
 
+        # Busy from here: processing events below may deliver another question
+        self.capturing = True
         # Store current opacity
         current_opacity = self.parent.windowOpacity()
         
@@ -72,47 +223,340 @@ class MainPage(QWidget):
         QApplication.processEvents()
         
         # Small delay to ensure window is hidden
-        QTimer.singleShot(100, lambda: self.take_screenshot_and_process(query, current_opacity))
+        QTimer.singleShot(100, lambda: self.take_screenshot_and_process(query, current_opacity, trace, rect,
+                                                                        scope, listener))
 
-    def take_screenshot_and_process(self, query, original_opacity):
+    def take_screenshot_and_process(self, query, original_opacity, trace=None, rect=None, scope=None,
+                                    listener=None):
+        self.capturing = False
         # Take screenshot while window is invisible
-        screenshot_path = take_screenshot()
+        with get_tracer().span("capture", parent=trace, source="hide",
+                               scope=(scope or self.parent.scope_tracker.scope).describe()):
+            frame = take_screenshot(rect)
         
         # Restore window opacity
         self.parent.setWindowOpacity(original_opacity)
         
-        if not screenshot_path:
-            self.response_text.setText("Failed to take screenshot.")
+        self.process_frame(query, frame, trace, listener)
+
+    def fail(self, message, listener=None):
+        """Show why a query could not be made, and tell its socket client"""
+        self.show_message(message)
+        if listener is not None:
+            listener.error(message)
+            QTimer.singleShot(0, self.next_client_question)
+
+    def busy(self):
+        """Whether a query is in flight, or about to be"""
+        return self.worker is not None or self.capturing
+
+    def ask_client(self, question):
+        """Ask a socket client's question now, or once the query in flight ends
+
+        Socket questions never supersede one another, nor a typed question.
+        """
+        if self.busy() or self.client_questions:
+            self.client_questions.append(question)
+            question.send({"event": "queued", "id": question.id, "position": len(self.client_questions)})
             return
+        self.ask(question.prompt, listener=question)
+
+    def next_client_question(self):
+        """Start the oldest queued socket question whose client is still waiting"""
+        while self.client_questions and not self.busy():
+            question = self.client_questions.popleft()
+            if not question.closed:
+                self.ask(question.prompt, listener=question)
+
+    def release_listener(self, message):
+        """Tell the socket client of the query in flight that no answer is coming"""
+        if self.listener is not None:
+            self.listener.error(message)
+            self.listener = None
+
+    def process_frame(self, query, frame, trace=None, listener=None):
+        if trace is None:
+            trace = get_tracer().trace("query", provider=self.parent.model_provider, prompt_chars=len(query))
+        if frame is None:
+            trace.finish(error="capture failed")
+            self.fail("Failed to take screenshot.", listener)
+            return
+        if self.parent.archive is not None:
+            self.parent.archive.add(frame)
+
+        with trace.child("change_regions"):
+            detail = self.changed_region(frame)
+
+        # A new question supersedes the one in flight
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.trace.finish(status="superseded")
+            self.release_listener("Superseded by a newer question")
 
         # Show loading state
-        self.response_text.setText("Processing your request...")
-        self.query_input.setEnabled(False)
+        self.show_message("Processing your request...")
+        self.question = query
+        self.cancel_button.setEnabled(True)
 
+        # Imported here so provider clients load after the window is up
+        from glance.api import ApiWorker
         self.worker = ApiWorker(
             self.parent.api_endpoint, 
             self.parent.api_key, 
-            screenshot_path, 
+            frame, 
             query, 
-            self.parent.model_provider
+            self.parent.model_provider,
+            image_budgets=self.parent.config.get("image_budgets"),
+            registry=self.parent.providers,
+            cache=self.parent.response_cache if listener is None or listener.use_cache else None,
+            detail=detail,
+            scheduler=self.parent.scheduler,
+            deadline=self.parent.config.get("request_deadline", 60),
+            hedge=self.parent.hedge,
+            trace=trace,
+            session=self.session if self.chat_button.isChecked() else None,
+            router=self.parent.router,
+            preprocess=self.parent.preprocess,
+            low_memory=self.parent.low_memory
         )
+        self.streaming = False
+        self.listener = listener
+        if listener is not None:
+            listener.attach(self.worker)
+        self.worker.chunk.connect(self.append_response_chunk)
+        self.worker.restarted.connect(self.restart_response)
         self.worker.finished.connect(self.display_response)
         self.worker.error.connect(self.handle_error)
         self.worker.start()
 
-    def display_response(self, response):
-        self.query_input.setEnabled(True)
-        if self.parent.model_provider == 'gemini':
-            # Gemini response is already formatted
-            content = response.get("choices", [{}])[0].get("message", {}).get("content", "No response")
+    def cancel_query(self):
+        if self.worker is None:
+            return
+        self.worker.cancel()
+        self.worker.trace.finish(status="cancelled")
+        self.worker = None
+        self.release_listener("Cancelled")
+        self.query_ended()
+        self.cancel_button.setEnabled(False)
+        if self.streaming:
+            # Keep what arrived, formatted
+            self.finish_answer()
         else:
-            # OpenAI response
-            content = response.get("choices", [{}])[0].get("message", {}).get("content", "No response")
-        self.response_text.setText(content)
+            self.show_message("Request cancelled.")
+
+    def abandon(self, listener):
+        """Stop the query a socket client stopped waiting for"""
+        if listener in self.client_questions:
+            self.client_questions.remove(listener)
+        elif listener is not None and listener is self.listener:
+            self.listener = None
+            self.cancel_query()
+
+    def is_current(self):
+        """Whether the signal being handled comes from the query in flight"""
+        return self.worker is not None and self.sender() is self.worker
+
+    def append_response_chunk(self, text):
+        if not self.is_current():
+            return
+        start = time.perf_counter()
+        if not self.streaming:
+            # Replace the loading message with the first piece of the answer
+            self.streaming = True
+            self.begin_answer()
+        self.append_answer(text)
+        # Chunk rendering is too fine-grained for spans; total it on the trace
+        self.worker.trace.add("render_chunks_ms", (time.perf_counter() - start) * 1000)
+
+    def restart_response(self, model):
+        """Drop a bad partial answer while a stronger model is asked"""
+        if not self.is_current():
+            return
+        self.streaming = False
+        self.show_message(f"Asking {model}...")
+
+    def changed_region(self, frame):
+        """Crop of the area that changed since the last capture, if it is small enough to send separately
+
+        Only follow-ups asked within ``change_regions.follow_up_s`` of the
+        previous capture get one; any other question sends the full screen at
+        full detail.
+        """
+        if not self.change_options.get("enabled", False):
+            return None
+        if self.change_detector is None:
+            from glance.regions import ChangeDetector
+            self.change_detector = ChangeDetector(tile_size=self.change_options.get("tile_size", 64))
+        now = time.monotonic()
+        follow_up = self.last_capture_at is not None and \
+            now - self.last_capture_at <= self.change_options.get("follow_up_s", 120)
+        self.last_capture_at = now
+        change = self.change_detector.update(frame)
+        if not follow_up or not change.is_partial(self.change_options.get("max_fraction", 0.3)):
+            return None
+        return frame.crop(change.bounding_box(margin=self.change_options.get("margin", 32)))
+
+    def reset_change_detector(self):
+        """Forget the last screen seen; the next question is sent without a detail crop"""
+        if self.change_detector is not None:
+            self.change_detector.reset()
+
+    def display_response(self, response):
+        if not self.is_current():
+            return
+        trace = self.worker.trace
+        frame = self.worker.frame
+        self.worker = None
+        # The listener got the answer straight from the worker
+        self.listener = None
+        self.cancel_button.setEnabled(False)
+        content = response.get("choices", [{}])[0].get("message", {}).get("content", "No response")
+        metrics = response.get("metrics", {})
+        model = metrics.get("routing", {}).get("model", "")
+        self.history.add(HistoryEntry(self.question, content, time.time(), model, self.parent.model_provider,
+                                      metrics.get("ttft_ms"), metrics.get("total_ms")),
+                         frame=frame, metrics=metrics)
+        with trace.child("render", streamed=self.streaming):
+            if self.streaming:
+                # The answer is already on screen; format what is still plain
+                self.finish_answer()
+            else:
+                self.show_answer(content)
+        trace.finish()
+        self.query_ended()
 
     def handle_error(self, error_msg):
-        self.query_input.setEnabled(True)
-        self.response_text.setText(f"Error: {error_msg}")
+        if not self.is_current():
+            return
+        self.worker.trace.finish(error=error_msg)
+        self.worker = None
+        self.listener = None
+        self.cancel_button.setEnabled(False)
+        self.show_message(f"Error: {error_msg}")
+        self.query_ended()
+
+    def query_ended(self):
+        """Let the memory governor reclaim what the query used, once things are quiet"""
+        if self.parent.memory is not None:
+            self.parent.memory.query_done()
+        if self.client_questions:
+            QTimer.singleShot(0, self.next_client_question)
+
+    def show_message(self, message):
+        """Replace the response area with a status or error message"""
+        self.begin_answer()
+        self.response_text.setPlainText(message)
+
+    def show_entry(self, entry):
+        """Show an answer from the history again"""
+        if self.worker is not None:
+            # The answer streaming in keeps the response area
+            return
+        self.query_input.setPlainText(entry.question)
+        self.show_answer(entry.answer)
+
+    def show_answer(self, text):
+        """Show a whole answer: as plain text at once, formatted once the worker has converted it"""
+        self.begin_answer()
+        self.append_answer(text, render=False)
+        self.finish_answer()
+
+    def begin_answer(self):
+        """Start a new answer in an empty response area
+
+        While an answer is shown, the document holds its formatted part
+        followed by the rest as plain text, which starts at ``plain_start``.
+        Complete blocks are sent to the renderer as they arrive and their
+        plain text is swapped for the HTML when it comes back, so the
+        document is only ever edited near its end.
+        """
+        self.answer_id += 1
+        self.answer_text = ""
+        # Characters of answer_text sent to the renderer, and formatted in the document
+        self.submitted_upto = 0
+        self.applied_upto = 0
+        self.plain_start = 0
+        self.answer_done = False
+        # Rendered fragments waiting for an earlier one, by start offset
+        self.pending_fragments = {}
+        self.fragments = []
+        self.response_text.clear()
+
+    def append_answer(self, text, render=True):
+        """Append plain text to the answer, and render any blocks it completes"""
+        text = text.replace("\r\n", "\n")
+        self.answer_text += text
+        # Append at the end of the document instead of re-rendering it
+        cursor = self.response_text.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text, QTextCharFormat())
+        self.response_text.setTextCursor(cursor)
+        if render:
+            # Offsets past submitted_upto are outside any code fence, so the scan can start there
+            stable = stable_length(self.answer_text[self.submitted_upto:])
+            if stable:
+                self.submit_fragment(self.submitted_upto + stable)
+
+    def finish_answer(self):
+        """Render whatever of the answer is still plain text"""
+        self.answer_done = True
+        if self.submitted_upto < len(self.answer_text):
+            self.submit_fragment(len(self.answer_text))
+
+    def submit_fragment(self, end):
+        start, self.submitted_upto = self.submitted_upto, end
+        whole = start == 0 and end == len(self.answer_text) and self.answer_done
+        self.renderer.render(self.answer_text[start:end], token=(self.answer_id, start, end), cache=whole)
+
+    def apply_rendered(self, token, html):
+        """Swap a fragment's plain text for its HTML, in answer order"""
+        answer_id, start, end = token
+        if answer_id != self.answer_id:
+            return
+        self.pending_fragments[start] = (end, html)
+        while self.applied_upto in self.pending_fragments:
+            end, html = self.pending_fragments.pop(self.applied_upto)
+            last = self.answer_done and end == len(self.answer_text)
+            self.replace_plain(utf16_length(self.answer_text[self.applied_upto:end]), html,
+                               utf16_length(self.answer_text[end:]), last)
+            self.applied_upto = end
+            self.fragments.append(html)
+            if last and len(self.fragments) > 1:
+                # Shown again from the history, the answer is converted in one go
+                self.renderer.store(self.answer_text, "".join(self.fragments))
+
+    def replace_plain(self, length, html, tail, last):
+        """Replace ``length`` positions of plain text at ``plain_start`` with ``html``
+
+        Args:
+            tail: Length of the plain text after the replaced part
+            last: Whether this completes the answer
+        """
+        scrollbar = self.response_text.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum()
+        cursor = QTextCursor(self.response_text.document())
+        cursor.beginEditBlock()
+        cursor.setPosition(self.plain_start)
+        if last:
+            cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+        else:
+            cursor.setPosition(self.plain_start + length, QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+        if not last:
+            # Keep the plain text still streaming in its own block after the HTML
+            cursor.insertBlock()
+            cursor.movePosition(QTextCursor.PreviousCharacter)
+        block = cursor.block()
+        cursor.insertHtml(html)
+        if block.length() == 1 and block.next().textList() is not None:
+            # A list inserted into an empty block starts a block of its own
+            cleanup = QTextCursor(block)
+            cleanup.movePosition(QTextCursor.NextCharacter, QTextCursor.KeepAnchor)
+            cleanup.removeSelectedText()
+        cursor.endEditBlock()
+        self.plain_start = self.response_text.document().characterCount() - 1 - tail
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
 
     def adjust_input_height(self):
         # Calculate required height based on content
@@ -27,7 +27,7 @@ class SettingsPage(QWidget):
         
         # Add model provider selection
         self.settings_model_provider = QLineEdit()
-        self.settings_model_provider.setPlaceholderText("openai or gemini")
+        self.settings_model_provider.setPlaceholderText("openai, gemini or local")
         self.settings_model_provider.textChanged.connect(self.on_model_provider_changed)
 
         self.settings_api_endpoint = QLineEdit()
@@ -62,6 +62,9 @@ class SettingsPage(QWidget):
         if text.lower() == 'gemini':
             self.settings_api_endpoint.setEnabled(False)
             self.settings_api_endpoint.setPlaceholderText("Not required for Gemini API")
+        elif text.lower() == 'local':
+            self.settings_api_endpoint.setEnabled(True)
+            self.settings_api_endpoint.setPlaceholderText("e.g. http://localhost:8080/v1/chat/completions")
         else:
             self.settings_api_endpoint.setEnabled(True)
             self.settings_api_endpoint.setPlaceholderText("Required for OpenAI API")
@@ -69,8 +72,8 @@ class SettingsPage(QWidget):
     def save_settings(self):
         # Validate model provider
         model_provider = self.settings_model_provider.text().lower()
-        if model_provider not in ['openai', 'gemini']:
-            self.parent.main_page.response_text.setText("Error: Model provider must be either 'openai' or 'gemini'")
+        if model_provider not in ['openai', 'gemini', 'local']:
+            self.parent.main_page.response_text.setText("Error: Model provider must be 'openai', 'gemini' or 'local'")
             self.parent.show_main_page()
             return
 
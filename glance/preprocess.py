@@ -0,0 +1,318 @@
+"""Image preprocessing in worker processes.
+
+``encode_for_budget`` runs its resizes and encodes on the thread of the
+query. Pillow releases the GIL for parts of that work but not all of it, and
+it uses one core, so on 5K and multi-monitor desktops a query takes hundreds
+of milliseconds to prepare its image and the widget stutters meanwhile.
+
+``PreprocessPool`` does the same work in a warm pool of worker processes:
+
+* The captured pixels are copied once into shared memory, and workers read
+  them in place with ``Image.frombuffer``. Nothing large is pickled; only the
+  encoded candidates travel back.
+* Downscaling is split the way Pillow itself works, in two passes: the
+  width is scaled in bands of rows, then the height in bands of columns,
+  one band per worker, each written straight into a shared image. Every
+  output pixel gets exactly the filter weights of a whole-image resize, so
+  the result is identical to the in-thread encoder's. (Bands of rows scaled
+  in one pass are not: Pillow places the filter of a band relative to its
+  own box, and rounding moves pixels by one level.)
+* The candidates of a step of the encode ladder (PNG, then WebP and JPEG at
+  each quality) are encoded concurrently and the first one in preference
+  order that fits is taken, so the wall-clock cost of a step is that of its
+  slowest useful encode rather than the sum of all of them.
+
+PNG, WebP and JPEG files cannot be assembled from separately encoded tiles
+with Pillow, so each candidate is a single encode; the parallelism is across
+bands for the resize and across candidates for the encode. The result is the
+same ``EncodedImage`` the in-thread encoder returns. Frames smaller than
+``min_pixels`` are encoded in-thread, where they are cheaper than a
+round-trip to the pool.
+
+Workers are spawned, which runs the main script again in each of them;
+``main.py`` only loads Qt when started directly, so they stay small.
+"""
+import atexit
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+from io import BytesIO
+from multiprocessing import shared_memory
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from .encoder import Candidate, EncodeBudget, EncodedImage, encode_for_budget, encode_ladder
+from .frame import Frame
+
+logger = logging.getLogger(__name__)
+
+
+class ImageSpec(NamedTuple):
+    """Where a raw image lives in shared memory, and its layout"""
+    name: str
+    width: int
+    height: int
+    raw_mode: str
+    stride: int
+
+
+class SharedImage:
+    """Raw pixels in a shared memory block, owned by the parent process"""
+
+    def __init__(self, size: int):
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, size))
+        self.spec: Optional[ImageSpec] = None
+
+    @classmethod
+    def from_frame(cls, frame: Frame) -> "SharedImage":
+        """Copy the frame's captured pixels into shared memory (the only copy made)"""
+        buffer = frame.buffer
+        data = memoryview(buffer.data).cast("B")
+        shared = cls(len(data))
+        shared.memory.buf[:len(data)] = data
+        shared.spec = ImageSpec(shared.memory.name, buffer.width, buffer.height, buffer.raw_mode, buffer.stride)
+        return shared
+
+    @classmethod
+    def blank(cls, size: Tuple[int, int]) -> "SharedImage":
+        """Room for an RGB image of ``size``, to be filled by workers"""
+        width, height = size
+        shared = cls(width * height * 3)
+        shared.spec = ImageSpec(shared.memory.name, width, height, "RGB", width * 3)
+        return shared
+
+    def release(self) -> None:
+        self.memory.close()
+        try:
+            self.memory.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _open(spec: ImageSpec, top: int = 0, bottom: Optional[int] = None):
+    """Map rows ``top:bottom`` of a shared image in a worker; close the memory once the image is dropped"""
+    from PIL import Image
+
+    bottom = spec.height if bottom is None else bottom
+    memory = shared_memory.SharedMemory(name=spec.name)
+    rows = memory.buf[top * spec.stride:bottom * spec.stride]
+    image = Image.frombuffer("RGB", (spec.width, bottom - top), rows, "raw", spec.raw_mode, spec.stride, 1)
+    del rows
+    return memory, image
+
+
+def _warm() -> int:
+    """Load Pillow and its codecs in a worker before the first query needs them"""
+    from PIL import Image, features
+
+    features.check("webp")
+    Image.new("RGB", (8, 8)).save(BytesIO(), format="PNG")
+    return os.getpid()
+
+
+def _scale_rows(source: ImageSpec, target: ImageSpec, top: int, bottom: int) -> None:
+    """First pass: scale rows ``top:bottom`` of ``source`` to the width of the shared ``target``"""
+    from PIL import Image
+
+    memory, image = _open(source, top, bottom)
+    output = shared_memory.SharedMemory(name=target.name)
+    try:
+        band = image.resize((target.width, bottom - top), Image.Resampling.LANCZOS)
+        output.buf[top * target.stride:bottom * target.stride] = band.tobytes()
+        del band
+    finally:
+        # The image holds a view of the memory until it is gone
+        del image
+        memory.close()
+        output.close()
+
+
+def _scale_columns(source: ImageSpec, target: ImageSpec, left: int, right: int) -> None:
+    """Second pass: scale columns ``left:right`` of ``source`` to the height of the shared ``target``"""
+    from PIL import Image
+
+    memory, image = _open(source)
+    output = shared_memory.SharedMemory(name=target.name)
+    try:
+        band = image.crop((left, 0, right, source.height)).resize((right - left, target.height),
+                                                                   Image.Resampling.LANCZOS)
+        data = band.tobytes()
+        del band
+        row = (right - left) * 3
+        for y in range(target.height):
+            start = y * target.stride + left * 3
+            output.buf[start:start + row] = data[y * row:(y + 1) * row]
+    finally:
+        del image
+        memory.close()
+        output.close()
+
+
+def _release_when_done(shared: "SharedImage", futures: List[concurrent.futures.Future]) -> None:
+    """Unlink ``shared`` once none of ``futures`` can still be reading it, without waiting here"""
+    pending = [future for future in futures if not future.done()]
+    if not pending:
+        shared.release()
+        return
+    remaining = [len(pending)]
+    lock = threading.Lock()
+
+    def finished(_future) -> None:
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            shared.release()
+
+    for future in pending:
+        future.add_done_callback(finished)
+
+
+def _encode(spec: ImageSpec, fmt: str, quality: Optional[int]) -> bytes:
+    memory, image = _open(spec)
+    try:
+        options = {} if quality is None else {"quality": quality}
+        out = BytesIO()
+        image.save(out, format=fmt, **options)
+        return out.getvalue()
+    finally:
+        del image
+        memory.close()
+
+
+class PreprocessPool:
+    """Warm worker processes that downscale and encode large frames in parallel"""
+
+    def __init__(self, workers: Optional[int] = None, min_pixels: int = 3_000_000):
+        """
+        Args:
+            workers: Worker processes, default one per CPU up to 4
+            min_pixels: Frames with fewer pixels are encoded in the calling thread
+        """
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.min_pixels = min_pixels
+        self.encoded = 0
+        self.local = 0
+        self.errors = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, options: dict) -> Optional["PreprocessPool"]:
+        """Build the pool from the ``preprocess`` config section, or None if disabled
+
+        Enabled by default on machines with more than one CPU.
+        """
+        if not options.get("enabled", (os.cpu_count() or 1) > 1):
+            return None
+        return cls(workers=options.get("workers"), min_pixels=options.get("min_pixels", 3_000_000))
+
+    def _pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Spawned, not forked: the parent has Qt and several threads running
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+                atexit.register(self.close)
+            return self._executor
+
+    def warm_up(self) -> None:
+        """Start the workers and load Pillow in them, off the query path"""
+        try:
+            pool = self._pool()
+            for future in [pool.submit(_warm) for _ in range(self.workers)]:
+                future.result()
+        except Exception as e:
+            # Queries fall back to in-thread encoding if the pool keeps failing
+            logger.warning("Could not start the preprocessing workers: %s", e)
+
+    def encode_for_budget(self, frame: Frame, budget: EncodeBudget) -> EncodedImage:
+        """``encoder.encode_for_budget`` with the work spread over the pool
+
+        Falls back to encoding in the calling thread for small frames, and if
+        the pool fails.
+        """
+        if frame.width * frame.height < self.min_pixels:
+            self.local += 1
+            return encode_for_budget(frame, budget)
+        try:
+            encoded = self._encode(frame, budget)
+        except Exception as e:
+            logger.warning("Preprocessing in the pool failed, encoding in-thread: %s", e)
+            self.errors += 1
+            return encode_for_budget(frame, budget)
+        self.encoded += 1
+        return encoded
+
+    def resize(self, source: SharedImage, size: Tuple[int, int]) -> SharedImage:
+        """Downscale a shared image to ``size``: the width in bands of rows, then the height in bands of columns"""
+        width, height = size
+        # Holds the first pass: full height, final width
+        wide = SharedImage.blank((width, source.spec.height))
+        target = SharedImage.blank(size)
+        try:
+            self._in_bands(_scale_rows, source, wide, source.spec.height)
+            self._in_bands(_scale_columns, wide, target, width)
+        except BaseException:
+            target.release()
+            raise
+        finally:
+            wide.release()
+        return target
+
+    def _in_bands(self, scale, source: SharedImage, target: SharedImage, extent: int) -> None:
+        """Run ``scale`` over ``extent`` rows or columns split between the workers, and wait for all of it"""
+        pool = self._pool()
+        bands = min(self.workers, extent)
+        edges = [extent * i // bands for i in range(bands + 1)]
+        futures = [pool.submit(scale, source.spec, target.spec, start, end)
+                   for start, end in zip(edges, edges[1:]) if end > start]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            # Bands still running after a failure write into the images until they end
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+
+    def _encode(self, frame: Frame, budget: EncodeBudget) -> EncodedImage:
+        """``encoder.encode_ladder`` with each level's candidates encoded concurrently in the pool"""
+        pool = self._pool()
+        # Every encode submitted; the source is unlinked once none of them runs
+        pending: List[concurrent.futures.Future] = []
+        source = SharedImage.from_frame(frame)
+
+        def encode_level(dimension: int, candidates: List[Candidate]) -> Iterator[bytes]:
+            size = frame.scaled_size(dimension)
+            scaled = source if size == frame.size else self.resize(source, size)
+            futures = []
+            try:
+                futures = [pool.submit(_encode, scaled.spec, fmt, quality) for fmt, quality in candidates]
+                # Taken in order of preference; later candidates still running are dropped
+                for future in futures:
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+                pending.extend(futures)
+                if scaled is not source:
+                    # Dropped candidates may still be reading it; unlinked once they end
+                    _release_when_done(scaled, futures)
+
+        try:
+            return encode_ladder(frame, budget, encode_level)
+        finally:
+            _release_when_done(source, pending)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "started": self._executor is not None, "encoded": self.encoded,
+                "local": self.local, "errors": self.errors}
+
+    def close(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            # Waiting is brief (queued work is cancelled) and avoids tearing the pool down mid-exit
+            executor.shutdown(wait=True, cancel_futures=True)
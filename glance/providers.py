@@ -0,0 +1,626 @@
+"""Long-lived provider clients.
+
+Each provider client owns its connection pool for the life of the app, so
+repeat queries reuse DNS results, TCP connections and TLS sessions instead of
+paying for them on every question. ``ProviderRegistry`` hands out one client
+per provider/endpoint/key and only rebuilds a client when its configuration
+changes. Every client sends its requests through an ``AdmissionController``
+configured from that provider's rate limits.
+
+With ``stream_body`` (low-memory mode), OpenAI-compatible clients send
+``JsonBody`` request bodies, which base64-encode the images as they are
+written to the socket instead of building the whole body in memory first.
+"""
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .admission import AdmissionController, AdmissionError, estimate_tokens
+from .encoder import EncodedImage
+from .session import Turn
+from .tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+OPENAI_MODEL = "gpt-4-vision-preview"
+LOCAL_MODEL = "llava"
+DEFAULT_GENERATION = {"max_tokens": 300}
+
+
+class InlineImage:
+    """Data URL of an encoded image, base64-encoded a piece at a time as it is sent"""
+    # A multiple of 3, so the pieces join into one valid base64 string
+    CHUNK = 3 * 16384
+
+    def __init__(self, encoded: EncodedImage):
+        self.encoded = encoded
+        self.prefix = f"data:{encoded.mime_type};base64,".encode("ascii")
+
+    def __len__(self):
+        return len(self.prefix) + 4 * -(-len(self.encoded.data) // 3)
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self.prefix
+        data = memoryview(self.encoded.data)
+        for start in range(0, len(data), self.CHUNK):
+            yield base64.b64encode(data[start:start + self.CHUNK])
+
+    def key(self) -> str:
+        """Stands in for the data URL where payloads are compared rather than sent"""
+        return self.prefix.decode("ascii") + hashlib.sha1(self.encoded.data).hexdigest()
+
+
+def _payload_key(value):
+    if isinstance(value, InlineImage):
+        return value.key()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class JsonBody:
+    """A JSON request body whose ``InlineImage`` values are encoded while it is sent
+
+    Everything but the images is serialized up front. requests sends an
+    iterable of known length with a Content-Length header and writes it
+    piece by piece, so neither an image's base64 text nor the whole body is
+    ever held in memory. A body can be sent once; build one per attempt.
+    """
+
+    def __init__(self, payload: dict):
+        marker = uuid.uuid4().hex
+        images: List[InlineImage] = []
+
+        def placeholder(value):
+            if not isinstance(value, InlineImage):
+                raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+            images.append(value)
+            return f"{marker}{len(images) - 1}{marker}"
+
+        # Split into JSON text and image indices, alternately
+        pieces = json.dumps(payload, default=placeholder, allow_nan=False).split(marker)
+        self.parts = [images[int(piece)] if i % 2 else piece.encode("utf-8") for i, piece in enumerate(pieces)]
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part in self.parts:
+            if isinstance(part, InlineImage):
+                yield from part
+            elif part:
+                yield part
+
+
+class _StreamUsage:
+    """Counts the streams open on a client, so retiring it closes it once the last one ends"""
+
+    def _init_usage(self) -> None:
+        self.streams_open = 0
+        self.retired = False
+        self._usage_lock = threading.Lock()
+
+    def _in_use(self, stream: Iterator[str]) -> Iterator[str]:
+        with self._usage_lock:
+            self.streams_open += 1
+        try:
+            yield from stream
+        finally:
+            with self._usage_lock:
+                self.streams_open -= 1
+                idle = self.retired and self.streams_open == 0
+            if idle:
+                self.close()
+
+    def retire(self) -> None:
+        """Close the client now if it is idle, otherwise when its last open stream ends"""
+        with self._usage_lock:
+            self.retired = True
+            idle = self.streams_open == 0
+        if idle:
+            self.close()
+
+
+class OpenAIProvider(_StreamUsage):
+    """Client for OpenAI-compatible chat completion endpoints"""
+    name = "openai"
+
+    def __init__(self, api_endpoint: str, api_key: str, pool_size: int = 4,
+                 timeout: float = 30, verify=True, admission: Optional[AdmissionController] = None,
+                 model: Optional[str] = None, generation: Optional[dict] = None, stream_body: bool = False):
+        """
+        Args:
+            api_endpoint: Chat completions URL
+            api_key: Bearer token
+            pool_size: Keep-alive connections kept per host
+            timeout: Connect/read timeout in seconds
+            verify: TLS verification flag or CA bundle path, as for requests
+            admission: Rate limiting and retry policy, default unlimited with retries
+            model: Default model name
+            generation: Extra request body fields such as max_tokens or temperature
+            stream_body: Encode images into the request body as it is sent (``JsonBody``)
+                rather than building the body in memory
+        """
+        self.admission = admission or AdmissionController()
+        self.api_endpoint = api_endpoint
+        self.api_key = api_key
+        self.model = model or OPENAI_MODEL
+        self.generation = {**DEFAULT_GENERATION, **(generation or {})}
+        self.timeout = timeout
+        self.stream_body = stream_body
+        # Passed per request: requests lets REQUESTS_CA_BUNDLE override Session.verify
+        self.verify = verify
+        self.requests_made = 0
+        self._init_usage()
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+
+    @staticmethod
+    def _content(images: Sequence[EncodedImage], prompt: str, inline: bool = False) -> list:
+        content = [{"type": "text", "text": prompt}]
+        for encoded in images:
+            url = InlineImage(encoded) if inline else f"data:{encoded.mime_type};base64,{encoded.base64()}"
+            content.append({"type": "image_url", "image_url": {"url": url}})
+        return content
+
+    def build_payload(self, images: Sequence[EncodedImage], prompt: str, stream: bool = True,
+                      model: Optional[str] = None, history: Optional[Sequence[Turn]] = None) -> dict:
+        """Chat completion request body for a prompt about one or more images
+
+        With ``stream_body`` the image URLs are ``InlineImage`` objects, which
+        only ``JsonBody`` serializes.
+
+        Args:
+            history: Earlier turns of the session, sent as alternating user and
+                assistant messages before the question
+        """
+        messages = []
+        for turn in history or ():
+            messages.append({"role": "user", "content": self._content(turn.images, turn.prompt, self.stream_body)})
+            messages.append({"role": "assistant", "content": turn.answer})
+        messages.append({"role": "user", "content": self._content(images, prompt, self.stream_body)})
+        return {
+            "model": model or self.model,
+            "messages": messages,
+            **self.generation,
+            "stream": stream
+        }
+
+    @staticmethod
+    def _estimate(payload: dict, prompt: str, images: Sequence[EncodedImage],
+                  history: Optional[Sequence[Turn]]) -> int:
+        tokens = estimate_tokens(prompt, [encoded.size for encoded in images], payload.get("max_tokens", 300))
+        return tokens + sum(turn.tokens for turn in history or ())
+
+    def stream(self, images: Sequence[EncodedImage], prompt: str, model: Optional[str] = None,
+               history: Optional[Sequence[Turn]] = None, info: Optional[dict] = None,
+               is_cancelled: Optional[Callable[[], bool]] = None) -> Iterator[str]:
+        """Send a query and yield the answer as it arrives
+
+        Args:
+            images: Encoded images to attach
+            prompt: The user's question
+            model: Model to ask instead of the client's default
+            history: Earlier turns of the session, or None outside session mode.
+                The screenshot in the history is the same encode every time, so
+                servers with prompt caching reuse their work on it
+            info: Filled with the response's ``finish_reason`` once it is known
+            is_cancelled: Returns True once the caller gave up; rate-limit waits
+                and retry backoff stop early
+
+        Raises:
+            requests.RequestException: If the request fails after any retries
+            AdmissionError: If the client-side rate limit or circuit breaker refuses it
+        """
+        with get_tracer().span("request_build"):
+            payload = self.build_payload(images, prompt, model=model, history=history)
+        tokens = self._estimate(payload, prompt, images, history)
+        yield from self._in_use(self.admission.stream(lambda: self._send(payload, info), tokens, is_cancelled))
+
+    def _send(self, payload: dict, info: Optional[dict] = None) -> Iterator[str]:
+        """One attempt at a chat completion request"""
+        self.requests_made += 1
+        body = {"data": JsonBody(payload)} if self.stream_body else {"json": payload}
+        with self.session.post(self.api_endpoint, timeout=self.timeout, verify=self.verify,
+                               stream=True, **body) as response:
+            response.raise_for_status()
+            if response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                yield from self._iter_sse(response, info)
+            else:
+                # Endpoint ignored "stream" and sent a complete response
+                choice = (response.json().get("choices") or [{}])[0]
+                if info is not None:
+                    info["finish_reason"] = choice.get("finish_reason")
+                yield choice.get("message", {}).get("content", "")
+
+    @staticmethod
+    def _iter_sse(response, info: Optional[dict] = None) -> Iterator[str]:
+        """Yield the text deltas of an OpenAI-style server-sent event stream"""
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            choices = event.get("choices") or [{}]
+            if info is not None and choices[0].get("finish_reason"):
+                info["finish_reason"] = choices[0]["finish_reason"]
+            text = (choices[0].get("delta") or {}).get("content")
+            if text:
+                yield text
+
+    def stats(self) -> dict:
+        """Request and connection counters for this client's pool"""
+        opened = 0
+        served = 0
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools[key]
+            opened += pool.num_connections
+            served += pool.num_requests
+        return {
+            "requests": self.requests_made,
+            "connections_opened": opened,
+            "connections_reused": max(0, served - opened),
+            "admission": self.admission.stats(),
+        }
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class _SharedStream:
+    """One upstream answer replayed to every caller that asked the same question"""
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        # Filled by the upstream request (finish_reason, model), copied to every subscriber at the end
+        self.info: dict = {}
+        self.subscribers = 0
+        # Set once the upstream was dropped for lack of readers; nobody may join after that
+        self.abandoned = False
+        self._cond = threading.Condition()
+
+    def feed(self, source: Iterator[str]) -> None:
+        """Pump ``source`` into the buffer; stops early once nobody is listening"""
+        try:
+            for text in source:
+                with self._cond:
+                    if self.subscribers == 0:
+                        self.abandoned = True
+                        break
+                    self.parts.append(text)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._cond:
+                self.done = True
+                # An answer cut short for lack of readers must not be replayed to a new one
+                self.abandoned = self.abandoned or self.subscribers == 0
+                self._cond.notify_all()
+
+    def subscribe(self, info: Optional[dict] = None,
+                  is_cancelled: Optional[Callable[[], bool]] = None) -> Optional[Iterator[str]]:
+        """Start reading the answer from its beginning, or None if the upstream was already dropped"""
+        with self._cond:
+            if self.abandoned:
+                return None
+            self.subscribers += 1
+        return self._replay(info, is_cancelled)
+
+    def _replay(self, info: Optional[dict], is_cancelled: Optional[Callable[[], bool]]) -> Iterator[str]:
+        index = 0
+        try:
+            while True:
+                with self._cond:
+                    while index >= len(self.parts) and not self.done:
+                        if is_cancelled is not None and is_cancelled():
+                            return
+                        # Woken by new text, or periodically to notice a cancelled caller
+                        self._cond.wait(0.1)
+                    if index < len(self.parts):
+                        text = self.parts[index]
+                        index += 1
+                    else:
+                        if info is not None:
+                            info.update(self.info)
+                        if self.error is not None:
+                            raise self.error
+                        return
+                yield text
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+
+class LocalProvider(OpenAIProvider):
+    """Client for local OpenAI-compatible servers (llama.cpp server, Ollama)
+
+    Local servers decode concurrent requests as one batch only while they have
+    free slots (llama.cpp ``--parallel``, Ollama ``OLLAMA_NUM_PARALLEL``);
+    anything beyond that waits inside the server and counts against our read
+    timeout. This client keeps at most one request per slot in flight, so
+    concurrent queries share the server's batch, and coalesces identical
+    concurrent queries into a single upstream request.
+    """
+    name = "local"
+
+    def __init__(self, api_endpoint: str, api_key: str = "", model: Optional[str] = None,
+                 generation: Optional[dict] = None, parallel: Optional[int] = None,
+                 coalesce: bool = True, warmup: bool = True, **options):
+        """
+        Args:
+            api_endpoint: Chat completions URL, e.g. http://localhost:8080/v1/chat/completions
+            api_key: Bearer token, usually empty for local servers
+            model: Model name as the server knows it
+            generation: Extra request body fields such as max_tokens or temperature
+            parallel: Requests the server decodes together; None to ask llama.cpp's
+                ``/props`` and fall back to 1
+            coalesce: Share one upstream request between identical concurrent queries
+            warmup: Whether the app should load the model at startup
+            options: Further ``OpenAIProvider`` options
+        """
+        super().__init__(api_endpoint, api_key, model=model or LOCAL_MODEL, generation=generation, **options)
+        if not api_key:
+            self.session.headers.pop("Authorization", None)
+        self.parallel = parallel
+        self.coalesce = coalesce
+        self.warm_at_startup = warmup
+        self.coalesced = 0
+        self.warmup_ms: Optional[float] = None
+        self._slots: Optional[threading.BoundedSemaphore] = None
+        self._slots_lock = threading.Lock()
+        self._inflight: Dict[str, _SharedStream] = {}
+        self._inflight_lock = threading.Lock()
+
+    @property
+    def server_root(self) -> str:
+        parts = urlsplit(self.api_endpoint)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def probe_parallel(self) -> int:
+        """Number of server slots, from llama.cpp's ``/props`` when available"""
+        try:
+            response = self.session.get(f"{self.server_root}/props", timeout=2, verify=self.verify)
+            if response.ok:
+                return max(1, int(response.json().get("total_slots", 1)))
+        except (requests.RequestException, ValueError):
+            pass
+        return 1
+
+    @property
+    def slots(self) -> threading.BoundedSemaphore:
+        with self._slots_lock:
+            if self._slots is None:
+                if self.parallel is None:
+                    self.parallel = self.probe_parallel()
+                    logger.info("Local server at %s has %d slot(s)", self.server_root, self.parallel)
+                self._slots = threading.BoundedSemaphore(self.parallel)
+            return self._slots
+
+    def _send_in_slot(self, payload: dict, info: Optional[dict] = None) -> Iterator[str]:
+        slots = self.slots
+        slots.acquire()
+        try:
+            yield from self._send(payload, info)
+        finally:
+            slots.release()
+
+    def stream(self, images: Sequence[EncodedImage], prompt: str, model: Optional[str] = None,
+               history: Optional[Sequence[Turn]] = None, info: Optional[dict] = None,
+               is_cancelled: Optional[Callable[[], bool]] = None) -> Iterator[str]:
+        """Send a query, or join an identical one already in flight, and yield the answer
+
+        Every query reading a shared request gets its ``info`` once the answer
+        ends. A cancelled query stops reading at once; the shared request
+        keeps going while any query still reads it, and is dropped (with its
+        rate-limit waits) once none does.
+        """
+        with get_tracer().span("request_build"):
+            payload = self.build_payload(images, prompt, model=model, history=history)
+        tokens = self._estimate(payload, prompt, images, history)
+        if not self.coalesce:
+            yield from self._in_use(self.admission.stream(lambda: self._send_in_slot(payload, info), tokens,
+                                                          is_cancelled))
+            return
+        key = hashlib.sha1(json.dumps(payload, sort_keys=True, default=_payload_key).encode("utf-8")).hexdigest()
+        with self._inflight_lock:
+            shared = self._inflight.get(key)
+            answer = shared.subscribe(info, is_cancelled) if shared is not None else None
+            if answer is not None:
+                self.coalesced += 1
+            else:
+                shared = _SharedStream()
+                self._inflight[key] = shared
+                answer = shared.subscribe(info, is_cancelled)
+                # Stops once no query reads it any more; until then it keeps the client open
+                upstream = self._in_use(self.admission.stream(
+                    lambda: self._send_in_slot(payload, shared.info), tokens,
+                    lambda: shared.subscribers == 0))
+
+                def pump():
+                    shared.feed(upstream)
+                    with self._inflight_lock:
+                        if self._inflight.get(key) is shared:
+                            del self._inflight[key]
+
+                threading.Thread(target=pump, name="glance-local-stream", daemon=True).start()
+        yield from answer
+
+    def warmup(self) -> Optional[float]:
+        """Load the model with a one-token request so the first real query is fast
+
+        Returns:
+            Milliseconds the warmup took, or None if the server could not be reached
+        """
+        payload = {"model": self.model, "messages": [{"role": "user", "content": "Hi"}],
+                   "max_tokens": 1, "stream": False}
+        start = time.perf_counter()
+        try:
+            self.slots
+            # Loading weights can take far longer than a normal answer
+            response = self.session.post(self.api_endpoint, json=payload, timeout=max(self.timeout, 300),
+                                         verify=self.verify)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning("Local model warmup failed: %s", e)
+            return None
+        self.warmup_ms = (time.perf_counter() - start) * 1000
+        logger.info("Warmed up %s in %.0fms", self.model, self.warmup_ms)
+        return self.warmup_ms
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats.update({"parallel": self.parallel, "coalesced": self.coalesced, "warmup_ms": self.warmup_ms})
+        return stats
+
+
+class GeminiProvider(_StreamUsage):
+    """Long-lived wrapper around ``GeminiAPI`` and its ``genai.Client``"""
+    name = "gemini"
+
+    def __init__(self, api_key: str, admission: Optional[AdmissionController] = None,
+                 base_url: Optional[str] = None):
+        # google-genai is slow to import, so it is only loaded once Gemini is used
+        from .geminiapi import GeminiAPI
+        self.api = GeminiAPI(api_key, admission=admission, base_url=base_url)
+        self.admission = self.api.admission
+        # Still reported once the client is closed
+        self.default_model = self.api.model
+        self.requests_made = 0
+        self._init_usage()
+
+    @property
+    def model(self) -> str:
+        return self.default_model
+
+    def stream(self, images: Sequence[EncodedImage], prompt: str, model: Optional[str] = None,
+               history: Optional[Sequence[Turn]] = None, info: Optional[dict] = None,
+               is_cancelled: Optional[Callable[[], bool]] = None) -> Iterator[str]:
+        """Send a query and yield the answer as it arrives
+
+        In session mode (``history`` is not None) the screenshots are also
+        uploaded to the Files API in the background, so follow-ups can refer
+        to them instead of sending the bytes again.
+
+        Raises:
+            AdmissionError: If the client was closed, e.g. because the settings changed
+        """
+        # Read once: close() may run on another thread while this query waits
+        api = self.api
+        if api is None:
+            raise AdmissionError("The Gemini client was closed; please ask again.")
+        self.requests_made += 1
+        if history is not None:
+            api.upload_images(images)
+        yield from self._in_use(api.analyze_image_stream(list(images), prompt, model=model, history=history,
+                                                              info=info, is_cancelled=is_cancelled))
+
+    def stats(self) -> dict:
+        api = self.api
+        return {"requests": self.requests_made, "admission": self.admission.stats(),
+                "uploads": api.upload_stats() if api is not None else None}
+
+    def close(self) -> None:
+        if self.api is None:
+            return
+        self.api.close()
+        # genai.Client releases its connections when garbage collected
+        self.api = None
+
+
+ProviderKey = Tuple[str, str, str]
+
+
+class ProviderRegistry:
+    """One pooled client per provider/endpoint/key, shared by all queries"""
+
+    def __init__(self, rate_limits: Optional[dict] = None, provider_options: Optional[dict] = None,
+                 **client_options):
+        """
+        Args:
+            rate_limits: Admission settings per provider name, e.g.
+                ``{"openai": {"rpm": 60, "tpm": 90000}}``
+            provider_options: Client settings per OpenAI-compatible provider name, e.g.
+                ``{"local": {"model": "llava:13b", "generation": {"temperature": 0.2}}}``
+            client_options: Extra keyword arguments for every OpenAI-compatible client
+                (pool_size, timeout, verify, stream_body)
+        """
+        self.rate_limits = rate_limits or {}
+        self.provider_options = provider_options or {}
+        self._clients: Dict[ProviderKey, object] = {}
+        self._lock = threading.Lock()
+        self.client_options = client_options
+        self.builds = 0
+
+    @staticmethod
+    def key(model_provider: str, api_endpoint: str, api_key: str) -> ProviderKey:
+        # Gemini ignores the endpoint, so it must not split the cache
+        return (model_provider, api_endpoint if model_provider != 'gemini' else "", api_key)
+
+    def get(self, model_provider: str, api_endpoint: str, api_key: str):
+        """Return the client for this configuration, building it on first use"""
+        key = self.key(model_provider, api_endpoint, api_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                admission = AdmissionController.from_config(self.rate_limits.get(model_provider, {}))
+                options = {**self.client_options, **self.provider_options.get(model_provider, {})}
+                if model_provider == 'gemini':
+                    client = GeminiProvider(api_key, admission=admission,
+                                            base_url=self.provider_options.get('gemini', {}).get('base_url'))
+                elif model_provider == 'local':
+                    client = LocalProvider(api_endpoint, api_key, admission=admission, **options)
+                else:
+                    client = OpenAIProvider(api_endpoint, api_key, admission=admission, **options)
+                self._clients[key] = client
+                self.builds += 1
+                logger.debug("Built %s client (%d builds so far)", model_provider, self.builds)
+            return client
+
+    def retain(self, model_provider: str, api_endpoint: str, api_key: str, also=()) -> None:
+        """Retire every client whose configuration differs from the given one
+
+        Called when settings are saved; a client whose settings did not change
+        keeps its warm connections. A retired client is closed once the
+        queries still streaming from it have finished.
+
+        Args:
+            also: Further (provider, endpoint, key) configurations to keep
+        """
+        keep = {self.key(model_provider, api_endpoint, api_key)}
+        keep.update(self.key(*config) for config in also)
+        with self._lock:
+            stale = [key for key in self._clients if key not in keep]
+            for key in stale:
+                self._clients.pop(key).retire()
+
+    def stats(self) -> dict:
+        """Pool statistics for every live client, keyed by provider and endpoint"""
+        with self._lock:
+            clients = {f"{key[0]}:{key[1]}" if key[1] else key[0]: client.stats()
+                       for key, client in self._clients.items()}
+        return {"builds": self.builds, "clients": clients}
+
+    def close(self) -> None:
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
@@ -0,0 +1,212 @@
+"""Change-region detection between consecutive captures.
+
+Frames are compared in square tiles with vectorized NumPy operations on the
+raw pixel buffers (no decode), then changed tiles are grouped into a small
+set of bounding boxes. When only a small part of the screen changed, the
+pipeline can upload a low-resolution overview plus a full-resolution crop of
+the changed area instead of the whole screen at full detail.
+"""
+import ctypes
+import ctypes.util
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .frame import Frame
+from .screenshot import PixelBuffer
+
+# x, y, width, height in pixels
+Rect = Tuple[int, int, int, int]
+
+
+def _row_words(buffer: PixelBuffer, tile_size: int) -> Tuple[np.ndarray, int]:
+    """View the pixel rows as the widest integer words that keep tiles aligned
+
+    Returns:
+        The (height, words) array and the number of words per tile column
+    """
+    row_bytes = buffer.width * buffer.bytes_per_pixel
+    rows = np.frombuffer(buffer.data, np.uint8, count=buffer.stride * buffer.height)
+    rows = rows.reshape(buffer.height, buffer.stride)[:, :row_bytes]
+    tile_bytes = tile_size * buffer.bytes_per_pixel
+    for dtype in (np.uint64, np.uint32):
+        size = np.dtype(dtype).itemsize
+        if row_bytes % size == 0 and tile_bytes % size == 0 and buffer.stride % size == 0:
+            return rows.view(dtype), tile_bytes // size
+    return rows, tile_bytes
+
+
+def _load_memcmp():
+    name = ctypes.util.find_library("c")
+    if not name:
+        return None
+    try:
+        memcmp = ctypes.CDLL(name).memcmp
+    except (OSError, AttributeError):
+        return None
+    memcmp.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+    memcmp.restype = ctypes.c_int
+    return memcmp
+
+
+# Used to skip identical bands of rows without materializing a diff array
+_memcmp = _load_memcmp()
+
+
+def changed_tiles(previous: PixelBuffer, current: PixelBuffer, tile_size: int = 64) -> np.ndarray:
+    """Boolean grid with one cell per tile, True where any pixel differs"""
+    rows_y = -(-current.height // tile_size)
+    columns = -(-current.width // tile_size)
+    if (previous.width, previous.height, previous.raw_mode) != (current.width, current.height, current.raw_mode):
+        return np.ones((rows_y, columns), dtype=bool)
+
+    old, words_per_tile = _row_words(previous, tile_size)
+    new, _ = _row_words(current, tile_size)
+    old_address = old.ctypes.data
+    new_address = new.ctypes.data
+    starts = np.arange(0, old.shape[1], words_per_tile)
+
+    grid = np.zeros((rows_y, columns), dtype=bool)
+    for band, top in enumerate(range(0, current.height, tile_size)):
+        rows = min(tile_size, current.height - top)
+        offset = top * current.stride
+        if _memcmp is not None and _memcmp(old_address + offset, new_address + offset, rows * current.stride) == 0:
+            continue
+        # Collapse the band's rows, then each run of tile columns
+        diff = (old[top:top + rows] != new[top:top + rows]).any(axis=0)
+        grid[band] = np.logical_or.reduceat(diff, starts)
+    return grid
+
+
+def _components(grid: np.ndarray) -> List[Tuple[int, int, int, int]]:
+    """Bounding boxes (in tiles) of 8-connected groups of changed tiles"""
+    seen = np.zeros_like(grid)
+    boxes = []
+    for y, x in zip(*np.nonzero(grid)):
+        if seen[y, x]:
+            continue
+        seen[y, x] = True
+        stack = [(y, x)]
+        top, left, bottom, right = y, x, y, x
+        while stack:
+            cy, cx = stack.pop()
+            top, bottom = min(top, cy), max(bottom, cy)
+            left, right = min(left, cx), max(right, cx)
+            for ny in range(max(cy - 1, 0), min(cy + 2, grid.shape[0])):
+                for nx in range(max(cx - 1, 0), min(cx + 2, grid.shape[1])):
+                    if grid[ny, nx] and not seen[ny, nx]:
+                        seen[ny, nx] = True
+                        stack.append((ny, nx))
+        boxes.append((left, top, right + 1, bottom + 1))
+    return boxes
+
+
+def _area(box) -> int:
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+
+def _union(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def merge_boxes(boxes: list, max_boxes: int = 4, gap: int = 1) -> list:
+    """Merge boxes that touch (within ``gap``) and cap their number
+
+    While there are more than ``max_boxes``, the pair whose union adds the
+    least unchanged area is merged.
+    """
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] - gap <= b[2] and b[0] - gap <= a[2] and a[1] - gap <= b[3] and b[1] - gap <= a[3]:
+                    boxes[i] = _union(a, b)
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    while len(boxes) > max_boxes:
+        cost, i, j = min((_area(_union(boxes[i], boxes[j])) - _area(boxes[i]) - _area(boxes[j]), i, j)
+                         for i in range(len(boxes)) for j in range(i + 1, len(boxes)))
+        boxes[i] = _union(boxes[i], boxes[j])
+        del boxes[j]
+    return boxes
+
+
+class ChangeResult:
+    """Outcome of comparing a frame with the previous capture"""
+
+    def __init__(self, boxes: List[Rect], changed_fraction: float, elapsed_ms: float,
+                 size: Tuple[int, int], first: bool = False):
+        self.boxes = boxes
+        self.changed_fraction = changed_fraction
+        self.elapsed_ms = elapsed_ms
+        self.size = size
+        # True when there was no previous frame to compare against
+        self.first = first
+
+    def is_partial(self, max_fraction: float) -> bool:
+        """Whether some, but at most ``max_fraction``, of the screen changed"""
+        return not self.first and bool(self.boxes) and self.changed_fraction <= max_fraction
+
+    def bounding_box(self, margin: int = 0) -> Optional[Rect]:
+        """Single rectangle around every changed box, grown by ``margin`` pixels"""
+        if not self.boxes:
+            return None
+        left = max(0, min(x for x, _, _, _ in self.boxes) - margin)
+        top = max(0, min(y for _, y, _, _ in self.boxes) - margin)
+        right = min(self.size[0], max(x + w for x, _, w, _ in self.boxes) + margin)
+        bottom = min(self.size[1], max(y + h for _, y, _, h in self.boxes) + margin)
+        return left, top, right - left, bottom - top
+
+    def report(self) -> dict:
+        return {
+            "boxes": [list(box) for box in self.boxes],
+            "changed_fraction": round(self.changed_fraction, 4),
+            "elapsed_ms": round(self.elapsed_ms, 2),
+        }
+
+
+class ChangeDetector:
+    """Compares each frame with the one before it"""
+
+    def __init__(self, tile_size: int = 64, max_boxes: int = 4):
+        self.tile_size = tile_size
+        self.max_boxes = max_boxes
+        self.previous: Optional[PixelBuffer] = None
+
+    def update(self, frame: Frame) -> ChangeResult:
+        """Compare ``frame`` with the previous one and remember it for next time"""
+        start = time.perf_counter()
+        current = frame.buffer
+        size = (current.width, current.height)
+        if self.previous is None:
+            self.previous = current
+            return ChangeResult([(0, 0, *size)], 1.0, (time.perf_counter() - start) * 1000, size, first=True)
+
+        grid = changed_tiles(self.previous, current, self.tile_size)
+        self.previous = current
+
+        fraction = float(grid.mean()) if grid.size else 0.0
+        if fraction > 0.5:
+            # Mostly changed: one box around everything, skip the component walk
+            ys, xs = np.nonzero(grid)
+            tile_boxes = [(xs.min(), ys.min(), xs.max() + 1, ys.max() + 1)]
+        else:
+            tile_boxes = merge_boxes(_components(grid), self.max_boxes)
+
+        t = self.tile_size
+        boxes = []
+        for left, top, right, bottom in tile_boxes:
+            x, y = left * t, top * t
+            boxes.append((int(x), int(y), int(min(right * t, size[0]) - x), int(min(bottom * t, size[1]) - y)))
+        return ChangeResult(boxes, fraction, (time.perf_counter() - start) * 1000, size)
+
+    def reset(self) -> None:
+        self.previous = None
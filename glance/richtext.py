@@ -0,0 +1,271 @@
+"""Markdown answers as rich text.
+
+Answers usually come back as markdown. ``to_html`` converts the subset models
+actually use (headings, paragraphs, lists, quotes, fenced code, inline code,
+emphasis and links) to the HTML subset ``QTextDocument`` understands. It is
+plain Python with no Qt objects, so it can run on a worker thread.
+
+``MarkdownRenderer`` does the conversion on a background thread and caches
+the result per text, so an answer is converted once however often it is
+shown. While an answer streams in, ``stable_length`` tells the caller how much
+of it is made of complete blocks that will not change as more text arrives;
+only those are converted, and the rest stays plain text until it is complete.
+"""
+import hashlib
+import html
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from .tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+CODE_STYLE = "background-color: rgba(0, 0, 0, 0.35); font-family: monospace;"
+
+_FENCE = re.compile(r"^\s*(```|~~~)")
+_HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_BULLET = re.compile(r"^\s*[-*+]\s+(.*)$")
+_NUMBERED = re.compile(r"^\s*\d+[.)]\s+(.*)$")
+_QUOTE = re.compile(r"^\s*>\s?(.*)$")
+_RULE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+_INLINE_CODE = re.compile(r"`([^`]+)`")
+_LINK = re.compile(r"\[([^\]]+)\]\((https?://[^)\s]+)\)")
+_BOLD = re.compile(r"(\*\*|__)(?=\S)(.+?)(?<=\S)\1")
+_ITALIC = re.compile(r"(?<![\w*])([*_])(?=\S)(.+?)(?<=\S)\1(?![\w*])")
+
+
+def _link(match) -> str:
+    # The URL was escaped with the rest of the text; only its quotes still need it
+    url = match.group(2).replace('"', "&quot;")
+    return f'<a href="{url}">{match.group(1)}</a>'
+
+
+def _inline(text: str) -> str:
+    """Escape ``text`` and apply inline code, links, bold and italics"""
+    # Code spans are set aside first so emphasis markers inside them survive
+    spans: List[str] = []
+
+    def keep(match):
+        spans.append(f'<code style="{CODE_STYLE}">{html.escape(match.group(1))}</code>')
+        return f"\x00{len(spans) - 1}\x00"
+
+    text = html.escape(_INLINE_CODE.sub(keep, text), quote=False)
+    text = _LINK.sub(_link, text)
+    text = _BOLD.sub(r"<b>\2</b>", text)
+    text = _ITALIC.sub(r"<i>\2</i>", text)
+    return re.sub("\x00(\\d+)\x00", lambda m: spans[int(m.group(1))], text)
+
+
+def to_html(markdown: str) -> str:
+    """Convert a markdown answer to HTML for ``QTextDocument``"""
+    out: List[str] = []
+    paragraph: List[str] = []
+    items: List[str] = []
+    list_tag = None
+    quote: List[str] = []
+    code: Optional[List[str]] = None
+    fence = ""
+
+    def flush():
+        nonlocal list_tag
+        if paragraph:
+            out.append("<p>" + "<br>".join(_inline(line) for line in paragraph) + "</p>")
+            paragraph.clear()
+        if items:
+            out.append(f"<{list_tag}>" + "".join(f"<li>{_inline(item)}</li>" for item in items) + f"</{list_tag}>")
+            items.clear()
+            list_tag = None
+        if quote:
+            out.append("<blockquote>" + "<br>".join(_inline(line) for line in quote) + "</blockquote>")
+            quote.clear()
+
+    for line in markdown.splitlines():
+        if code is not None:
+            if line.strip().startswith(fence):
+                out.append(f'<pre style="{CODE_STYLE}">{html.escape(chr(10).join(code))}</pre>')
+                code = None
+            else:
+                code.append(line)
+            continue
+        match = _FENCE.match(line)
+        if match:
+            flush()
+            code, fence = [], match.group(1)
+            continue
+        if not line.strip():
+            flush()
+            continue
+        match = _HEADING.match(line)
+        if match:
+            flush()
+            level = len(match.group(1))
+            out.append(f"<h{level}>{_inline(match.group(2))}</h{level}>")
+            continue
+        if _RULE.match(line):
+            flush()
+            out.append("<hr>")
+            continue
+        for pattern, tag in ((_BULLET, "ul"), (_NUMBERED, "ol")):
+            match = pattern.match(line)
+            if match:
+                if list_tag != tag:
+                    flush()
+                    list_tag = tag
+                items.append(match.group(1))
+                break
+        else:
+            match = _QUOTE.match(line)
+            if match:
+                if not quote:
+                    flush()
+                quote.append(match.group(1))
+            elif items and line.startswith((" ", "\t")):
+                # Continuation of the previous list item
+                items[-1] += " " + line.strip()
+            else:
+                if items or quote:
+                    flush()
+                paragraph.append(line)
+    flush()
+    if code is not None:
+        # An unterminated fence still shows as code
+        out.append(f'<pre style="{CODE_STYLE}">{html.escape(chr(10).join(code))}</pre>')
+    return "".join(out)
+
+
+def stable_length(markdown: str) -> int:
+    """Length of the prefix of a streaming answer made of complete blocks
+
+    A block is complete once a blank line follows it, or, for fenced code,
+    once the closing fence has arrived; text after that point may still
+    change meaning (a list may continue, a fence may close).
+    """
+    stable = 0
+    position = 0
+    fence = None
+    for line in markdown.splitlines(keepends=True):
+        position += len(line)
+        if not line.endswith("\n"):
+            break
+        stripped = line.strip()
+        if fence is not None:
+            if stripped.startswith(fence):
+                fence = None
+                stable = position
+            continue
+        match = _FENCE.match(line)
+        if match:
+            fence = match.group(1)
+        elif not stripped:
+            stable = position
+    return stable
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class MarkdownRenderer(QObject):
+    """Converts markdown to HTML on a worker thread, caching results per text"""
+    # (token, html) for a render requested with a token; delivered on the GUI thread
+    rendered = pyqtSignal(object, str)
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 8 * 1024 * 1024, parent=None):
+        """
+        Args:
+            max_entries: Rendered texts kept
+            max_bytes: Upper bound on the size of the cached HTML
+        """
+        super().__init__(parent)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="glance-render")
+
+    def cached(self, text: str) -> Optional[str]:
+        """HTML for ``text`` if it has been rendered already"""
+        key = text_key(text)
+        with self._lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+            return result
+
+    def render(self, text: str, token=None, cache: bool = True) -> Future:
+        """Convert ``text`` in the background
+
+        Requests are handled in order, but a cached result is emitted at
+        once, possibly ahead of earlier requests still being converted.
+
+        Args:
+            token: Passed back with ``rendered`` so the caller can match results
+            cache: Whether to keep the result; fragments of a streaming answer
+                are not worth keeping, the whole answer is
+
+        Returns:
+            Future with the HTML; ``rendered`` is also emitted with ``token``
+            unless it is None
+        """
+        cached = self.cached(text)
+        if cached is not None:
+            with self._lock:
+                self.hits += 1
+            future = Future()
+            future.set_result(cached)
+            if token is not None:
+                self.rendered.emit(token, cached)
+            return future
+        with self._lock:
+            self.misses += 1
+        return self._executor.submit(self._render, text, token, cache)
+
+    def _render(self, text: str, token, cache: bool) -> str:
+        start = time.perf_counter()
+        try:
+            result = to_html(text)
+        except Exception:
+            # Never lose an answer to a formatting bug
+            logger.exception("Markdown conversion failed")
+            result = "<p>" + html.escape(text).replace("\n", "<br>") + "</p>"
+        get_tracer().observe("markdown_ms", (time.perf_counter() - start) * 1000)
+        if cache:
+            self.store(text, result)
+        if token is not None:
+            self.rendered.emit(token, result)
+        return result
+
+    def store(self, text: str, result: str) -> None:
+        """Keep ``result`` as the HTML of ``text``, e.g. an answer assembled from rendered fragments"""
+        key = text_key(text)
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = result
+            self._bytes += len(result)
+            while self._cache and (len(self._cache) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._cache.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def clear(self) -> None:
+        """Forget every rendered answer"""
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._cache), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,214 @@
+"""Model tiering.
+
+Each provider gets a ladder of models, cheapest and fastest first (for
+Gemini, built from ``GeminiModel``: 2.0 Flash, then 1.5 Pro). A query starts
+on the lowest tier expected to handle it: long prompts and images that are
+still large after preprocessing (many tiles, or a busy screen that barely
+compressed into the byte budget) start higher, and a tier whose recent answers
+have often had to be escalated, or whose recent latency misses the target
+while a stronger tier meets it, is skipped. If an answer comes back empty,
+cut off by the output token limit, or fails, the query is asked again one
+tier up; requests no model would accept (400, 401, 403) and requests turned
+away by admission control are not. The route taken is recorded in the query's metrics and trace, and
+outcomes per model feed back into later choices.
+"""
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence
+
+from .admission import AdmissionError, estimate_tokens
+from .encoder import EncodedImage
+
+# Finish reasons meaning the answer hit the output token limit
+TRUNCATED_REASONS = ("length", "MAX_TOKENS")
+# Errors another model cannot fix
+FATAL_STATUS = (400, 401, 403)
+# Outcomes a stronger model may do better on; the others are not the model's doing
+ESCALATE_REASONS = ("error", "empty", "truncated")
+
+
+def classify(answer: str, finish_reason: Optional[str] = None, error: Optional[Exception] = None) -> Optional[str]:
+    """What went wrong with a response, or None if it is fine
+
+    'error', 'empty' and 'truncated' are worth escalating; 'fatal' is a
+    request no model would accept and 'refused' one that admission control
+    turned away before it reached the model.
+    """
+    if error is not None:
+        if isinstance(error, AdmissionError):
+            return "refused"
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None) or getattr(error, "code", None)
+        return "fatal" if status in FATAL_STATUS else "error"
+    if not answer.strip():
+        return "empty"
+    if finish_reason in TRUNCATED_REASONS:
+        return "truncated"
+    return None
+
+
+class ModelStats:
+    """Recent outcomes and latencies of one model"""
+
+    def __init__(self, window: int = 100):
+        self.failures: Deque[bool] = deque(maxlen=window)
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.attempts = 0
+        self.reasons: Dict[str, int] = {}
+        # Queries routed past this model since it was last tried
+        self.skipped = 0
+
+    def record(self, reason: Optional[str], total_ms: Optional[float]) -> None:
+        self.attempts += 1
+        self.skipped = 0
+        # The failure rate is how often the model needed escalating
+        self.failures.append(reason in ESCALATE_REASONS)
+        if reason is not None:
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        elif total_ms is not None:
+            self.latencies.append(total_ms)
+
+    def failure_rate(self) -> float:
+        return sum(self.failures) / len(self.failures) if self.failures else 0.0
+
+    def latency_p50(self) -> Optional[float]:
+        samples = sorted(self.latencies)
+        return samples[len(samples) // 2] if samples else None
+
+
+class Route:
+    """Models a query may be asked of, from the chosen tier up, and the escalations so far"""
+
+    def __init__(self, models: Sequence[str], start: int, reason: str, max_escalations: int):
+        self.models = list(models)
+        self.index = start
+        self.reason = reason
+        self.max_escalations = max_escalations
+        self.escalations: List[dict] = []
+
+    @property
+    def model(self) -> str:
+        return self.models[self.index]
+
+    def escalate(self, reason: str) -> Optional[str]:
+        """Move one tier up after a bad answer; None if there is nowhere left to go"""
+        if self.index + 1 >= len(self.models) or len(self.escalations) >= self.max_escalations:
+            return None
+        self.escalations.append({"from": self.model, "to": self.models[self.index + 1], "reason": reason})
+        self.index += 1
+        return self.model
+
+    def report(self) -> dict:
+        return {"model": self.model, "initial": self.escalations[0]["from"] if self.escalations else self.model,
+                "reason": self.reason, "escalations": self.escalations}
+
+
+class ModelRouter:
+    """Picks the cheapest model expected to answer a query, and escalates bad answers"""
+
+    def __init__(self, tiers: Optional[Dict[str, List[str]]] = None, long_prompt_tokens: int = 200,
+                 large_image_tokens: int = 1200, large_image_bytes: int = 300 * 1024, max_failure_rate: float = 0.3, min_samples: int = 10,
+                 latency_target_ms: Optional[float] = None, max_escalations: int = 1, probe_every: int = 20,
+                 window: int = 100):
+        """
+        Args:
+            tiers: Models per provider name, cheapest first; providers not listed
+                use only their configured model
+            long_prompt_tokens: Prompts longer than this start one tier up
+            large_image_tokens: Preprocessed images costing more than this start one tier up
+            large_image_bytes: Preprocessed images larger than this start one tier up
+            max_failure_rate: Skip a tier when more of its recent answers needed escalating
+            min_samples: Answers needed before a tier's history is trusted
+            latency_target_ms: Skip a tier whose median latency misses this when a
+                stronger one meets it; None to ignore latency
+            max_escalations: Retries on stronger models per query
+            probe_every: Try a skipped tier again after this many queries, so it can recover
+            window: Recent answers remembered per model
+        """
+        self.tiers = dict(tiers or {})
+        self.long_prompt_tokens = long_prompt_tokens
+        self.large_image_tokens = large_image_tokens
+        self.large_image_bytes = large_image_bytes
+        self.max_failure_rate = max_failure_rate
+        self.min_samples = min_samples
+        self.latency_target_ms = latency_target_ms
+        self.max_escalations = max_escalations
+        self.probe_every = probe_every
+        self.window = window
+        self.models: Dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, options: dict) -> Optional["ModelRouter"]:
+        """Build the router from the ``routing`` config section, or None if disabled"""
+        if not options.get("enabled", True):
+            return None
+        return cls(
+            tiers=options.get("tiers"),
+            long_prompt_tokens=options.get("long_prompt_tokens", 200),
+            large_image_tokens=options.get("large_image_tokens", 1200),
+            large_image_bytes=int(options.get("large_image_kb", 300) * 1024),
+            max_failure_rate=options.get("max_failure_rate", 0.3),
+            min_samples=options.get("min_samples", 10),
+            latency_target_ms=options.get("latency_target_ms"),
+            max_escalations=options.get("max_escalations", 1),
+            probe_every=options.get("probe_every", 20),
+        )
+
+    def tiers_for(self, provider: str, default_model: str) -> List[str]:
+        """The provider's ladder; its configured model alone when no ladder is set"""
+        if provider in self.tiers:
+            return list(self.tiers[provider]) or [default_model]
+        if provider == "gemini":
+            # Only a Gemini query gets here, and it has loaded google-genai already
+            from .geminiapi import GeminiModel
+            return [GeminiModel.GEMINI_2_FLASH.value, GeminiModel.GEMINI_1_5_PRO.value]
+        return [default_model]
+
+    def route(self, provider: str, default_model: str, prompt: str,
+              images: Sequence[EncodedImage] = ()) -> Route:
+        """Choose the starting tier for a prompt and its images, as encoded for the lowest tier"""
+        models = self.tiers_for(provider, default_model)
+        start, reasons = 0, []
+        if estimate_tokens(prompt, max_output=0) > self.long_prompt_tokens:
+            reasons.append("long prompt")
+        if (estimate_tokens("", [encoded.size for encoded in images], max_output=0) > self.large_image_tokens
+                or sum(len(encoded.data) for encoded in images) > self.large_image_bytes):
+            reasons.append("large image")
+        if reasons:
+            start = min(1, len(models) - 1)
+
+        with self._lock:
+            while start + 1 < len(models):
+                stats = self.models.get(models[start])
+                if stats is None or len(stats.failures) < self.min_samples:
+                    break
+                if stats.skipped >= self.probe_every:
+                    reasons.append(f"probing {models[start]}")
+                    break
+                if stats.failure_rate() > self.max_failure_rate:
+                    reasons.append(f"{models[start]} often escalated")
+                elif self._too_slow(stats, self.models.get(models[start + 1])):
+                    reasons.append(f"{models[start]} too slow")
+                else:
+                    break
+                stats.skipped += 1
+                start += 1
+        return Route(models, start, ", ".join(reasons) or "default", self.max_escalations)
+
+    def _too_slow(self, stats: ModelStats, stronger: Optional[ModelStats]) -> bool:
+        if self.latency_target_ms is None or stronger is None or len(stronger.latencies) < self.min_samples:
+            return False
+        slow, fast = stats.latency_p50(), stronger.latency_p50()
+        return slow is not None and fast is not None and slow > self.latency_target_ms >= fast
+
+    def record(self, model: str, reason: Optional[str], total_ms: Optional[float] = None) -> None:
+        """Remember how ``model`` did: ``reason`` from ``classify``, None for a good answer"""
+        with self._lock:
+            self.models.setdefault(model, ModelStats(self.window)).record(reason, total_ms)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {model: {"attempts": stats.attempts, "failure_rate": round(stats.failure_rate(), 3),
+                            "latency_p50_ms": stats.latency_p50(), "failures": dict(stats.reasons)}
+                    for model, stats in self.models.items()}
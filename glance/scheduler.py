@@ -0,0 +1,145 @@
+"""Request scheduling on a single background asyncio loop.
+
+All provider I/O is submitted to one event loop running on a daemon thread.
+Each job gets an end-to-end deadline, can be cancelled from the UI, and runs
+under a semaphore that bounds how many requests are in flight. The provider
+clients themselves are blocking (requests, genai), so jobs execute in a small
+thread pool owned by the loop and stop cooperatively when cancelled. A job
+that is cancelled or times out keeps its slot until its thread has actually
+returned, so the semaphore bounds the threads streaming, not just the jobs
+being waited for.
+
+Results reach Qt through the jobs' own signals: emitting a signal from this
+loop's threads queues the call onto the GUI thread.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RequestScheduler:
+    """Background asyncio loop that runs provider jobs with deadlines"""
+
+    def __init__(self, max_concurrency: int = 2, max_workers: int = 4):
+        """
+        Args:
+            max_concurrency: Jobs allowed in flight at once; others wait their turn
+            max_workers: Threads available for blocking provider calls
+        """
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix="glance-request")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._thread = threading.Thread(target=self._run_loop, name="glance-scheduler", daemon=True)
+        self._thread.start()
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.timed_out = 0
+
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, job: Callable[[], object], timeout: Optional[float] = None,
+               on_timeout: Optional[Callable[[], None]] = None) -> concurrent.futures.Future:
+        """Schedule a blocking job; safe to call from any thread
+
+        Args:
+            job: Callable doing the provider I/O
+            timeout: End-to-end deadline in seconds, including time spent waiting for a slot
+            on_timeout: Called (on the loop thread) when the deadline passes
+
+        Returns:
+            Future that can be cancelled to abandon the job
+        """
+        return asyncio.run_coroutine_threadsafe(self._run_job(job, timeout, on_timeout), self.loop)
+
+    def submit_within(self, job: Callable[[], object]) -> concurrent.futures.Future:
+        """Run a blocking job on the scheduler's threads without taking a slot
+
+        For I/O a running job does under its own slot, such as the primary
+        stream of a hedged query while the job itself waits for it.
+        """
+        return self._executor.submit(job)
+
+    def run_coroutine(self, coro) -> concurrent.futures.Future:
+        """Run a coroutine on the scheduler's loop"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run_blocking(self, job: Callable[[], object]):
+        """Await a blocking callable on the scheduler's thread pool"""
+        return await self.loop.run_in_executor(self._executor, job)
+
+    async def _run_job(self, job, timeout, on_timeout):
+        try:
+            return await asyncio.wait_for(self._guarded(job), timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            if on_timeout is not None:
+                on_timeout()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+    async def _guarded(self, job):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        work = self._executor.submit(job)
+        try:
+            result = await asyncio.wrap_future(work, loop=self.loop)
+            self.completed += 1
+            return result
+        finally:
+            if work.done():
+                self._release()
+            else:
+                # Abandoned while its thread still streams; it has been told to
+                # stop and keeps the slot until it does
+                work.add_done_callback(self._release_later)
+
+    def _release(self) -> None:
+        self.active -= 1
+        self._semaphore.release()
+
+    def _release_later(self, work: concurrent.futures.Future) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            # The loop has been shut down
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "timed_out": self.timed_out,
+        }
+
+    def shutdown(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=1)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_scheduler: Optional[RequestScheduler] = None
+
+
+def get_scheduler() -> RequestScheduler:
+    """Return the process-wide scheduler"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RequestScheduler()
+    return _scheduler
@@ -0,0 +1,273 @@
+"""Capture scopes.
+
+A query can look at the whole desktop, the monitor the pointer is on, the
+window that had focus before Glance, or a region the user drew. The scope is
+resolved to a rectangle in captured-frame pixels, and only that part of the
+screen is captured (or cropped out of a ring-buffer frame), so everything
+downstream, from change detection to the encoder's byte budget, works on the
+region the user cares about instead of the whole desktop.
+
+By the time a question is asked, Glance itself has focus and the pointer is
+usually over it, so ``ScopeTracker`` keeps sampling the pointer and the
+focused window while the widget is in the background and answers from the
+last sample taken before it was focused.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+from typing import Callable, Iterable, NamedTuple, Optional
+
+from PyQt5.QtCore import QObject, QPoint, QRect, QTimer
+from PyQt5.QtGui import QCursor, QGuiApplication
+
+from .screenshot import Rect
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ("desktop", "monitor", "window", "region")
+
+# Labels shown in the scope picker, in SCOPES order
+SCOPE_LABELS = {
+    "desktop": "Desktop",
+    "monitor": "Monitor",
+    "window": "Window",
+    "region": "Region...",
+}
+
+
+class CaptureScope(NamedTuple):
+    """What part of the screen a query captures
+
+    Attributes:
+        kind: One of ``SCOPES``
+        region: The user-drawn rectangle, for the 'region' scope
+    """
+    kind: str = "desktop"
+    region: Optional[Rect] = None
+
+    def describe(self) -> str:
+        if self.kind == "region" and self.region is not None:
+            return "region {}x{}+{}+{}".format(self.region[2], self.region[3], self.region[0], self.region[1])
+        return self.kind
+
+
+def to_frame_rect(rect: QRect) -> Rect:
+    """Convert a rectangle in Qt's logical desktop coordinates to captured-frame pixels"""
+    screen = QGuiApplication.primaryScreen()
+    origin = screen.virtualGeometry().topLeft()
+    ratio = screen.devicePixelRatio()
+    return (int((rect.x() - origin.x()) * ratio), int((rect.y() - origin.y()) * ratio),
+            int(rect.width() * ratio), int(rect.height() * ratio))
+
+
+def monitor_rect_at(point: QPoint) -> Optional[Rect]:
+    """The monitor containing ``point`` (logical coordinates), in frame pixels"""
+    screen = QGuiApplication.screenAt(point)
+    if screen is None:
+        return None
+    return to_frame_rect(screen.geometry())
+
+
+_X_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+
+
+class X11WindowLocator:
+    """Geometry of the focused top-level window, read from ``_NET_ACTIVE_WINDOW``"""
+
+    _ANY_PROPERTY_TYPE = 0
+
+    def __init__(self):
+        self._x11 = None
+        self._display = None
+        self._root = None
+        self._active_atom = None
+        self._x_error = False
+        # Keep a reference so the callback is not garbage collected
+        self._error_handler = _X_ERROR_HANDLER(self._on_x_error)
+
+    def _on_x_error(self, display, event):
+        # The default Xlib handler exits the process on BadWindow
+        self._x_error = True
+        return 0
+
+    def available(self) -> bool:
+        if not os.environ.get("DISPLAY") or os.environ.get('XDG_SESSION_TYPE') == 'wayland':
+            return False
+        if self._display is not None:
+            return True
+        name = ctypes.util.find_library("X11")
+        if not name:
+            return False
+        try:
+            x11 = ctypes.CDLL(name)
+        except OSError:
+            return False
+        x11.XOpenDisplay.restype = ctypes.c_void_p
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        x11.XDefaultRootWindow.restype = ctypes.c_ulong
+        x11.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        x11.XInternAtom.restype = ctypes.c_ulong
+        x11.XInternAtom.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+        x11.XGetWindowProperty.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_long, ctypes.c_long, ctypes.c_int,
+            ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_int),
+            ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_void_p),
+        ]
+        x11.XGetGeometry.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong),
+            ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int),
+            ctypes.POINTER(ctypes.c_uint), ctypes.POINTER(ctypes.c_uint),
+            ctypes.POINTER(ctypes.c_uint), ctypes.POINTER(ctypes.c_uint),
+        ]
+        x11.XTranslateCoordinates.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_ulong),
+        ]
+        x11.XFree.argtypes = [ctypes.c_void_p]
+        x11.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        # Passed and returned as plain pointers so the previous handler can be restored
+        x11.XSetErrorHandler.restype = ctypes.c_void_p
+        x11.XSetErrorHandler.argtypes = [ctypes.c_void_p]
+
+        display = x11.XOpenDisplay(None)
+        if not display:
+            return False
+        self._x11 = x11
+        self._display = display
+        self._root = x11.XDefaultRootWindow(display)
+        self._active_atom = x11.XInternAtom(display, b"_NET_ACTIVE_WINDOW", 0)
+        return True
+
+    def active_window(self) -> Optional[int]:
+        x11 = self._x11
+        actual_type, actual_format = ctypes.c_ulong(), ctypes.c_int()
+        items, remaining = ctypes.c_ulong(), ctypes.c_ulong()
+        prop = ctypes.c_void_p()
+        status = x11.XGetWindowProperty(self._display, self._root, self._active_atom, 0, 1, 0,
+                                        self._ANY_PROPERTY_TYPE, ctypes.byref(actual_type),
+                                        ctypes.byref(actual_format), ctypes.byref(items),
+                                        ctypes.byref(remaining), ctypes.byref(prop))
+        if status != 0 or not prop.value:
+            return None
+        try:
+            if items.value < 1 or actual_format.value != 32:
+                return None
+            # 32-bit format properties are returned as an array of C longs
+            return ctypes.cast(prop, ctypes.POINTER(ctypes.c_ulong))[0] or None
+        finally:
+            x11.XFree(prop)
+
+    def geometry(self, window: int) -> Optional[Rect]:
+        """Position and size of ``window`` relative to the root window"""
+        x11 = self._x11
+        root, child = ctypes.c_ulong(), ctypes.c_ulong()
+        x, y = ctypes.c_int(), ctypes.c_int()
+        width, height, border, depth = ctypes.c_uint(), ctypes.c_uint(), ctypes.c_uint(), ctypes.c_uint()
+        if not x11.XGetGeometry(self._display, window, ctypes.byref(root), ctypes.byref(x), ctypes.byref(y),
+                                ctypes.byref(width), ctypes.byref(height), ctypes.byref(border),
+                                ctypes.byref(depth)):
+            return None
+        if not x11.XTranslateCoordinates(self._display, window, self._root, 0, 0,
+                                         ctypes.byref(x), ctypes.byref(y), ctypes.byref(child)):
+            return None
+        return x.value, y.value, width.value, height.value
+
+    def focused_window_rect(self, exclude: Iterable[int] = ()) -> Optional[Rect]:
+        """Root-window rectangle of the focused window, unless it is one of ``exclude``
+
+        On X11 the root window's origin is the top-left of the captured
+        desktop, so the result is already in frame pixels.
+        """
+        if not self.available():
+            return None
+        previous = self._x11.XSetErrorHandler(ctypes.cast(self._error_handler, ctypes.c_void_p))
+        self._x_error = False
+        try:
+            window = self.active_window()
+            if window is None or window in set(exclude):
+                return None
+            rect = self.geometry(window)
+            self._x11.XSync(self._display, 0)
+            return None if self._x_error else rect
+        finally:
+            self._x11.XSetErrorHandler(previous)
+
+
+class ScopeTracker(QObject):
+    """Resolves capture scopes to rectangles from state sampled before Glance took focus"""
+
+    def __init__(self, own_windows: Callable[[], Iterable[int]] = lambda: (), interval_ms: int = 500,
+                 parent=None):
+        """
+        Args:
+            own_windows: Returns Glance's own window ids, which are never the 'focused window'
+            interval_ms: Time between samples while the widget is in the background
+        """
+        super().__init__(parent)
+        self.own_windows = own_windows
+        self.windows = X11WindowLocator()
+        self.scope = CaptureScope()
+        self.cursor: Optional[QPoint] = None
+        self.window_rect: Optional[Rect] = None
+        self.active = False
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.sample)
+
+    def set_scope(self, scope: CaptureScope) -> None:
+        """Remember ``scope`` for the rest of the session"""
+        self.scope = scope
+        self._update_timer()
+
+    def set_active(self, active: bool) -> None:
+        """Track widget focus; sampling pauses while the user is in Glance"""
+        was_active, self.active = self.active, active
+        if was_active and not active:
+            self.sample()
+        self._update_timer()
+
+    def _update_timer(self) -> None:
+        # Only the pointer and window scopes need to know what happened before focus
+        if not self.active and self.scope.kind in ("monitor", "window"):
+            if not self.timer.isActive():
+                self.timer.start()
+        else:
+            self.timer.stop()
+
+    def sample(self) -> None:
+        if self.active:
+            return
+        self.cursor = QCursor.pos()
+        if self.scope.kind == "window":
+            rect = self.windows.focused_window_rect(exclude=self.own_windows())
+            if rect is not None:
+                self.window_rect = rect
+
+    def rect(self, scope: Optional[CaptureScope] = None) -> Optional[Rect]:
+        """Rectangle to capture for ``scope`` (default: the session scope), None for the whole desktop"""
+        rect = self._resolve(scope or self.scope)
+        if rect is None:
+            return None
+        # Keep it on the desktop; a window half off-screen is captured where visible
+        left, top, width, height = rect
+        desktop = to_frame_rect(QGuiApplication.primaryScreen().virtualGeometry())
+        right, bottom = min(left + width, desktop[2]), min(top + height, desktop[3])
+        left, top = max(0, left), max(0, top)
+        if right <= left or bottom <= top:
+            return None
+        return left, top, right - left, bottom - top
+
+    def _resolve(self, scope: CaptureScope) -> Optional[Rect]:
+        if scope.kind == "region":
+            return scope.region
+        if scope.kind == "window":
+            rect = self.window_rect
+            if rect is None and not self.active:
+                rect = self.windows.focused_window_rect(exclude=self.own_windows())
+            if rect is not None:
+                return rect
+            logger.debug("No focused window geometry, capturing the monitor instead")
+        if scope.kind in ("monitor", "window"):
+            return monitor_rect_at(self.cursor if self.cursor is not None else QCursor.pos())
+        return None
@@ -1,17 +1,482 @@
-import subprocess
+"""Screen capture engine.
+
+Captures the desktop straight into an in-memory pixel buffer. Several
+backends are tried in order of speed (Qt, X11 MIT-SHM, then the external
+gnome-screenshot/scrot tools) and the first one that works is cached for
+the rest of the session.
+
+Run ``python -m glance.screenshot`` (e.g. under ``xvfb-run``) to probe the
+backends on the current display and print their capture timings.
+"""
+import ctypes
+import ctypes.util
+import logging
 import os
-from datetime import datetime
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import List, Optional, Tuple
+
+from .frame import Frame
+
+logger = logging.getLogger(__name__)
+
+# x, y, width, height in captured-frame pixels, relative to the desktop's top-left corner
+Rect = Tuple[int, int, int, int]
+
+
+class CaptureError(Exception):
+    """Raised when a backend cannot capture the screen"""
+
+
+class PixelBuffer:
+    """Raw pixels of a captured screen
+
+    Attributes:
+        data: Pixel bytes, ``stride`` bytes per row
+        width: Width in pixels
+        height: Height in pixels
+        raw_mode: PIL raw mode describing the pixel layout ('BGRX' or 'RGB')
+        stride: Bytes per row, including any padding
+        backend: Name of the backend that produced the buffer
+        elapsed_ms: Time the capture took
+    """
+
+    def __init__(self, data: bytes, width: int, height: int, raw_mode: str = "RGB",
+                 stride: Optional[int] = None, backend: str = "", elapsed_ms: float = 0.0):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.raw_mode = raw_mode
+        self.stride = stride or width * len(raw_mode)
+        self.backend = backend
+        self.elapsed_ms = elapsed_ms
+
+    @property
+    def bytes_per_pixel(self) -> int:
+        return len(self.raw_mode)
+
+    def clip(self, rect: Rect) -> Rect:
+        """``rect`` clipped to the buffer; the width or height is 0 if nothing is left"""
+        x, y, width, height = rect
+        left, top = max(0, x), max(0, y)
+        right, bottom = min(self.width, x + width), min(self.height, y + height)
+        return left, top, max(0, right - left), max(0, bottom - top)
+
+    def crop(self, rect: Rect) -> "PixelBuffer":
+        """New buffer holding the pixels inside ``rect``, clipped to the buffer"""
+        x, y, width, height = self.clip(rect)
+        bpp = self.bytes_per_pixel
+        data = memoryview(self.data)
+        rows = [data[row * self.stride + x * bpp:row * self.stride + (x + width) * bpp]
+                for row in range(y, y + height)]
+        return PixelBuffer(b"".join(rows), width, height, raw_mode=self.raw_mode,
+                           backend=self.backend, elapsed_ms=self.elapsed_ms)
+
+    def to_image(self):
+        """Decode the buffer into an RGB PIL image (no copy of the source bytes)"""
+        from PIL import Image
+        return Image.frombuffer("RGB", (self.width, self.height), self.data,
+                                "raw", self.raw_mode, self.stride, 1)
+
+    def __repr__(self):
+        return (f"PixelBuffer({self.width}x{self.height} {self.raw_mode}, "
+                f"backend={self.backend!r}, {self.elapsed_ms:.1f}ms)")
+
+
+class CaptureBackend:
+    """Base class for capture backends"""
+    name = "base"
+
+    def available(self) -> bool:
+        """Cheap check whether the backend can work in this session"""
+        return False
+
+    def capture(self, rect: Optional[Rect] = None) -> PixelBuffer:
+        """Capture the whole desktop, or only ``rect`` of it
+
+        Raises:
+            CaptureError: If the capture failed
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release any resources held by the backend"""
+
+
+class QtCaptureBackend(CaptureBackend):
+    """Capture via ``QScreen.grabWindow``. Must be used from the GUI thread."""
+    name = "qt"
+
+    def available(self) -> bool:
+        # grabWindow returns black frames on Wayland compositors
+        if os.environ.get('XDG_SESSION_TYPE') == 'wayland':
+            return False
+        try:
+            from PyQt5.QtGui import QGuiApplication
+        except ImportError:
+            return False
+        return QGuiApplication.instance() is not None and QGuiApplication.primaryScreen() is not None
+
+    def capture(self, rect: Optional[Rect] = None) -> PixelBuffer:
+        from PyQt5.QtGui import QGuiApplication, QImage
+
+        screen = QGuiApplication.primaryScreen()
+        geometry = screen.virtualGeometry()
+        x, y, width, height = geometry.x(), geometry.y(), geometry.width(), geometry.height()
+        if rect is not None:
+            # grabWindow takes logical coordinates; only the region is read back
+            ratio = screen.devicePixelRatio()
+            x, y = x + int(rect[0] / ratio), y + int(rect[1] / ratio)
+            width, height = max(1, round(rect[2] / ratio)), max(1, round(rect[3] / ratio))
+        pixmap = screen.grabWindow(0, x, y, width, height)
+        if pixmap.isNull() or pixmap.width() == 0:
+            raise CaptureError("QScreen.grabWindow returned an empty pixmap")
+
+        image = pixmap.toImage().convertToFormat(QImage.Format_RGB32)
+        bits = image.constBits()
+        bits.setsize(image.sizeInBytes())
+        # Format_RGB32 is 0xffRRGGBB per pixel, i.e. BGRX in memory on little-endian hosts
+        return PixelBuffer(bytes(bits), image.width(), image.height(),
+                           raw_mode="BGRX", stride=image.bytesPerLine())
+
+
+class _XImage(ctypes.Structure):
+    # Only the leading fields of XImage are declared; we never allocate one ourselves
+    _fields_ = [
+        ("width", ctypes.c_int),
+        ("height", ctypes.c_int),
+        ("xoffset", ctypes.c_int),
+        ("format", ctypes.c_int),
+        ("data", ctypes.c_void_p),
+        ("byte_order", ctypes.c_int),
+        ("bitmap_unit", ctypes.c_int),
+        ("bitmap_bit_order", ctypes.c_int),
+        ("bitmap_pad", ctypes.c_int),
+        ("depth", ctypes.c_int),
+        ("bytes_per_line", ctypes.c_int),
+        ("bits_per_pixel", ctypes.c_int),
+    ]
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ("shmseg", ctypes.c_ulong),
+        ("shmid", ctypes.c_int),
+        ("shmaddr", ctypes.c_void_p),
+        ("readOnly", ctypes.c_int),
+    ]
+
+
+_X_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+
+
+class XShmCaptureBackend(CaptureBackend):
+    """Capture the X11 root window through the MIT-SHM extension
+
+    The shared memory segment is created once and reused, so each capture is
+    a single server round-trip plus one memcpy out of the segment.
+    """
+    name = "xshm"
+
+    _ZPIXMAP = 2
+    _IPC_PRIVATE = 0
+    _IPC_CREAT = 0o1000
+    _IPC_RMID = 0
+
+    def __init__(self):
+        self._x11 = None
+        self._xext = None
+        self._libc = None
+        self._display = None
+        self._image = None
+        self._shm = None
+        self._size = None
+        self._x_error = None
+        # Keep a reference so the callback is not garbage collected
+        self._error_handler = _X_ERROR_HANDLER(self._on_x_error)
+
+    def _on_x_error(self, display, event):
+        # The default Xlib handler exits the process; record the error instead
+        self._x_error = True
+        return 0
 
-def take_screenshot():
-    filename = f"screenshots/screenshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-    os.makedirs("screenshots", exist_ok=True)
+    def _load_libraries(self) -> bool:
+        if self._x11 is not None:
+            return True
+        names = [ctypes.util.find_library(lib) for lib in ("X11", "Xext", "c")]
+        if not all(names):
+            return False
+        x11, xext, libc = (ctypes.CDLL(name) for name in names)
 
+        x11.XOpenDisplay.restype = ctypes.c_void_p
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        x11.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        x11.XRootWindow.restype = ctypes.c_ulong
+        x11.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultVisual.restype = ctypes.c_void_p
+        x11.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XFree.argtypes = [ctypes.c_void_p]
+        x11.XSetErrorHandler.restype = ctypes.c_void_p
+        x11.XSetErrorHandler.argtypes = [_X_ERROR_HANDLER]
+
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        xext.XShmCreateImage.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p,
+            ctypes.POINTER(_XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint,
+        ]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage), ctypes.c_int, ctypes.c_int, ctypes.c_ulong,
+        ]
+
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+        self._x11, self._xext, self._libc = x11, xext, libc
+        return True
+
+    def available(self) -> bool:
+        if not os.environ.get("DISPLAY") or os.environ.get('XDG_SESSION_TYPE') == 'wayland':
+            return False
+        try:
+            return self._load_libraries()
+        except OSError:
+            return False
+
+    def _open(self) -> None:
+        x11, xext, libc = self._x11, self._xext, self._libc
+        x11.XSetErrorHandler(self._error_handler)
+
+        display = x11.XOpenDisplay(None)
+        if not display:
+            raise CaptureError("Cannot open X display")
+        if not xext.XShmQueryExtension(display):
+            x11.XCloseDisplay(display)
+            raise CaptureError("X server does not support MIT-SHM")
+
+        screen = x11.XDefaultScreen(display)
+        width = x11.XDisplayWidth(display, screen)
+        height = x11.XDisplayHeight(display, screen)
+
+        shm = _XShmSegmentInfo()
+        image = xext.XShmCreateImage(display, x11.XDefaultVisual(display, screen),
+                                     x11.XDefaultDepth(display, screen), self._ZPIXMAP,
+                                     None, ctypes.byref(shm), width, height)
+        if not image:
+            x11.XCloseDisplay(display)
+            raise CaptureError("XShmCreateImage failed")
+
+        size = image.contents.bytes_per_line * height
+        shm.shmid = libc.shmget(self._IPC_PRIVATE, size, self._IPC_CREAT | 0o600)
+        if shm.shmid < 0:
+            x11.XFree(image)
+            x11.XCloseDisplay(display)
+            raise CaptureError("shmget failed")
+        shm.shmaddr = libc.shmat(shm.shmid, None, 0)
+        shm.readOnly = 0
+        image.contents.data = shm.shmaddr
+
+        self._x_error = False
+        xext.XShmAttach(display, ctypes.byref(shm))
+        x11.XSync(display, 0)
+        # The segment is freed automatically once both sides have detached
+        libc.shmctl(shm.shmid, self._IPC_RMID, None)
+
+        self._display, self._image, self._shm, self._size = display, image, shm, size
+        if self._x_error:
+            # Typically a remote display that cannot see our shared memory
+            self.close()
+            raise CaptureError("XShmAttach failed")
+
+    def capture(self, rect: Optional[Rect] = None) -> PixelBuffer:
+        if not self.available():
+            raise CaptureError("X11 MIT-SHM is not available")
+        if self._display is None:
+            self._open()
+
+        image = self._image
+        self._x_error = False
+        root = self._x11.XRootWindow(self._display, self._x11.XDefaultScreen(self._display))
+        ok = self._xext.XShmGetImage(self._display, root, image, 0, 0, 0xFFFFFFFF)
+        if not ok or self._x_error:
+            # The screen may have been resized; rebuild the segment next time
+            self.close()
+            raise CaptureError("XShmGetImage failed")
+
+        contents = image.contents
+        if contents.bits_per_pixel != 32:
+            raise CaptureError(f"Unsupported X11 pixel depth: {contents.bits_per_pixel} bpp")
+        stride = contents.bytes_per_line
+        if rect is not None:
+            # Copy only the rows of the region out of the segment
+            full = PixelBuffer(b"", contents.width, contents.height, raw_mode="BGRX", stride=stride)
+            x, y, width, height = full.clip(rect)
+            data = ctypes.string_at(self._shm.shmaddr + y * stride, height * stride)
+            return PixelBuffer(data, contents.width, height, raw_mode="BGRX", stride=stride).crop(
+                (x, 0, width, height))
+        data = ctypes.string_at(self._shm.shmaddr, self._size)
+        return PixelBuffer(data, contents.width, contents.height,
+                           raw_mode="BGRX", stride=stride)
+
+    def close(self) -> None:
+        if self._display is None:
+            return
+        self._xext.XShmDetach(self._display, ctypes.byref(self._shm))
+        self._x11.XSync(self._display, 0)
+        self._libc.shmdt(self._shm.shmaddr)
+        # The pixel memory belongs to the shm segment, so only free the XImage struct
+        self._image.contents.data = None
+        self._x11.XFree(self._image)
+        self._x11.XCloseDisplay(self._display)
+        self._display = self._image = self._shm = self._size = None
+
+
+class SubprocessCaptureBackend(CaptureBackend):
+    """Last-resort capture through gnome-screenshot or scrot"""
+    name = "subprocess"
+
+    TOOLS = [
+        ("gnome-screenshot", ["-f"]),
+        ("scrot", ["-o"]),
+    ]
+
+    def available(self) -> bool:
+        return any(shutil.which(tool) for tool, _ in self.TOOLS)
+
+    def capture(self, rect: Optional[Rect] = None) -> PixelBuffer:
+        from PIL import Image
+
+        with tempfile.TemporaryDirectory(prefix="glance-") as tmp:
+            filename = os.path.join(tmp, "capture.png")
+            for tool, args in self.TOOLS:
+                if not shutil.which(tool):
+                    continue
+                try:
+                    subprocess.run([tool, *args, filename], check=True, capture_output=True)
+                except (subprocess.CalledProcessError, OSError):
+                    continue
+                if os.path.exists(filename):
+                    with Image.open(filename) as img:
+                        img = img.convert("RGB")
+                        buffer = PixelBuffer(img.tobytes(), img.width, img.height, raw_mode="RGB")
+                        return buffer if rect is None else buffer.crop(rect)
+        raise CaptureError("No screenshot tool succeeded")
+
+
+class CaptureEngine:
+    """Captures the screen with the fastest working backend
+
+    The backend is chosen the first time it is needed (or explicitly via
+    ``select_backend`` at startup) and cached. If the cached backend starts
+    failing, the engine falls back to the next one in the list.
+    """
+
+    def __init__(self, backends: Optional[List[CaptureBackend]] = None):
+        self.backends = backends or [QtCaptureBackend(), XShmCaptureBackend(), SubprocessCaptureBackend()]
+        self.backend: Optional[CaptureBackend] = None
+        self.last_elapsed_ms = 0.0
+
+    def select_backend(self) -> Optional[CaptureBackend]:
+        """Probe the backends in order and cache the first one that captures successfully
+
+        Returns:
+            The selected backend, or None if none works
+        """
+        self.backend = None
+        for backend in self.backends:
+            if self._try(backend) is not None:
+                break
+        return self.backend
+
+    def _try(self, backend: CaptureBackend, rect: Optional[Rect] = None) -> Optional[PixelBuffer]:
+        if not backend.available():
+            return None
+        start = time.perf_counter()
+        try:
+            buffer = backend.capture(rect)
+        except CaptureError as e:
+            logger.debug("Capture backend %s failed: %s", backend.name, e)
+            return None
+        buffer.backend = backend.name
+        buffer.elapsed_ms = (time.perf_counter() - start) * 1000
+        self.backend = backend
+        self.last_elapsed_ms = buffer.elapsed_ms
+        return buffer
+
+    def capture(self, rect: Optional[Rect] = None) -> PixelBuffer:
+        """Capture the desktop, or the ``rect`` part of it, into memory
+
+        Raises:
+            CaptureError: If every backend fails
+        """
+        if self.backend is not None:
+            buffer = self._try(self.backend, rect)
+            if buffer is not None:
+                return buffer
+        for backend in self.backends:
+            if backend is self.backend:
+                continue
+            buffer = self._try(backend, rect)
+            if buffer is not None:
+                return buffer
+        self.backend = None
+        raise CaptureError("No capture backend is available")
+
+    def close(self) -> None:
+        for backend in self.backends:
+            backend.close()
+
+
+_engine: Optional[CaptureEngine] = None
+
+
+def get_engine() -> CaptureEngine:
+    """Return the process-wide capture engine"""
+    global _engine
+    if _engine is None:
+        _engine = CaptureEngine()
+    return _engine
+
+
+def take_screenshot(rect: Optional[Rect] = None) -> Optional[Frame]:
+    """Capture the screen (or only ``rect`` of it) into an in-memory frame, or None if capture failed"""
     try:
-        subprocess.run(["gnome-screenshot", "-f", filename], check=True)
-        return filename
-    except:
+        return Frame(get_engine().capture(rect))
+    except CaptureError:
+        return None
+
+
+if __name__ == "__main__":
+    import sys
+    from PyQt5.QtWidgets import QApplication
+
+    app = QApplication(sys.argv)
+    for backend in get_engine().backends:
+        if not backend.available():
+            print(f"{backend.name:>10}: unavailable")
+            continue
+        timings = []
         try:
-            subprocess.run(["scrot", filename], check=True)
-            return filename
-        except:
-            return None
\ No newline at end of file
+            for _ in range(5):
+                start = time.perf_counter()
+                buffer = backend.capture()
+                timings.append((time.perf_counter() - start) * 1000)
+        except CaptureError as e:
+            print(f"{backend.name:>10}: failed ({e})")
+            continue
+        print(f"{backend.name:>10}: {buffer.width}x{buffer.height} "
+              f"best {min(timings):.1f}ms, mean {sum(timings) / len(timings):.1f}ms")
+    selected = get_engine().select_backend()
+    print(f"selected: {selected.name if selected else None}")
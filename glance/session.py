@@ -0,0 +1,122 @@
+"""Multi-turn sessions.
+
+In session mode the first question about a screen sends the screenshot, and
+follow-ups send only their text plus the conversation so far, until the
+screen changes (by perceptual hash) and a new screenshot is attached. Each
+provider turns the history into its own format: OpenAI-compatible endpoints
+get it as chat messages, and Gemini refers to the screenshot through the Files
+API once it has been uploaded. The history sent with a question is trimmed to
+a token budget, oldest turns first; the turn holding the current screenshot
+is always kept.
+"""
+import threading
+from typing import List, Optional, Sequence
+
+from .admission import estimate_tokens
+from .encoder import EncodedImage
+
+# Stands in for a screenshot from earlier in the conversation that is no longer sent
+OMITTED_IMAGE_NOTE = "[An earlier screenshot was attached here.]"
+
+
+class Turn:
+    """One question, the screenshots sent with it and the answer"""
+
+    def __init__(self, prompt: str, images: Sequence[EncodedImage] = (), answer: str = ""):
+        self.prompt = prompt
+        self.images = list(images)
+        self.answer = answer
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.prompt + self.answer, [encoded.size for encoded in self.images], max_output=0)
+
+    def without_images(self) -> "Turn":
+        return Turn(f"{OMITTED_IMAGE_NOTE}\n\n{self.prompt}", answer=self.answer)
+
+
+class Session:
+    """Conversation about the screen, trimmed to a token budget"""
+
+    def __init__(self, max_history_tokens: int = 4000, tolerance: int = 8, max_turns: int = 50):
+        """
+        Args:
+            max_history_tokens: Upper bound on the estimated tokens of history sent with a question
+            tolerance: Maximum Hamming distance between frame hashes for the screen
+                to count as unchanged
+            max_turns: Turns remembered at most, whatever their size
+        """
+        self.max_history_tokens = max_history_tokens
+        self.tolerance = tolerance
+        self.max_turns = max_turns
+        self.turns: List[Turn] = []
+        # Perceptual hash of the screen the latest screenshot showed
+        self.frame_hash: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, options: dict) -> "Session":
+        """Build a session from the ``session`` config section"""
+        return cls(
+            max_history_tokens=options.get("max_history_tokens", 4000),
+            tolerance=options.get("tolerance", 8),
+            max_turns=options.get("max_turns", 50),
+        )
+
+    def needs_image(self, frame_hash: Optional[int]) -> bool:
+        """Whether a question about the screen with ``frame_hash`` must attach it"""
+        with self._lock:
+            if self.frame_hash is None or frame_hash is None:
+                return True
+            return bin(self.frame_hash ^ frame_hash).count("1") > self.tolerance
+
+    def history(self, keep_image: bool = True) -> List[Turn]:
+        """Turns to send before the next question, oldest first
+
+        Only the newest turn with a screenshot keeps it (none do when
+        ``keep_image`` is False, because the question brings a new one); other
+        screenshots are replaced by a note. Turns are then dropped oldest first
+        until the history fits ``max_history_tokens``.
+        """
+        with self._lock:
+            turns = list(self.turns)
+        image_index = None
+        if keep_image:
+            image_index = max((i for i, turn in enumerate(turns) if turn.images), default=None)
+        turns = [turn if i == image_index or not turn.images else turn.without_images()
+                 for i, turn in enumerate(turns)]
+
+        kept = set()
+        budget = self.max_history_tokens
+        if image_index is not None:
+            kept.add(image_index)
+            budget -= turns[image_index].tokens
+        for i in range(len(turns) - 1, -1, -1):
+            if i in kept:
+                continue
+            cost = turns[i].tokens
+            if cost > budget:
+                break
+            kept.add(i)
+            budget -= cost
+        return [turns[i] for i in sorted(kept)]
+
+    def add(self, turn: Turn, frame_hash: Optional[int] = None) -> None:
+        """Record a completed turn; a turn with screenshots makes ``frame_hash`` the current screen"""
+        with self._lock:
+            self.turns.append(turn)
+            if turn.images:
+                self.frame_hash = frame_hash
+            if len(self.turns) > self.max_turns:
+                del self.turns[:len(self.turns) - self.max_turns]
+                if not any(turn.images for turn in self.turns):
+                    self.frame_hash = None
+
+    def reset(self) -> None:
+        with self._lock:
+            self.turns.clear()
+            self.frame_hash = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self.turns)
@@ -0,0 +1,156 @@
+"""Startup profiling.
+
+Run with ``--profile-startup`` (or ``GLANCE_PROFILE_STARTUP=1``) to report how
+long each module took to import and each initialization step took, up to
+the moment the window is first visible. Pass ``--profile-startup=path.json``
+to also write the report as JSON.
+"""
+import importlib.abc
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class _TimedLoader(importlib.abc.Loader):
+    """Wraps a module loader to time ``exec_module``"""
+
+    def __init__(self, loader, profiler: "StartupProfiler"):
+        self.loader = loader
+        self.profiler = profiler
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.profiler._enter_import()
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profiler._exit_import(module.__name__, (time.perf_counter() - start) * 1000)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class _TimingFinder(importlib.abc.MetaPathFinder):
+    """First finder on ``sys.meta_path``; defers to the others and wraps their loaders"""
+
+    def __init__(self, profiler: "StartupProfiler"):
+        self.profiler = profiler
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, self.profiler)
+                return spec
+        return None
+
+
+class StartupProfiler:
+    """Import times per module and durations of named startup steps"""
+
+    def __init__(self, enabled: bool = False, output: Optional[str] = None):
+        self.enabled = enabled
+        self.output = output
+        self.start = time.perf_counter()
+        self.marks: List[Tuple[str, float]] = []
+        # (module, inclusive ms, self ms)
+        self.imports: List[Tuple[str, float, float]] = []
+        # Per-thread stacks of time spent in nested imports
+        self._children: Dict[int, List[float]] = {}
+        self._finder = None
+        self.reported = False
+
+    @classmethod
+    def from_argv(cls, argv: List[str]) -> "StartupProfiler":
+        """Enable profiling from ``--profile-startup[=path]`` or GLANCE_PROFILE_STARTUP"""
+        output = os.environ.get("GLANCE_PROFILE_STARTUP")
+        enabled = bool(output)
+        for arg in list(argv):
+            if arg == "--profile-startup" or arg.startswith("--profile-startup="):
+                enabled = True
+                output = arg.partition("=")[2] or output
+                argv.remove(arg)
+        if output in ("1", "true", ""):
+            output = None
+        profiler = cls(enabled, output)
+        if enabled:
+            profiler.install()
+        return profiler
+
+    def install(self) -> None:
+        if self._finder is None:
+            self._finder = _TimingFinder(self)
+            sys.meta_path.insert(0, self._finder)
+
+    def uninstall(self) -> None:
+        if self._finder is not None and self._finder in sys.meta_path:
+            sys.meta_path.remove(self._finder)
+        self._finder = None
+
+    def _enter_import(self) -> None:
+        self._children.setdefault(threading.get_ident(), []).append(0.0)
+
+    def _exit_import(self, name: str, elapsed_ms: float) -> None:
+        stack = self._children[threading.get_ident()]
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed_ms
+        self.imports.append((name, elapsed_ms, elapsed_ms - nested))
+
+    def mark(self, label: str) -> None:
+        """Record that the step ``label`` has just finished"""
+        if self.enabled:
+            self.marks.append((label, (time.perf_counter() - self.start) * 1000))
+
+    def report(self, top: int = 25) -> dict:
+        """Print the profile once and return it; later calls only return it"""
+        steps = []
+        previous = 0.0
+        for label, at in self.marks:
+            steps.append({"step": label, "at_ms": round(at, 2), "took_ms": round(at - previous, 2)})
+            previous = at
+        slowest = sorted(self.imports, key=lambda item: item[2], reverse=True)[:top]
+        result = {
+            "total_ms": round(previous, 2),
+            "steps": steps,
+            "imports": [{"module": name, "self_ms": round(own, 2), "cumulative_ms": round(total, 2)}
+                        for name, total, own in slowest],
+            "import_count": len(self.imports),
+        }
+        if not self.enabled or self.reported:
+            return result
+        self.reported = True
+        self.uninstall()
+        out = sys.stderr
+        print(f"Startup profile: visible after {result['total_ms']:.1f}ms", file=out)
+        for step in steps:
+            print(f"  {step['step']:<24}{step['took_ms']:>9.1f}ms  (at {step['at_ms']:.1f}ms)", file=out)
+        print(f"Slowest of {len(self.imports)} imports (self / cumulative):", file=out)
+        for item in result["imports"]:
+            print(f"  {item['module']:<40}{item['self_ms']:>9.1f}ms {item['cumulative_ms']:>9.1f}ms", file=out)
+        if self.output:
+            with open(self.output, "w") as f:
+                json.dump(result, f, indent=2)
+        return result
+
+
+_profiler = StartupProfiler()
+
+
+def get_profiler() -> StartupProfiler:
+    """Return the process-wide profiler (disabled unless ``set_profiler`` enabled one)"""
+    return _profiler
+
+
+def set_profiler(profiler: StartupProfiler) -> None:
+    global _profiler
+    _profiler = profiler
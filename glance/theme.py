@@ -0,0 +1,126 @@
+"""Disk-cached qt_material stylesheet.
+
+``qt_material.build_stylesheet`` parses the theme XML, renders a Jinja
+template and regenerates its SVG icons on every call, and importing it pulls
+in Jinja. The compiled stylesheet and icons only depend on the theme, the
+extra settings and the qt_material version, so they are built once into a
+cache directory and later launches just read the file back.
+"""
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+from typing import Optional
+
+from PyQt5.QtCore import QDir
+from PyQt5.QtGui import QColor, QFontDatabase, QGuiApplication, QPalette
+
+logger = logging.getLogger(__name__)
+
+# Application fonts are registered once per process
+_fonts_added = False
+
+
+def default_cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "glance", "themes")
+
+
+def _qt_material_dir() -> Optional[str]:
+    """Package directory of qt_material, found without importing it"""
+    spec = importlib.util.find_spec("qt_material")
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    return list(spec.submodule_search_locations)[0]
+
+
+def _qt_material_version(package_dir: str) -> str:
+    # Read from the dist-info directory name; importlib.metadata is slower to import
+    site_dir = os.path.dirname(package_dir)
+    for entry in os.listdir(site_dir):
+        if entry.startswith("qt_material-") and entry.endswith((".dist-info", ".egg-info")):
+            return entry[len("qt_material-"):].rsplit(".", 1)[0]
+    # Fall back to the package's modification time
+    return str(int(os.path.getmtime(os.path.join(package_dir, "__init__.py"))))
+
+
+def _add_fonts(package_dir: str) -> None:
+    """Register the theme's Roboto fonts, as ``qt_material.add_fonts`` does, without importing it"""
+    global _fonts_added
+    if _fonts_added:
+        return
+    _fonts_added = True
+    fonts_dir = os.path.join(package_dir, "fonts", "roboto")
+    try:
+        fonts = [name for name in os.listdir(fonts_dir) if name.endswith(".ttf")]
+    except OSError:
+        return
+    for name in fonts:
+        QFontDatabase.addApplicationFont(os.path.join(fonts_dir, name))
+
+
+def _apply_side_effects(icons_dir: str, package_dir: str, primary_color: Optional[str]) -> None:
+    """What apply_stylesheet does besides building the stylesheet"""
+    _add_fonts(package_dir)
+    QDir.addSearchPath("icon", icons_dir)
+    QDir.addSearchPath("qt_material", os.path.join(package_dir, "resources"))
+    if primary_color:
+        palette = QGuiApplication.palette()
+        palette.setColor(QPalette.Text, QColor(*[int(primary_color[i:i + 2], 16) for i in range(1, 6, 2)], 92))
+        QGuiApplication.setPalette(palette)
+
+
+def load_stylesheet(theme: str, extra: Optional[dict] = None, cache_dir: Optional[str] = None) -> str:
+    """Compiled qt_material stylesheet for ``theme``, built on the first call only
+
+    Args:
+        theme: qt_material theme file name, e.g. 'dark_blue.xml'
+        extra: Extra theme settings passed to qt_material
+        cache_dir: Where compiled themes are kept, default ~/.cache/glance/themes
+
+    Returns:
+        str: The stylesheet, or an empty string if qt_material is unavailable
+    """
+    package_dir = _qt_material_dir()
+    if package_dir is None:
+        logger.warning("qt_material is not installed; using the default style")
+        return ""
+    extra = extra or {}
+    key_source = json.dumps([theme, _qt_material_version(package_dir), extra], sort_keys=True)
+    key = hashlib.sha1(key_source.encode("utf-8")).hexdigest()[:16]
+    directory = os.path.join(cache_dir or default_cache_dir(), f"{os.path.splitext(theme)[0]}-{key}")
+    stylesheet_path = os.path.join(directory, "stylesheet.qss")
+    meta_path = os.path.join(directory, "theme.json")
+    icons_dir = os.path.join(directory, "icons")
+
+    try:
+        with open(stylesheet_path) as f:
+            stylesheet = f.read()
+        with open(meta_path) as f:
+            meta = json.load(f)
+        _apply_side_effects(icons_dir, package_dir, meta.get("primaryColor"))
+        return stylesheet
+    except (OSError, ValueError):
+        pass
+
+    import qt_material
+    # Icons are generated into the cache directory so later launches can reuse them
+    stylesheet = qt_material.build_stylesheet(theme, extra=extra, parent=icons_dir)
+    if stylesheet is None:
+        return ""
+    theme_colors = qt_material.get_theme(theme) or {}
+    # Older qt_material releases cannot register these under PyQt5 themselves
+    _apply_side_effects(icons_dir, package_dir, theme_colors.get("primaryColor"))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{stylesheet_path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(stylesheet)
+        with open(meta_path, "w") as f:
+            json.dump({"theme": theme, "primaryColor": theme_colors.get("primaryColor")}, f)
+        # Written last so a half-built cache entry is never read back
+        os.replace(temp_path, stylesheet_path)
+    except OSError as e:
+        logger.warning("Could not cache stylesheet: %s", e)
+    return stylesheet
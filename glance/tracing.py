@@ -0,0 +1,388 @@
+"""Per-query tracing, rolling metrics and UI stall detection.
+
+A query is one trace: a root span opened when the user submits a question,
+with child spans for capture, preprocessing, request building, network and
+rendering. Spans can cross threads by passing the parent explicitly; within
+a thread, a new span nests under the innermost open one. Finished spans feed
+rolling histograms that back the stats panel, and can be exported as
+Prometheus text and as one JSON line per finished trace.
+
+``LagMonitor`` ticks a timer on the Qt event loop and records every tick that
+arrives more than a threshold late, together with the spans that were open
+on the UI thread while it was blocked. It is off unless ``tracing.stall_ms``
+sets the threshold.
+"""
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from PyQt5.QtCore import QObject, QTimer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the Prometheus histogram buckets
+MS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+BYTES_BUCKETS = (16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_ids = itertools.count(1)
+
+
+class Histogram:
+    """Cumulative buckets for export plus a rolling window for percentiles"""
+
+    def __init__(self, buckets=MS_BUCKETS, window_seconds: float = 300, max_samples: int = 1024):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.window_seconds = window_seconds
+        self.samples: Deque[Tuple[float, float]] = deque(maxlen=max_samples)
+
+    def observe(self, value: float) -> None:
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.total += 1
+        self.sum += value
+        self.samples.append((time.monotonic(), value))
+
+    def recent(self) -> List[float]:
+        cutoff = time.monotonic() - self.window_seconds
+        return [value for timestamp, value in self.samples if timestamp >= cutoff]
+
+    def percentiles(self, fractions=(0.5, 0.95)) -> Dict[str, Optional[float]]:
+        values = sorted(self.recent())
+        result = {}
+        for fraction in fractions:
+            key = f"p{int(fraction * 100)}"
+            result[key] = round(values[min(len(values) - 1, int(len(values) * fraction))], 2) if values else None
+        result["n"] = len(values)
+        return result
+
+
+class Span:
+    """A timed operation; use as a context manager or call ``finish``"""
+
+    def __init__(self, tracer: "Tracer", name: str, parent: Optional["Span"] = None,
+                 detached: bool = False, **attributes):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.root = parent.root if parent is not None else self
+        self.span_id = next(_ids)
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.duration_ms: Optional[float] = None
+        self.status = "ok"
+        # Finished spans of the whole trace, kept on the root for export
+        self.spans: List["Span"] = []
+        # A parentless span outside any trace only feeds the histograms
+        self.detached = detached
+        self._thread: Optional[int] = None
+
+    def child(self, name: str, **attributes) -> "Span":
+        return Span(self.tracer, name, parent=self, **attributes)
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def add(self, key: str, amount: float = 1) -> None:
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    @property
+    def finished(self) -> bool:
+        return self.duration_ms is not None
+
+    def finish(self, status: str = "ok", error: Optional[str] = None) -> None:
+        if self.finished:
+            return
+        self.duration_ms = (time.perf_counter() - self.start) * 1000
+        self.status = status
+        if error:
+            self.status = "error"
+            self.attributes["error"] = error
+        self.tracer._finished(self)
+
+    def __enter__(self) -> "Span":
+        self._thread = threading.get_ident()
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer._pop(self)
+        self.finish(error=str(exc) if exc is not None else None)
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent is not None else None,
+            "start_ms": round((self.start - self.root.start) * 1000, 3),
+            "duration_ms": round(self.duration_ms, 3) if self.duration_ms is not None else None,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """Collects spans, counters and histograms for the whole app"""
+
+    def __init__(self, window_seconds: float = 300, recent_traces: int = 50):
+        self.window_seconds = window_seconds
+        self.histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.traces: Deque[dict] = deque(maxlen=recent_traces)
+        self.stalls: Deque[dict] = deque(maxlen=recent_traces)
+        self.jsonl_path: Optional[str] = None
+        self.prometheus_path: Optional[str] = None
+        self.export_interval = 15.0
+        self._stacks: Dict[int, List[Span]] = {}
+        self._pending: List[str] = []
+        self._lock = threading.Lock()
+        self._exporter: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def configure(self, options: dict) -> "Tracer":
+        """Apply the ``tracing`` config section and start exporting if a path is set"""
+        self.jsonl_path = options.get("jsonl_path")
+        self.prometheus_path = options.get("prometheus_path")
+        self.export_interval = options.get("export_interval_s", 15)
+        if (self.jsonl_path or self.prometheus_path) and self._exporter is None:
+            self._exporter = threading.Thread(target=self._export_loop, name="glance-trace-export", daemon=True)
+            self._exporter.start()
+        return self
+
+    # Spans
+
+    def trace(self, name: str, **attributes) -> Span:
+        """Start a new root span"""
+        return Span(self, name, **attributes)
+
+    def span(self, name: str, parent: Optional[Span] = None, **attributes) -> Span:
+        """Start a span under ``parent``, or under this thread's innermost open span"""
+        if parent is None:
+            parent = self.current()
+        return Span(self, name, parent=parent, detached=parent is None, **attributes)
+
+    def current(self, thread_id: Optional[int] = None) -> Optional[Span]:
+        stack = self._stacks.get(thread_id if thread_id is not None else threading.get_ident())
+        return stack[-1] if stack else None
+
+    def active(self, thread_id: Optional[int] = None) -> List[str]:
+        """Names of the open spans on a thread (innermost last), or on every thread"""
+        with self._lock:
+            if thread_id is not None:
+                return [span.name for span in self._stacks.get(thread_id, ())]
+            return [span.name for stack in self._stacks.values() for span in stack]
+
+    def _push(self, span: Span) -> None:
+        with self._lock:
+            self._stacks.setdefault(span._thread, []).append(span)
+
+    def _pop(self, span: Span) -> None:
+        with self._lock:
+            stack = self._stacks.get(span._thread, [])
+            if span in stack:
+                stack.remove(span)
+            if not stack:
+                self._stacks.pop(span._thread, None)
+
+    def _finished(self, span: Span) -> None:
+        self.observe("span_duration_ms", span.duration_ms, span=span.name)
+        if span.status != "ok":
+            self.count("span_errors_total", span=span.name)
+        root = span.root
+        if span is not root:
+            root.spans.append(span)
+            return
+        if span.detached:
+            return
+        record = {
+            "trace_id": root.span_id,
+            "name": root.name,
+            "timestamp": round(root.wall_start, 3),
+            "duration_ms": round(root.duration_ms, 3),
+            "status": root.status,
+            "attributes": root.attributes,
+            "spans": [child.to_dict() for child in root.spans],
+        }
+        with self._lock:
+            self.traces.append(record)
+            if self.jsonl_path:
+                self._pending.append(json.dumps(record, default=str))
+
+    # Metrics
+
+    @staticmethod
+    def _key(metric: str, labels: dict) -> Tuple[str, Tuple]:
+        return metric, tuple(sorted(labels.items()))
+
+    def observe(self, metric: str, value: float, buckets=MS_BUCKETS, **labels) -> None:
+        key = self._key(metric, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets, self.window_seconds)
+            histogram.observe(value)
+
+    def count(self, metric: str, amount: float = 1, **labels) -> None:
+        key = self._key(metric, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def record_stall(self, lag_ms: float, spans: List[str], other: List[str]) -> None:
+        self.observe("ui_stall_ms", lag_ms)
+        self.count("ui_stalls_total")
+        with self._lock:
+            self.stalls.append({"timestamp": round(time.time(), 3), "lag_ms": round(lag_ms, 1),
+                                "span": spans[-1] if spans else None, "spans": spans, "background": other})
+
+    def percentiles(self, metric: str, **labels) -> Dict[str, Optional[float]]:
+        # Histograms are updated under the lock from any thread, so they are read under it too
+        with self._lock:
+            histogram = self.histograms.get(self._key(metric, labels))
+            return histogram.percentiles() if histogram is not None else {"p50": None, "p95": None, "n": 0}
+
+    def snapshot(self) -> dict:
+        """Recent percentiles per span, counters and the latest trace and stall"""
+        with self._lock:
+            spans = {dict(labels)["span"]: histogram.percentiles()
+                     for (metric, labels), histogram in self.histograms.items() if metric == "span_duration_ms"}
+            counters = dict(self.counters)
+            last_trace = self.traces[-1] if self.traces else None
+            last_stall = self.stalls[-1] if self.stalls else None
+        return {
+            "spans": spans,
+            "counters": {metric + (str(dict(labels)) if labels else ""): value
+                         for (metric, labels), value in counters.items()},
+            "last_trace": last_trace,
+            "last_stall": last_stall,
+        }
+
+    # Export
+
+    def prometheus_text(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}" if pairs else ""
+
+        with self._lock:
+            # Copied, so the buckets cannot change while they are written out
+            histograms = [(key, histogram.buckets, list(histogram.counts), histogram.total, histogram.sum)
+                          for key, histogram in sorted(self.histograms.items())]
+            counters = sorted(self.counters.items())
+        lines = []
+        for (metric, labels), value in counters:
+            name = f"glance_{metric}"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{label_text(labels)} {value:g}")
+        for (metric, labels), buckets, counts, total, total_sum in histograms:
+            name = f"glance_{metric}"
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {total}")
+            lines.append(f"{name}_sum{label_text(labels)} {total_sum:.3f}")
+            lines.append(f"{name}_count{label_text(labels)} {total}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self) -> None:
+        """Append finished traces to the JSONL file and rewrite the Prometheus file"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        try:
+            if pending and self.jsonl_path:
+                with open(self.jsonl_path, "a") as f:
+                    f.write("\n".join(pending) + "\n")
+            if self.prometheus_path:
+                temp_path = f"{self.prometheus_path}.tmp"
+                with open(temp_path, "w") as f:
+                    f.write(self.prometheus_text())
+                os.replace(temp_path, self.prometheus_path)
+        except OSError as e:
+            logger.warning("Could not export metrics: %s", e)
+
+    def _export_loop(self) -> None:
+        last_export = 0.0
+        while not self._stop.wait(1.0):
+            if self._pending or time.monotonic() - last_export >= self.export_interval:
+                self.flush()
+                last_export = time.monotonic()
+
+    def close(self) -> None:
+        self._stop.set()
+        self.flush()
+
+
+class LagMonitor(QObject):
+    """Records Qt event-loop stalls longer than ``threshold_ms``
+
+    A timer on the UI thread notes when it last ran; a watchdog thread notices
+    when it is overdue and samples the spans open on the UI thread while the
+    loop is still blocked, so the stall is attributed to what caused it.
+    """
+
+    def __init__(self, tracer: Tracer, threshold_ms: float = 100, interval_ms: int = 50, parent=None):
+        super().__init__(parent)
+        self.tracer = tracer
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.ui_thread = threading.get_ident()
+        self.last_tick = time.perf_counter()
+        self._sample: Optional[Tuple[List[str], List[str]]] = None
+        self._stop = threading.Event()
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.tick)
+        self._watchdog = threading.Thread(target=self._watch, name="glance-lag-watchdog", daemon=True)
+
+    def start(self) -> None:
+        self.last_tick = time.perf_counter()
+        self.timer.start()
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        self.timer.stop()
+        self._stop.set()
+
+    def tick(self) -> None:
+        now = time.perf_counter()
+        lag = now - self.last_tick - self.interval
+        self.last_tick = now
+        if lag > self.threshold:
+            spans, other = self._sample or (self.tracer.active(self.ui_thread), [])
+            self.tracer.record_stall(lag * 1000, spans, other)
+            logger.warning("UI thread stalled for %.0fms in %s", lag * 1000, spans[-1] if spans else "no span")
+        self._sample = None
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.threshold / 2):
+            overdue = time.perf_counter() - self.last_tick - self.interval
+            if overdue > self.threshold and self._sample is None:
+                ui = self.tracer.active(self.ui_thread)
+                other = [name for name in self.tracer.active() if name not in ui]
+                self._sample = (ui, other)
+
+
+_tracer: Optional[Tracer] = None
+
+
+def get_tracer() -> Tracer:
+    """Return the process-wide tracer"""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
@@ -1,25 +1,84 @@
 # widgets/floating_widget.py
 from PyQt5.QtWidgets import (
-    QWidget, QVBoxLayout, QHBoxLayout, QLabel, QStackedWidget
+    QWidget, QVBoxLayout, QHBoxLayout, QLabel, QStackedWidget, QPushButton
 )
-from PyQt5.QtCore import Qt, QPoint
+from PyQt5.QtCore import Qt, QPoint, QEvent
 from PyQt5.QtGui import QIcon
-from qt_material import apply_stylesheet
+import importlib
 import os
+import threading
 
 from pages.home_page import MainPage
 from pages.settings_page import SettingsPage
+from pages.history_page import HistoryPage
+from widgets.stats_panel import StatsPanel
 from glance.settings import load_settings, save_settings
+from glance.capture_buffer import BackgroundCapture
+from glance.scope import SCOPES, CaptureScope, to_frame_rect
+from glance.scheduler import RequestScheduler
+from glance.screenshot import get_engine
+from glance.hedging import HedgePolicy
+from glance.router import ModelRouter
+from glance.tracing import LagMonitor, get_tracer
+from glance.theme import load_stylesheet
+from glance.startup import get_profiler
 
 class FloatingWidget(QWidget):
     def __init__(self):
         super().__init__()
+        profiler = get_profiler()
 
         self.config = load_settings()
         self.api_endpoint = self.config.get("api_endpoint", "")
         self.api_key = self.config.get("api_key", "")
         self.model_provider = self.config.get("model_provider", "openai")
         
+        # Spans and rolling metrics for every query, plus UI stall detection
+        self.tracing_options = self.config.get("tracing", {})
+        self.tracer = get_tracer().configure(self.tracing_options)
+        self.lag_monitor = None
+        # Stall detection wakes the UI thread every 50ms, so it only runs when asked for
+        if self.tracing_options.get("stall_ms", 0) > 0:
+            self.lag_monitor = LagMonitor(self.tracer, threshold_ms=self.tracing_options["stall_ms"], parent=self)
+            self.lag_monitor.start()
+        
+        # Low-memory mode: fewer retained frames, streamed request bodies and an idle RSS ceiling
+        self.memory_options = self.config.get("memory", {})
+        self.low_memory = self.memory_options.get("low_memory", False)
+
+        # Pooled provider clients shared by every query, built on first use
+        self._providers = None
+        self._providers_lock = threading.Lock()
+        # Background event loop that runs every query
+        self.scheduler = RequestScheduler(max_concurrency=self.config.get("max_concurrent_requests", 2))
+        # Optional second provider raced against slow responses (None when disabled)
+        self.hedge = HedgePolicy.from_config(self.config.get("hedge", {}))
+        # Cheapest adequate model per query, escalating bad answers (None when disabled)
+        self.router = ModelRouter.from_config(self.config.get("routing", {}))
+        # Built by start_services once the window is visible; None until then, and when disabled
+        self.services_started = False
+        self.preprocess = None
+        self.response_cache = None
+        self.archive = None
+        self.history_store = None
+        self.scope_tracker = None
+        self.memory = None
+        self.ipc = None
+        
+        # Queries capture on submit and blank out our window ("mask", the default),
+        # hide the window first ("hide"), or use a frame sampled while unfocused ("ring")
+        self.capture_options = self.config.get("capture", {})
+        self.background_capture = None
+        if self.capture_options.get("mode", "mask") == "ring":
+            ring_options = {"max_frames": 1, **self.capture_options} if self.low_memory else self.capture_options
+            self.background_capture = BackgroundCapture.from_config(ring_options, self)
+            self.background_capture.start()
+        # Which part of the screen queries capture; kept for the session only
+        default_scope = self.capture_options.get("scope", "desktop")
+        self.default_scope = CaptureScope(default_scope if default_scope in SCOPES and default_scope != "region"
+                                          else "desktop")
+        profiler.mark("widget services")
+        
         # Set window opacity
         self.setWindowOpacity(0.95)
 
@@ -36,9 +95,9 @@ class FloatingWidget(QWidget):
         # Enable resizing
         self.setMinimumSize(300, 200)
         
-        # Apply styling with custom background and muted colors
-        apply_stylesheet(self, theme='dark_blue.xml')
-        self.setStyleSheet(self.styleSheet() + """
+        # Apply styling with custom background and muted colors; the compiled
+        # qt_material theme comes from the disk cache after the first launch
+        self.setStyleSheet(load_stylesheet('dark_blue.xml') + """
     QWidget {
         background-color: rgba(15, 20, 30, 0.6);
     }
@@ -58,6 +117,7 @@ class FloatingWidget(QWidget):
         color: #a1c4e3;
     }
 """)
+        profiler.mark("stylesheet")
         # Initialize stacked widget for multiple pages
         self.stacked_widget = QStackedWidget()
         
@@ -72,11 +132,100 @@ class FloatingWidget(QWidget):
         main_layout.setContentsMargins(0, 0, 0, 0)
         main_layout.setSpacing(0)
         
-        # Add title bar and stacked widget
+        # Add title bar, stacked widget and the (initially hidden) stats panel
         main_layout.addWidget(self.title_bar)
         main_layout.addWidget(self.stacked_widget)
+        main_layout.addWidget(self.stats_panel)
         
         self.setLayout(main_layout)
+        profiler.mark("widget layout")
+
+    def start_services(self):
+        """Build what queries need besides the scheduler; called once the window is visible
+
+        Each of these reads files, opens databases or sockets, or starts
+        processes, none of which the first paint should wait for.
+        """
+        if self.services_started:
+            return
+        self.services_started = True
+        profiler = get_profiler()
+        from glance.archive import ScreenshotArchive
+        from glance.cache import ResponseCache
+        from glance.history import HistoryStore
+        from glance.ipc import IpcServer
+        from glance.memory import MemoryGovernor
+        from glance.preprocess import PreprocessPool
+        from glance.scope import ScopeTracker
+
+        self.scope_tracker = ScopeTracker(own_windows=lambda: (int(self.winId()),), parent=self)
+        self.scope_tracker.set_scope(self.default_scope)
+        self.scope_tracker.set_active(self.isActiveWindow())
+        # Worker processes that resize and encode large captures (None: encode in the query thread);
+        # off by default in low-memory mode, since each warm worker is a resident process of its own
+        preprocess_options = self.config.get("preprocess", {})
+        if self.low_memory:
+            preprocess_options = {"enabled": False, **preprocess_options}
+        self.preprocess = PreprocessPool.from_config(preprocess_options)
+        # Answers for repeated screen + prompt pairs (None when disabled)
+        self.response_cache = ResponseCache.from_config(self.config.get("response_cache", {}))
+        # Screenshots sent with queries, written in the background (None when disabled)
+        self.archive = ScreenshotArchive.from_config(self.config.get("archive", {}))
+        # Searchable record of every answer, written in the background (None when not persisted)
+        self.history_store = HistoryStore.from_config(self.config.get("history", {}))
+        if self.history_store is not None:
+            self.main_page.history.set_source(self.history_store)
+            self.history_page = HistoryPage(self)
+            self.stacked_widget.addWidget(self.history_page)
+            self.history_button.show()
+        profiler.mark("deferred services")
+
+        # Trims memory after queries and enforces the idle ceiling (None outside low-memory mode)
+        self.memory = MemoryGovernor.from_config(self.memory_options, busy=lambda: self.main_page.worker is not None,
+                                                 parent=self)
+        if self.memory is not None:
+            # Dropped in this order while idle RSS stays above the ceiling
+            self.memory.add_releaser("rendered answers", self.main_page.renderer.clear)
+            self.memory.add_releaser("change baseline", self.main_page.reset_change_detector)
+            if self.background_capture is not None:
+                self.memory.add_releaser("capture ring", self.background_capture.buffer.clear)
+            self.memory.start()
+
+        # Control socket for questions from glance.client and keybindings (None when disabled)
+        self.ipc = IpcServer.from_config(self.config.get("ipc", {}), self.scheduler, self.status, parent=self)
+        if self.ipc is not None:
+            self.ipc.ask_requested.connect(self.ask_from_client)
+            self.ipc.ask_abandoned.connect(self.main_page.abandon)
+            self.ipc.show_requested.connect(self.bring_to_front)
+            if not self.ipc.start():
+                self.ipc = None
+        profiler.mark("control socket")
+
+    @property
+    def providers(self):
+        """Pooled provider clients; importing them is deferred until a query or preload needs them"""
+        with self._providers_lock:
+            if self._providers is None:
+                from glance.providers import ProviderRegistry
+                self._providers = ProviderRegistry(rate_limits=self.config.get("rate_limits", {}),
+                                                   provider_options=self.config.get("providers", {}),
+                                                   stream_body=self.low_memory)
+            return self._providers
+
+    def preload(self):
+        """Import the query pipeline in the background once the window is visible"""
+        modules = ["glance.api", "glance.regions"]
+        if 'gemini' in (self.model_provider, self.hedge.provider if self.hedge is not None else None):
+            modules.append("glance.geminiapi")
+
+        def load():
+            for name in modules:
+                importlib.import_module(name)
+            self.warm_up_provider()
+            if self.preprocess is not None:
+                self.preprocess.warm_up()
+
+        threading.Thread(target=load, name="glance-preload", daemon=True).start()
 
     def create_title_bar(self):
         # Create title bar
@@ -90,6 +239,25 @@ class FloatingWidget(QWidget):
         title_layout.addWidget(title_label)
         title_layout.addStretch()
         
+        # Toggle for the latency stats panel
+        self.stats_panel = StatsPanel(self.tracer)
+        self.stats_panel.setVisible(self.tracing_options.get("show_stats", False))
+        stats_button = QPushButton("Stats")
+        stats_button.setCheckable(True)
+        stats_button.setChecked(self.tracing_options.get("show_stats", False))
+        stats_button.setFixedHeight(22)
+        stats_button.toggled.connect(self.stats_panel.setVisible)
+        title_layout.addWidget(stats_button)
+
+        # Search through stored answers; shown once the history database is open
+        self.history_button = QPushButton("Search")
+        self.history_button.setFixedHeight(22)
+        self.history_button.setToolTip("Search earlier questions and answers (Ctrl+F)")
+        self.history_button.setShortcut("Ctrl+F")
+        self.history_button.clicked.connect(self.show_history_page)
+        self.history_button.hide()
+        title_layout.addWidget(self.history_button)
+        
         # Store title bar for dragging
         self.title_bar = title_bar
 
@@ -103,6 +271,9 @@ class FloatingWidget(QWidget):
         # Add pages to stacked widget
         self.stacked_widget.addWidget(self.main_page)
         self.stacked_widget.addWidget(self.settings_page)
+
+        # History search page, added by start_services if answers are stored
+        self.history_page = None
         
         # Set initial page
         self.show_main_page()
@@ -111,23 +282,103 @@ class FloatingWidget(QWidget):
         self.settings_page.update_fields(self.api_endpoint, self.api_key, self.model_provider)
         self.stacked_widget.setCurrentWidget(self.settings_page)
 
+    def show_history_page(self):
+        self.history_page.refresh()
+        self.stacked_widget.setCurrentWidget(self.history_page)
+
     def show_main_page(self):
         self.stacked_widget.setCurrentWidget(self.main_page)
 
     def save_settings(self, api_endpoint, api_key, model_provider):
-        settings = {
+        # Keep any other keys already in config.json
+        settings = dict(self.config)
+        settings.update({
             "api_endpoint": api_endpoint,
             "api_key": api_key,
             "model_provider": model_provider
-        }
+        })
         
+        self.config = settings
         self.api_endpoint = settings["api_endpoint"]
         self.api_key = settings["api_key"]
         self.model_provider = settings["model_provider"]
         
+        # Drop clients built for the old settings; an unchanged client stays warm
+        hedge_config = []
+        if self.hedge is not None:
+            hedge_config.append((self.hedge.provider, self.hedge.api_endpoint, self.hedge.api_key or api_key))
+        if self._providers is not None:
+            self._providers.retain(model_provider, api_endpoint, api_key, also=hedge_config)
+        self.warm_up_provider()
+        
         save_settings(settings)
         self.show_main_page()
 
+    def warm_up_provider(self):
+        """Load a local model in the background so the first question does not pay for it"""
+        if self.model_provider != 'local' or not self.api_endpoint.startswith('http'):
+            return
+        client = self.providers.get('local', self.api_endpoint, self.api_key)
+        if client.warm_at_startup and client.warmup_ms is None:
+            self.scheduler.submit(client.warmup)
+
+    def ask_from_client(self, question):
+        """Answer a question from the control socket like a typed one, leaving the input alone"""
+        if question.show:
+            self.bring_to_front()
+        self.main_page.ask_client(question)
+
+    def bring_to_front(self):
+        self.show()
+        self.raise_()
+        self.activateWindow()
+
+    def status(self):
+        """What the control socket reports; built on the GUI thread when a client asks"""
+        from glance.memory import usage
+        engine = get_engine()
+        status = {
+            "provider": self.model_provider,
+            "scope": (self.scope_tracker.scope if self.scope_tracker is not None else self.default_scope).describe(),
+            "visible": self.isVisible(),
+            "capture_backend": engine.backend.name if engine.backend is not None else None,
+            "capture_ms": round(engine.last_elapsed_ms, 2),
+            "ring_frames": len(self.background_capture.buffer) if self.background_capture is not None else None,
+            "scheduler": self.scheduler.stats(),
+            "providers": self._providers.stats() if self._providers is not None else None,
+            "response_cache": self.response_cache.stats() if self.response_cache is not None else None,
+            "archive": self.archive.stats() if self.archive is not None else None,
+            "preprocess": self.preprocess.stats() if self.preprocess is not None else None,
+            "history": self.history_store.stats() if self.history_store is not None else None,
+            "memory": self.memory.stats() if self.memory is not None else usage(),
+            "services_started": self.services_started,
+            "session_turns": len(self.main_page.session),
+            "queued_questions": len(self.main_page.client_questions),
+            "models": self.router.snapshot() if self.router is not None else None,
+        }
+        status["latency"] = self.tracer.snapshot()["spans"]
+        return status
+
+    def changeEvent(self, event):
+        if event.type() == QEvent.ActivationChange:
+            if self.background_capture is not None:
+                self.background_capture.set_active(self.isActiveWindow())
+            if self.scope_tracker is not None:
+                self.scope_tracker.set_active(self.isActiveWindow())
+        super().changeEvent(event)
+
+    def capture_exclusion_rect(self, capture_rect=None):
+        """Our window's on-screen rectangle in captured-frame pixels
+
+        Args:
+            capture_rect: The scoped rectangle the frame was captured from, if any;
+                the result is then relative to its top-left corner
+        """
+        x, y, width, height = to_frame_rect(self.frameGeometry())
+        if capture_rect is not None:
+            x, y = x - capture_rect[0], y - capture_rect[1]
+        return x, y, width, height
+
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
             # Check if click is in title bar
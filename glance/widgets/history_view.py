@@ -0,0 +1,188 @@
+# widgets/history_view.py
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, QRect, QSize, Qt, pyqtSignal
+from PyQt5.QtGui import QFontMetrics, QPixmap
+from PyQt5.QtWidgets import QListView, QStyle, QStyledItemDelegate
+
+from glance.history import HistoryEntry
+
+# Lines of the answer previewed under each question
+PREVIEW_LINES = 2
+# Characters of the answer kept for the preview
+PREVIEW_CHARS = 400
+# Decoded thumbnails kept per model
+THUMBNAIL_CACHE = 64
+
+
+class HistoryModel(QAbstractListModel):
+    """List model over a history source that loads older entries a page at a time
+
+    The source is ``glance.history.HistoryStore``, ``AnswerHistory`` or
+    ``SearchResults``; thumbnails are read from sources that store them, for
+    the rows being painted only.
+    """
+    EntryRole = Qt.UserRole + 1
+
+    def __init__(self, source, page_size: int = 20, parent=None):
+        super().__init__(parent)
+        self.source = source
+        self.page_size = page_size
+        self.entries: List[HistoryEntry] = []
+        self._thumbnails: "OrderedDict[int, Optional[QPixmap]]" = OrderedDict()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.entries):
+            return None
+        entry = self.entries[index.row()]
+        if role == Qt.DisplayRole:
+            return entry.question
+        if role == Qt.ToolTipRole:
+            return time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.timestamp)) + (
+                f" - {entry.model}" if entry.model else "")
+        if role == self.EntryRole:
+            return entry
+        if role == Qt.DecorationRole:
+            return self.thumbnail(entry)
+        return None
+
+    def thumbnail(self, entry: HistoryEntry) -> Optional[QPixmap]:
+        if entry.entry_id is None or not hasattr(self.source, "thumbnail"):
+            return None
+        if entry.entry_id in self._thumbnails:
+            self._thumbnails.move_to_end(entry.entry_id)
+            return self._thumbnails[entry.entry_id]
+        pixmap = None
+        data = self.source.thumbnail(entry.entry_id)
+        if data:
+            pixmap = QPixmap()
+            if not pixmap.loadFromData(data):
+                pixmap = None
+        self._thumbnails[entry.entry_id] = pixmap
+        if len(self._thumbnails) > THUMBNAIL_CACHE:
+            self._thumbnails.popitem(last=False)
+        return pixmap
+
+    def set_source(self, source) -> None:
+        """Show a different source, e.g. search results, starting from its first page"""
+        self.beginResetModel()
+        self.source = source
+        self.entries = []
+        self._thumbnails.clear()
+        self.endResetModel()
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and len(self.entries) < len(self.source)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        page = self.source.page(len(self.entries), self.page_size)
+        if not page:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.entries), len(self.entries) + len(page) - 1)
+        self.entries.extend(page)
+        self.endInsertRows()
+
+    def add(self, entry: HistoryEntry, **extra) -> None:
+        """Record a new answer at the top
+
+        Args:
+            extra: Passed on to the source's ``add``, e.g. the screenshot
+        """
+        self.source.add(entry, **extra)
+        self.beginInsertRows(QModelIndex(), 0, 0)
+        self.entries.insert(0, entry)
+        self.endInsertRows()
+        # A bounded source may have dropped its oldest entry
+        excess = len(self.entries) - len(self.source)
+        if excess > 0:
+            self.beginRemoveRows(QModelIndex(), len(self.entries) - excess, len(self.entries) - 1)
+            del self.entries[-excess:]
+            self.endRemoveRows()
+
+    def entry(self, row: int) -> Optional[HistoryEntry]:
+        return self.entries[row] if 0 <= row < len(self.entries) else None
+
+
+def preview(answer: str) -> str:
+    """The start of an answer on one line, without markdown markers"""
+    text = " ".join(answer[:PREVIEW_CHARS].split())
+    return text.replace("**", "").replace("`", "").replace("#", "")
+
+
+class HistoryDelegate(QStyledItemDelegate):
+    """Paints a question and a short plain preview of its answer in a fixed-height row
+
+    Rows are all the same height and drawn from plain text, so the view only
+    lays out and paints the rows on screen; the formatted answer is built
+    when an entry is opened. Search results preview the matching text, and
+    stored entries show their screenshot's thumbnail.
+    """
+
+    def sizeHint(self, option, index):
+        metrics = QFontMetrics(option.font)
+        return QSize(option.rect.width(), metrics.lineSpacing() * (1 + PREVIEW_LINES) + 10)
+
+    def paint(self, painter, option, index):
+        entry = index.data(HistoryModel.EntryRole)
+        if entry is None:
+            return
+        painter.save()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+            painter.setPen(option.palette.highlightedText().color())
+        else:
+            painter.setPen(option.palette.text().color())
+        metrics = QFontMetrics(option.font)
+        rect = option.rect.adjusted(6, 5, -6, -5)
+
+        thumbnail = index.data(Qt.DecorationRole)
+        if thumbnail is not None:
+            scaled = thumbnail.scaled(rect.height() * 16 // 10, rect.height(), Qt.KeepAspectRatio,
+                                      Qt.SmoothTransformation)
+            painter.drawPixmap(rect.x(), rect.y() + (rect.height() - scaled.height()) // 2, scaled)
+            rect.setLeft(rect.x() + scaled.width() + 6)
+
+        font = option.font
+        font.setBold(True)
+        painter.setFont(font)
+        question = QFontMetrics(font).elidedText(" ".join(entry.question.split()), Qt.ElideRight, rect.width())
+        painter.drawText(QRect(rect.x(), rect.y(), rect.width(), metrics.lineSpacing()),
+                         Qt.AlignLeft | Qt.AlignVCenter, question)
+
+        font.setBold(False)
+        painter.setFont(font)
+        body = QRect(rect.x(), rect.y() + metrics.lineSpacing(), rect.width(), metrics.lineSpacing() * PREVIEW_LINES)
+        painter.setOpacity(0.75)
+        painter.drawText(body, Qt.AlignLeft | Qt.AlignTop | Qt.TextWordWrap, entry.snippet or preview(entry.answer))
+        painter.restore()
+
+
+class HistoryView(QListView):
+    """Earlier answers, newest first; only the visible rows are laid out and painted"""
+    # A HistoryEntry the user asked to see again
+    opened = pyqtSignal(object)
+
+    def __init__(self, model: HistoryModel, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.setItemDelegate(HistoryDelegate(self))
+        # Every row has the same height, so nothing is measured per entry
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(QListView.Batched)
+        self.setBatchSize(50)
+        self.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.setSelectionMode(QListView.SingleSelection)
+        self.setEditTriggers(QListView.NoEditTriggers)
+        self.activated.connect(self.open)
+
+    def open(self, index):
+        entry = index.data(HistoryModel.EntryRole)
+        if entry is not None:
+            self.opened.emit(entry)
@@ -0,0 +1,78 @@
+# widgets/region_selector.py
+from PyQt5.QtWidgets import QWidget, QRubberBand, QApplication
+from PyQt5.QtCore import Qt, QRect, QPoint, QSize, pyqtSignal
+from PyQt5.QtGui import QPainter, QColor
+
+from glance.scope import to_frame_rect
+
+# Drags smaller than this (logical pixels) are treated as a stray click
+MIN_SIZE = 16
+
+
+class RegionSelector(QWidget):
+    """Full-desktop overlay for drawing the region a query should capture
+
+    Emits ``selected`` with the rectangle in captured-frame pixels, or
+    ``cancelled`` on Escape, a right click or a drag that is too small.
+    """
+    selected = pyqtSignal(tuple)
+    cancelled = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowFlags(Qt.Window | Qt.FramelessWindowHint | Qt.WindowStaysOnTopHint | Qt.Tool)
+        self.setAttribute(Qt.WA_TranslucentBackground)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+        self.setCursor(Qt.CrossCursor)
+        self.rubber_band = QRubberBand(QRubberBand.Rectangle, self)
+        self.origin = QPoint()
+
+    def start(self):
+        """Cover every monitor and wait for a drag"""
+        self.setGeometry(QApplication.primaryScreen().virtualGeometry())
+        self.show()
+        self.raise_()
+        self.activateWindow()
+        self.grabKeyboard()
+
+    def paintEvent(self, event):
+        # Dim the desktop so it is clear a selection is in progress
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(0, 0, 0, 70))
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.RightButton:
+            self.finish(None)
+            return
+        if event.button() == Qt.LeftButton:
+            self.origin = event.pos()
+            self.rubber_band.setGeometry(QRect(self.origin, QSize()))
+            self.rubber_band.show()
+
+    def mouseMoveEvent(self, event):
+        if self.rubber_band.isVisible():
+            self.rubber_band.setGeometry(QRect(self.origin, event.pos()).normalized())
+
+    def mouseReleaseEvent(self, event):
+        if event.button() != Qt.LeftButton or not self.rubber_band.isVisible():
+            return
+        rect = QRect(self.origin, event.pos()).normalized()
+        if rect.width() < MIN_SIZE or rect.height() < MIN_SIZE:
+            self.finish(None)
+            return
+        # Widget coordinates -> logical desktop coordinates -> frame pixels
+        self.finish(to_frame_rect(rect.translated(self.geometry().topLeft())))
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape:
+            self.finish(None)
+        else:
+            super().keyPressEvent(event)
+
+    def finish(self, rect):
+        self.releaseKeyboard()
+        self.close()
+        if rect is None:
+            self.cancelled.emit()
+        else:
+            self.selected.emit(rect)
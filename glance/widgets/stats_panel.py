@@ -0,0 +1,57 @@
+# widgets/stats_panel.py
+from PyQt5.QtWidgets import QLabel
+from PyQt5.QtCore import QTimer
+
+from glance.tracing import Tracer
+
+# Spans shown in the panel, in pipeline order
+PANEL_SPANS = ("capture", "preprocess", "network", "render")
+
+
+def _ms(value):
+    return "-" if value is None else f"{value:.0f}"
+
+
+class StatsPanel(QLabel):
+    """Compact readout of recent query latencies and UI stalls"""
+
+    def __init__(self, tracer: Tracer, parent=None):
+        super().__init__(parent)
+        self.tracer = tracer
+        self.setStyleSheet("font-family: monospace; font-size: 11px; padding: 4px 10px;")
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+
+    def setVisible(self, visible):
+        super().setVisible(visible)
+        # Only poll the tracer while someone can see the numbers
+        if visible:
+            self.refresh()
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    def refresh(self):
+        snapshot = self.tracer.snapshot()
+        spans = snapshot["spans"]
+        lines = []
+
+        last = snapshot["last_trace"]
+        if last is not None:
+            ttft = next((span["attributes"].get("ttft_ms") for span in last["spans"] if span["name"] == "network"), None)
+            lines.append(f"last   {_ms(last['duration_ms'])}ms  ttft {_ms(ttft)}ms  {last['status']}")
+
+        query = spans.get("query", {})
+        ttft = self.tracer.percentiles("ttft_ms")
+        lines.append(f"p50/95 query {_ms(query.get('p50'))}/{_ms(query.get('p95'))}  "
+                     f"ttft {_ms(ttft['p50'])}/{_ms(ttft['p95'])}  n={query.get('n', 0)}")
+        stages = [f"{name} {_ms(spans[name]['p50'])}" for name in PANEL_SPANS if name in spans]
+        if stages:
+            lines.append("p50    " + "  ".join(stages))
+
+        stall = snapshot["last_stall"]
+        if stall is not None:
+            stalls = int(snapshot["counters"].get("ui_stalls_total", 0))
+            lines.append(f"stalls {stalls}  last {_ms(stall['lag_ms'])}ms in {stall['span'] or 'idle'}")
+        self.setText("\n".join(lines))
@@ -8,6 +8,13 @@ setup(
         'PyQt5',
         'keyboard',
         'Pillow',
+        'numpy',
         'qt-material',
     ],
+    entry_points={
+        'console_scripts': [
+            'glance-batch=glance.batch:main',
+            'glance-ask=glance.client:main',
+        ],
+    },
 )
@@ -0,0 +1,97 @@
+import pytest
+import requests
+
+from glance.admission import AdmissionController, AdmissionError, CircuitBreaker, CircuitOpenError
+
+
+def answer(*parts):
+    return lambda: iter(parts)
+
+
+def failing(calls):
+    def open_stream():
+        calls.append(1)
+        raise requests.ConnectionError("connection refused")
+        yield  # pragma: no cover
+    return open_stream
+
+
+def test_admits_within_rate():
+    controller = AdmissionController(requests_per_minute=60)
+    assert list(controller.stream(answer("a", "b"))) == ["a", "b"]
+    assert controller.stats()["requests"] == 1
+
+
+def test_refusals_do_not_push_the_next_request_out():
+    controller = AdmissionController(requests_per_minute=1, max_wait=5)
+    list(controller.stream(answer("a")))
+    for _ in range(4):
+        with pytest.raises(AdmissionError, match="60s"):
+            list(controller.stream(answer("b")))
+    # Only the request that was sent is owed
+    assert controller.request_bucket.tokens > -0.01
+
+
+def test_refused_tokens_are_refunded():
+    controller = AdmissionController(tokens_per_minute=1000, max_wait=1)
+    list(controller.stream(answer("a"), tokens=1000))
+    with pytest.raises(AdmissionError):
+        list(controller.stream(answer("b"), tokens=1000))
+    assert controller.token_bucket.tokens > -1
+
+
+def test_retries_connection_errors():
+    controller = AdmissionController(base_delay=0)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise requests.ConnectionError("reset")
+        yield "ok"
+
+    assert list(controller.stream(flaky)) == ["ok"]
+    assert controller.retries == 1
+
+
+def test_circuit_opens_after_repeated_failures():
+    controller = AdmissionController(max_attempts=1, failure_threshold=2, reset_timeout=60)
+    calls = []
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            list(controller.stream(failing(calls)))
+    with pytest.raises(CircuitOpenError):
+        list(controller.stream(failing(calls)))
+    assert len(calls) == 2
+    assert controller.breaker.state == CircuitBreaker.OPEN
+
+
+def test_failed_trial_raises_the_provider_error():
+    controller = AdmissionController(max_attempts=3, base_delay=0, failure_threshold=1, reset_timeout=0)
+    calls = []
+    with pytest.raises(requests.ConnectionError):
+        list(controller.stream(failing(calls)))
+    calls.clear()
+    # The circuit is past its reset timeout, so this request is the half-open trial
+    with pytest.raises(requests.ConnectionError):
+        list(controller.stream(failing(calls)))
+    assert len(calls) == 1
+    assert controller.breaker.state == CircuitBreaker.OPEN
+
+
+def test_successful_trial_closes_the_circuit():
+    controller = AdmissionController(max_attempts=1, failure_threshold=1, reset_timeout=0)
+    with pytest.raises(requests.ConnectionError):
+        list(controller.stream(failing([])))
+    assert list(controller.stream(answer("ok"))) == ["ok"]
+    assert controller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_abandoned_trial_lets_the_next_request_try():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.abandon_trial()
+    assert breaker.before_call() is True
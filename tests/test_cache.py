@@ -0,0 +1,82 @@
+import json
+import os
+
+from glance.cache import CacheEntry, ResponseCache, normalize_prompt
+
+
+def test_normalized_prompt_hits():
+    cache = ResponseCache()
+    cache.put(0b1010, "What is this?", "m", "A window")
+    assert cache.get(0b1010, "  what is THIS ", "m") == "A window"
+    assert cache.get(0b1010, "what is this", "other-model") is None
+
+
+def test_hits_within_tolerance_only():
+    cache = ResponseCache(tolerance=2)
+    cache.put(0b0000, "q", "m", "answer")
+    assert cache.get(0b0011, "q", "m") == "answer"
+    assert cache.get(0b0111, "q", "m") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_closest_frame_wins():
+    cache = ResponseCache(tolerance=4)
+    cache.put(0b0000, "q", "m", "far")
+    cache.put(0b1110, "q", "m", "near")
+    assert cache.get(0b1111, "q", "m") == "near"
+
+
+def test_evicts_least_recently_used_entry():
+    cache = ResponseCache(max_entries=2)
+    cache.put(1, "a", "m", "first")
+    cache.put(2, "b", "m", "second")
+    assert cache.get(1, "a", "m") == "first"
+    cache.put(3, "c", "m", "third")
+    assert cache.get(2, "b", "m") is None
+    assert cache.get(1, "a", "m") == "first"
+
+
+def test_byte_bound_counts_utf8():
+    entry = CacheEntry(1, normalize_prompt("é" * 10), "m", "ü" * 10)
+    assert entry.size == 40
+    cache = ResponseCache(max_bytes=60)
+    cache.put(1, "é" * 10, "m", "ü" * 10)
+    cache.put(2, "é" * 10, "m", "ü" * 10)
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] <= 60
+
+
+def test_same_frame_replaces_entry():
+    cache = ResponseCache()
+    cache.put(1, "q", "m", "old")
+    cache.put(1, "q", "m", "new")
+    assert cache.get(1, "q", "m") == "new"
+    assert cache.stats()["entries"] == 1
+
+
+def test_persists_between_instances(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = ResponseCache(path=path, save_delay=60)
+    cache.put(7, "q", "m", "answer")
+    # Saved on the timer, not by put itself
+    assert not os.path.exists(path)
+    cache.flush()
+    assert [entry["answer"] for entry in json.load(open(path))] == ["answer"]
+    assert ResponseCache(path=path).get(7, "q", "m") == "answer"
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_unwritable_path_keeps_working_in_memory(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "missing" / "cache.json"), save_delay=60)
+    cache.put(7, "q", "m", "answer")
+    cache.flush()
+    assert cache.stats()["save_errors"] == 1
+    assert cache.get(7, "q", "m") == "answer"
+
+
+def test_unreadable_file_is_ignored(tmp_path):
+    path = tmp_path / "cache.json"
+    path.write_text("not json")
+    cache = ResponseCache(path=str(path))
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+from PIL import Image
+
+from glance.encoder import EncodeBudget, budget_for, encode_for_budget, encode_ladder
+from glance.frame import Frame
+from glance.screenshot import PixelBuffer
+
+
+def frame(image):
+    return Frame(PixelBuffer(image.tobytes(), image.width, image.height, raw_mode="RGB"))
+
+
+@pytest.fixture(scope="module")
+def noisy():
+    # Random pixels barely compress, so small budgets force the ladder down
+    return Image.frombytes("RGB", (1200, 800), os.urandom(1200 * 800 * 3))
+
+
+@pytest.fixture(scope="module")
+def flat():
+    return Image.new("RGB", (1200, 800), (30, 60, 90))
+
+
+def test_png_first_when_it_fits(flat):
+    encoded = encode_for_budget(frame(flat), EncodeBudget(max_bytes=100_000))
+    assert (encoded.format, encoded.steps, encoded.within_budget) == ("PNG", 1, True)
+    assert encoded.size == (1200, 800)
+
+
+def test_scales_to_max_dimension(flat):
+    encoded = encode_for_budget(frame(flat), EncodeBudget(max_bytes=100_000, max_dimension=600))
+    assert encoded.size == (600, 400)
+
+
+def test_falls_back_to_lossy_and_smaller(noisy):
+    budget = EncodeBudget(max_bytes=60_000, formats=("PNG", "JPEG"), qualities=(85, 55), min_dimension=256)
+    encoded = encode_for_budget(frame(noisy), budget)
+    assert encoded.format == "JPEG"
+    assert encoded.within_budget
+    assert len(encoded.data) <= 60_000
+    assert max(encoded.size) < 1200
+    assert encoded.steps <= budget.max_steps
+
+
+def test_returns_smallest_attempt_when_nothing_fits(noisy):
+    budget = EncodeBudget(max_bytes=10, formats=("JPEG",), qualities=(85, 55), max_steps=3)
+    encoded = encode_for_budget(frame(noisy), budget)
+    assert not encoded.within_budget
+    assert encoded.steps == 3
+
+
+def test_zero_max_steps_still_encodes_once(flat):
+    encoded = encode_for_budget(frame(flat), EncodeBudget(max_bytes=10, max_steps=0))
+    assert encoded.steps == 1
+    assert encoded.data
+
+
+def test_empty_qualities_use_the_defaults(flat):
+    encoded = encode_for_budget(frame(flat), EncodeBudget(max_bytes=10, formats=("JPEG",), qualities=()))
+    assert encoded.format == "JPEG"
+    assert encoded.quality in EncodeBudget._field_defaults["qualities"]
+
+
+def test_unknown_formats_fall_back_to_jpeg(flat):
+    encoded = encode_for_budget(frame(flat), EncodeBudget(max_bytes=100_000, formats=()))
+    assert encoded.format == "JPEG"
+
+
+def test_ladder_stops_encoding_a_level_once_one_fits(flat):
+    asked = []
+
+    def encode_level(dimension, candidates):
+        for fmt, quality in candidates:
+            asked.append((fmt, quality))
+            yield b"x" * (10 if quality == 70 else 1000)
+
+    budget = EncodeBudget(max_bytes=100, formats=("PNG", "JPEG"))
+    encoded = encode_ladder(frame(flat), budget, encode_level)
+    assert (encoded.format, encoded.quality, encoded.steps) == ("JPEG", 70, 3)
+    assert asked == [("PNG", None), ("JPEG", 85), ("JPEG", 70)]
+
+
+def test_budget_overrides():
+    budget = budget_for("gemini-1.5-flash", {"gemini-1.5-flash": {"max_bytes": 1234, "unknown": 1}})
+    assert budget.max_bytes == 1234
+    assert budget.max_dimension == 1024
@@ -0,0 +1,89 @@
+import requests
+
+from glance.admission import AdmissionError
+from glance.encoder import EncodedImage
+from glance.router import ModelRouter, classify
+
+TIERS = {"openai": ["small", "large"]}
+
+
+def image(size=(512, 512), nbytes=10_000):
+    return EncodedImage(b"x" * nbytes, "JPEG", 70, size, 1, 1.0, True)
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def test_classify():
+    assert classify("fine") is None
+    assert classify("  \n") == "empty"
+    assert classify("cut", finish_reason="length") == "truncated"
+    assert classify("cut", finish_reason="MAX_TOKENS") == "truncated"
+    assert classify("", error=requests.ConnectionError()) == "error"
+    assert classify("", error=http_error(500)) == "error"
+    assert classify("", error=http_error(401)) == "fatal"
+    assert classify("", error=AdmissionError("slow down")) == "refused"
+
+
+def test_short_query_starts_on_the_lowest_tier():
+    route = ModelRouter(tiers=TIERS).route("openai", "small", "what is this?", [image()])
+    assert route.model == "small"
+    assert route.reason == "default"
+
+
+def test_long_prompt_and_large_image_start_higher():
+    router = ModelRouter(tiers=TIERS, long_prompt_tokens=10)
+    assert router.route("openai", "small", "word " * 40).model == "large"
+    router = ModelRouter(tiers=TIERS, large_image_bytes=1000)
+    route = router.route("openai", "small", "q", [image(nbytes=5000)])
+    assert (route.model, route.reason) == ("large", "large image")
+
+
+def test_unlisted_provider_uses_its_model():
+    route = ModelRouter(tiers=TIERS).route("local", "llava", "q")
+    assert route.models == ["llava"]
+    assert route.escalate("empty") is None
+
+
+def test_escalates_once():
+    route = ModelRouter(tiers={"openai": ["a", "b", "c"]}, max_escalations=1).route("openai", "a", "q")
+    assert route.escalate("truncated") == "b"
+    assert route.escalate("truncated") is None
+    assert route.report()["initial"] == "a"
+
+
+def test_skips_a_tier_that_often_needs_escalating():
+    router = ModelRouter(tiers=TIERS, min_samples=5, max_failure_rate=0.3)
+    for _ in range(5):
+        router.record("small", "truncated")
+    route = router.route("openai", "small", "q")
+    assert route.model == "large"
+    assert "often escalated" in route.reason
+
+
+def test_refusals_and_fatal_errors_do_not_count_against_a_model():
+    router = ModelRouter(tiers=TIERS, min_samples=5)
+    for reason in ("refused", "fatal") * 3:
+        router.record("small", reason)
+    assert router.route("openai", "small", "q").model == "small"
+    assert router.snapshot()["small"]["failure_rate"] == 0.0
+
+
+def test_probes_a_skipped_tier_again():
+    router = ModelRouter(tiers=TIERS, min_samples=2, probe_every=3)
+    router.record("small", "empty")
+    router.record("small", "empty")
+    models = [router.route("openai", "small", "q").model for _ in range(4)]
+    assert models == ["large", "large", "large", "small"]
+
+
+def test_skips_a_slow_tier_when_a_stronger_one_meets_the_target():
+    router = ModelRouter(tiers=TIERS, min_samples=3, latency_target_ms=1000)
+    for _ in range(3):
+        router.record("small", None, total_ms=3000)
+        router.record("large", None, total_ms=500)
+    route = router.route("openai", "small", "q")
+    assert (route.model, route.reason) == ("large", "small too slow")
@@ -0,0 +1,85 @@
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from glance.scheduler import RequestScheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = RequestScheduler(max_concurrency=1, max_workers=3)
+    yield scheduler
+    scheduler.shutdown()
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_runs_jobs_and_returns_results(scheduler):
+    assert scheduler.submit(lambda: 42).result(timeout=2) == 42
+    wait_until(lambda: scheduler.stats()["active"] == 0)
+    assert scheduler.stats()["completed"] == 1
+
+
+def test_job_errors_reach_the_caller(scheduler):
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        scheduler.submit(fail).result(timeout=2)
+
+
+def test_jobs_wait_for_a_slot(scheduler):
+    release = threading.Event()
+    first = scheduler.submit(release.wait)
+    second = scheduler.submit(lambda: "second")
+    wait_until(lambda: scheduler.stats()["waiting"] == 1)
+    assert not second.done()
+    release.set()
+    assert second.result(timeout=2) == "second"
+    assert first.result(timeout=2) is True
+
+
+def test_deadline_includes_time_waiting_for_a_slot(scheduler):
+    release = threading.Event()
+    scheduler.submit(release.wait)
+    timed_out = threading.Event()
+    late = scheduler.submit(lambda: "late", timeout=0.1, on_timeout=timed_out.set)
+    assert late.result(timeout=2) is None
+    assert timed_out.is_set()
+    assert scheduler.stats()["timed_out"] == 1
+    release.set()
+
+
+def test_cancelled_job_keeps_its_slot_until_its_thread_returns(scheduler):
+    release = threading.Event()
+    started = threading.Event()
+
+    def job():
+        started.set()
+        release.wait()
+
+    future = scheduler.submit(job)
+    started.wait(2)
+    future.cancel()
+    wait_until(lambda: scheduler.stats()["cancelled"] == 1)
+    after = scheduler.submit(lambda: "after")
+    with pytest.raises(concurrent.futures.TimeoutError):
+        after.result(timeout=0.2)
+    assert scheduler.stats()["active"] == 1
+    release.set()
+    assert after.result(timeout=2) == "after"
+
+
+def test_submit_within_takes_no_slot(scheduler):
+    def job():
+        # Runs under the only slot and waits on work of its own
+        return scheduler.submit_within(lambda: "inner").result(timeout=2)
+
+    assert scheduler.submit(job).result(timeout=2) == "inner"
@@ -0,0 +1,56 @@
+from glance.encoder import EncodedImage
+from glance.session import OMITTED_IMAGE_NOTE, Session, Turn
+
+
+def image():
+    return EncodedImage(b"x" * 100, "JPEG", 70, (512, 512), 1, 1.0, True)
+
+
+def test_first_question_needs_the_image():
+    session = Session(tolerance=2)
+    assert session.needs_image(0b1111)
+    session.add(Turn("q", [image()], "a"), frame_hash=0b1111)
+    assert not session.needs_image(0b1100)
+    assert session.needs_image(0b0000)
+    assert session.needs_image(None)
+
+
+def test_only_the_newest_screenshot_is_kept():
+    session = Session()
+    session.add(Turn("first", [image()], "a"), frame_hash=1)
+    session.add(Turn("second", [image()], "b"), frame_hash=2)
+    history = session.history()
+    assert [bool(turn.images) for turn in history] == [False, True]
+    assert history[0].prompt.startswith(OMITTED_IMAGE_NOTE)
+    # A question bringing a new screenshot drops them all
+    assert not any(turn.images for turn in session.history(keep_image=False))
+
+
+def test_history_is_trimmed_oldest_first_keeping_the_screenshot():
+    session = Session(max_history_tokens=900)
+    session.add(Turn("look", [image()], "a"), frame_hash=1)
+    for i in range(20):
+        session.add(Turn(f"follow-up {i} " + "word " * 40, answer="answer " * 40))
+    history = session.history()
+    assert history[0].prompt == "look"
+    assert history[-1].prompt.startswith("follow-up 19")
+    assert len(history) < 21
+    assert sum(turn.tokens for turn in history) <= 900
+
+
+def test_max_turns_forgets_the_screen_with_its_turn():
+    session = Session(max_turns=2)
+    session.add(Turn("look", [image()], "a"), frame_hash=1)
+    session.add(Turn("more", answer="b"))
+    assert not session.needs_image(1)
+    session.add(Turn("again", answer="c"))
+    assert len(session) == 2
+    assert session.needs_image(1)
+
+
+def test_reset():
+    session = Session()
+    session.add(Turn("look", [image()], "a"), frame_hash=1)
+    session.reset()
+    assert len(session) == 0
+    assert session.needs_image(1)